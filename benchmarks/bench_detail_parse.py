@@ -0,0 +1,133 @@
+# Compare the time taken to extract the course detail information by
+# scrape.parse_course_detail with the original implementation of
+# course_detail, which made separate text scans and XPath queries for
+# each piece of information, and check that both give the same result.
+#
+# Usage:
+#
+#   python benchmarks/bench_detail_parse.py saved_detail_pages/*.html
+#
+# where the HTML files are course detail pages saved from the
+# registration site.
+
+import re
+import sys
+import time
+import argparse
+from pathlib import Path
+
+import lxml.html
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from scrape import (SIZE_KEYS, TUITION_COURSE_KEYS,  # noqa: E402
+                    TUITION_PER_CREDIT_KEYS, LASC_AREAS, LASC_WI,
+                    ONLINE_18, TUITION_UNIT, COURSE_LEVEL,
+                    lasc_area_label, parse_course_detail)
+
+
+def original_parse_course_detail(page_content, course_url=''):
+    """
+    The parsing half of course_detail as it was before the single pass
+    extractor, kept here as the reference for timing and correctness.
+    """
+
+    def parse_size_cap(element):
+        return element.getparent().text_content().split(':')[1].strip()
+
+    lxml_parsed = lxml.html.fromstring(page_content)
+
+    if 'System Error' in page_content:
+        return {k: -1 for k in SIZE_KEYS}
+
+    if TUITION_PER_CREDIT_KEYS[0] in page_content:
+        tuition_keys = TUITION_PER_CREDIT_KEYS
+        tuition_unit = 'credit'
+    else:
+        tuition_keys = TUITION_COURSE_KEYS
+        tuition_unit = 'course'
+
+    lasc_areas = [lasc_area_label(area) for area in LASC_AREAS
+                  if area in page_content]
+
+    xpath_expr = './/*[contains(text(), $key)]'
+    to_get = {}
+
+    for key in SIZE_KEYS + tuition_keys:
+        foo = lxml_parsed.xpath(xpath_expr, key=key)
+        try:
+            value = parse_size_cap(foo[0])
+        except IndexError:
+            value = ''
+        if key in SIZE_KEYS:
+            value = int(value)
+
+        try:
+            idx = TUITION_PER_CREDIT_KEYS.index(key)
+        except ValueError:
+            to_get[key] = value
+        else:
+            use_key = TUITION_COURSE_KEYS[idx]
+            to_get[use_key] = value
+
+    to_get[TUITION_UNIT] = tuition_unit
+    to_get[LASC_WI] = ','.join(lasc_areas)
+    to_get[ONLINE_18] = '18 On-Line' in page_content
+
+    all_the_text = lxml_parsed.text_content()
+    matches = re.search(r'.*Course Level\s+(\w+)\s+(Description|General/Liberal|Lectures/Labs|Corequisites|Add To Wait List|Minnesota Transfer Curriculum Goal|Non-Course Prerequisites)',
+                        all_the_text)
+
+    if matches:
+        to_get[COURSE_LEVEL] = matches.groups(1)[0]
+    else:
+        to_get[COURSE_LEVEL] = 'Unknown'
+        raise RuntimeError('Failed to find "Course Level" '
+                           'in URL {}'.format(course_url))
+
+    return to_get
+
+
+def time_parser(parser, pages, repeat):
+    """
+    Return the best time, out of ``repeat`` tries, to parse every page.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for page in pages:
+            parser(page)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare course detail '
+                                     'parsing speed with the original '
+                                     'implementation')
+    parser.add_argument('pages', nargs='+',
+                        help='Saved course detail pages (HTML).')
+    parser.add_argument('--repeat', action='store', type=int, default=5,
+                        help='Number of times to time each parser; the '
+                        'best time is reported.')
+    args = parser.parse_args()
+
+    pages = [Path(p).read_text(encoding='utf-8') for p in args.pages]
+
+    # Make sure the two agree before timing anything.
+    for path, page in zip(args.pages, pages):
+        old = original_parse_course_detail(page)
+        new = parse_course_detail(page)
+        if old != new:
+            raise RuntimeError('Parsers disagree on {}:\n  original: {}\n'
+                               '  new: {}'.format(path, old, new))
+
+    old_time = time_parser(original_parse_course_detail, pages, args.repeat)
+    new_time = time_parser(parse_course_detail, pages, args.repeat)
+
+    print(f'{len(pages)} pages, best of {args.repeat}')
+    print(f'  original: {old_time:.4f} s '
+          f'({len(pages) / old_time:.1f} pages/s)')
+    print(f'  new:      {new_time:.4f} s '
+          f'({len(pages) / new_time:.1f} pages/s)')
+    print(f'  speedup:  {old_time / new_time:.2f}x')
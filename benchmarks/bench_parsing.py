@@ -0,0 +1,260 @@
+# Benchmarks for the parsing hot paths of scrape.py, run against the
+# pages kept in benchmarks/fixtures/ (see benchmarks/fixtures.py) so
+# that no network is needed.
+#
+# Usage:
+#
+#   python benchmarks/bench_parsing.py --save baseline.json
+#   ...change the code...
+#   python benchmarks/bench_parsing.py --compare baseline.json
+#
+# For each benchmark the pages (or items) per second, the best time and
+# the peak memory allocated are reported. With --compare, any benchmark
+# that is slower than the baseline by more than --tolerance is reported
+# as a regression and the exit status is 1.
+
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+from pathlib import Path
+from contextlib import contextmanager
+
+import lxml.html
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import scrape  # noqa: E402
+from fixtures import (DEFAULT_FIXTURE_DIR, FixtureServer,  # noqa: E402
+                      fingerprint, load)
+
+# Default fraction by which a benchmark may be slower than the baseline
+# before it counts as a regression.
+DEFAULT_TOLERANCE = 0.1
+
+# The URL templates in scrape.py that point at the registration site.
+URL_TEMPLATES = ['URL_ROOT', 'SUBJECT_SEARCH_URL', 'COURSE_DETAIL_URL']
+
+
+def table_cells(search_pages):
+    """
+    Return the raw text of every header and cell of the search results
+    tables, and the location cells, in the same way
+    ``scrape.results_table_rows`` picks them out.
+    """
+    texts = []
+    locations = []
+    for page in search_pages:
+        try:
+            table = lxml.html.fromstring(page).findall(
+                ".//table[@id='resultsTable']")[0]
+        except IndexError:
+            continue
+        texts.extend(h.text_content() for h in table.findall('.//th'))
+        for row in table.findall('.//tbody/tr'):
+            cols = row.findall('td')
+            texts.extend(c.text_content() for c in cols[1:-1])
+            locations.append(cols[-1])
+    return texts, locations
+
+
+@contextmanager
+def site_at(url_root):
+    """
+    Point the URL templates of scrape.py at ``url_root`` instead of the
+    registration site for the duration of the block.
+    """
+    originals = {name: getattr(scrape, name) for name in URL_TEMPLATES}
+    try:
+        for name, template in originals.items():
+            setattr(scrape, name,
+                    template.replace(scrape.URL_COMMON_ROOT, url_root))
+        yield
+    finally:
+        for name, template in originals.items():
+            setattr(scrape, name, template)
+
+
+def build_benchmarks(fixtures):
+    """
+    Return a list of ``(name, unit, count, function)``, where calling
+    ``function`` processes ``count`` pages or items.
+    """
+    search_pages = list(fixtures['search_pages'].values())
+    detail_pages = list(fixtures['detail_pages'].values())
+    texts, locations = table_cells(search_pages)
+
+    url_params = dict(year_term=None, subject=None, course_id=None,
+                      campus_id=fixtures['campus_id'])
+    subject_params = [
+        scrape.source_params(subject, url_params, fixtures['year_term'])
+        for subject in fixtures['subjects']
+    ]
+    detail_params = [
+        dict(url_params, year_term=fixtures['year_term'], course_id=cid)
+        for cid in fixtures['course_ids']
+    ]
+
+    def scrape_tables():
+        for page in search_pages:
+            try:
+                scrape.scrape_class_data_from_results_table(page)
+            except IndexError:
+                pass
+
+    def stream_tables():
+        for page in search_pages:
+            data = page.encode('utf-8')
+            table = scrape.ResultsTableStream(encoding='utf-8')
+            for start in range(0, len(data), scrape.STREAM_CHUNK_SIZE):
+                table.feed(data[start:start + scrape.STREAM_CHUNK_SIZE])
+            try:
+                table.close()
+            except IndexError:
+                pass
+
+    def class_lists():
+        for params in subject_params:
+            try:
+                scrape.class_list_for_subject(params)
+            except IndexError:
+                pass
+
+    return [
+        ('decrap_item', 'items', len(texts),
+         lambda: [scrape.decrap_item(text) for text in texts]),
+        ('get_location', 'items', len(locations),
+         lambda: [scrape.get_location(loc) for loc in locations]),
+        ('scrape_class_data_from_results_table', 'pages', len(search_pages),
+         scrape_tables),
+        ('ResultsTableStream', 'pages', len(search_pages), stream_tables),
+        ('parse_course_detail', 'pages', len(detail_pages),
+         lambda: [scrape.parse_course_detail(page) for page in detail_pages]),
+        ('class_list_for_subject (local server)', 'pages',
+         len(subject_params), class_lists),
+        ('course_detail (local server)', 'pages', len(detail_params),
+         lambda: [scrape.course_detail(params) for params in detail_params]),
+    ]
+
+
+def best_time(function, repeat):
+    """
+    Return the best time, out of ``repeat`` tries, to call ``function``.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def peak_memory(function):
+    """
+    Return the peak memory, in bytes, allocated by Python while calling
+    ``function``; memory lxml allocates for its own trees is not seen.
+    This is measured separately from the timing because tracing
+    allocations slows everything down.
+    """
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run(fixtures, repeat=5, only=None):
+    """
+    Run the benchmarks, or those whose names contain one of the strings
+    in ``only``, and return the results keyed by benchmark name.
+    """
+    results = {}
+    with FixtureServer(fixtures) as server, site_at(server.url_root):
+        for name, unit, count, function in build_benchmarks(fixtures):
+            if only and not any(part in name for part in only):
+                continue
+            print(f'    Running {name}\r', end='', flush=True)
+            seconds = best_time(function, repeat)
+            results[name] = dict(unit=unit, count=count, seconds=seconds,
+                                 per_second=count / seconds,
+                                 peak_memory=peak_memory(function))
+    return results
+
+
+def report(results, baseline=None, tolerance=DEFAULT_TOLERANCE):
+    """
+    Print the results, compared with the baseline if there is one, and
+    return the names of the benchmarks that regressed.
+    """
+    regressions = []
+    width = max(len(name) for name in results)
+    for name, result in results.items():
+        line = (f'{name:<{width}}  {result["per_second"]:10.1f} '
+                f'{result["unit"]}/s  {result["seconds"]:8.4f} s  '
+                f'{result["peak_memory"] / 2**20:7.1f} MiB')
+        old = (baseline or {}).get(name)
+        if old is not None:
+            ratio = result['seconds'] / old['seconds']
+            line += f'  {ratio:5.2f}x baseline time'
+            if ratio > 1 + tolerance:
+                line += '  REGRESSION'
+                regressions.append(name)
+        print(line)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the parsing '
+                                     'in scrape.py against recorded pages')
+    parser.add_argument('--fixtures', action='store',
+                        default=str(DEFAULT_FIXTURE_DIR),
+                        help='Directory of pages recorded by '
+                        'benchmarks/fixtures.py. The default is the fixed '
+                        'set kept with the benchmarks.')
+    parser.add_argument('--repeat', action='store', type=int, default=5,
+                        help='Number of times to time each benchmark; the '
+                        'best time is reported.')
+    parser.add_argument('--only', action='store', nargs='+', default=None,
+                        help='Run only the benchmarks whose names contain '
+                        'one of these.')
+    parser.add_argument('--save', action='store', metavar='BASELINE_JSON',
+                        help='Save the results as a baseline.')
+    parser.add_argument('--compare', action='store', metavar='BASELINE_JSON',
+                        help='Compare the results with a saved baseline.')
+    parser.add_argument('--tolerance', action='store', type=float,
+                        default=DEFAULT_TOLERANCE,
+                        help='Fraction by which a benchmark may be slower '
+                        'than the baseline before it is a regression.')
+    args = parser.parse_args()
+
+    fixtures = load(args.fixtures)
+    results = run(fixtures, repeat=args.repeat, only=args.only)
+
+    pages = fingerprint(fixtures)
+    baseline = None
+    if args.compare:
+        saved = json.loads(Path(args.compare).read_text())
+        baseline = saved['results']
+        if saved.get('fixtures') != pages:
+            print('Warning: the baseline was run on different pages, so '
+                  'the times may not be comparable.')
+
+    print(f'{len(fixtures["search_pages"])} search pages, '
+          f'{len(fixtures["detail_pages"])} detail pages, '
+          f'best of {args.repeat}')
+    regressions = report(results, baseline=baseline,
+                         tolerance=args.tolerance)
+
+    if args.save:
+        Path(args.save).write_text(json.dumps(
+            dict(python=sys.version.split()[0], repeat=args.repeat,
+                 fixtures=pages, results=results), indent=2))
+        print(f'Saved baseline to {args.save}')
+
+    if regressions:
+        print(f'{len(regressions)} benchmarks regressed: '
+              f'{", ".join(regressions)}')
+        sys.exit(1)
@@ -0,0 +1,55 @@
+# Time how long each headcounts command takes to start, as a fresh
+# process, which matters for the many short runs started by cron.
+#
+# Usage:
+#
+#   python benchmarks/bench_startup.py
+#
+# For each command the best wall time of "headcounts.py <command> --help"
+# is reported, next to that of an interpreter that does nothing, along
+# with the slow-to-import libraries the command loaded.
+
+import sys
+import time
+import argparse
+import subprocess
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from headcounts import COMMANDS  # noqa: E402
+
+HEADCOUNTS = Path(__file__).resolve().parent.parent / 'headcounts.py'
+
+
+def best_wall_time(command, repeat):
+    """
+    Return the best time, out of ``repeat`` tries, to run ``command``,
+    and its standard error from the last try.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run(command, capture_output=True, text=True,
+                                check=True)
+        best = min(best, time.perf_counter() - start)
+    return best, result.stderr
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the startup of the '
+                                     'headcounts commands')
+    parser.add_argument('--repeat', action='store', type=int, default=5,
+                        help='Number of times to run each command; the '
+                        'best time is reported.')
+    args = parser.parse_args()
+
+    bare, _ = best_wall_time([sys.executable, '-c', 'pass'], args.repeat)
+    print(f'{"python -c pass":<15} {bare * 1000:7.1f} ms')
+    for name in COMMANDS:
+        seconds, stderr = best_wall_time(
+            [sys.executable, str(HEADCOUNTS), '--startup-time', name,
+             '--help'], args.repeat)
+        heavy = stderr.strip().rsplit('heavy modules loaded: ', 1)[-1]
+        print(f'{name:<15} {seconds * 1000:7.1f} ms  '
+              f'(+{(seconds - bare) * 1000:.1f} ms; {heavy})')
@@ -0,0 +1,237 @@
+# Recorded pages from the registration site for the benchmarks, and a
+# small local web server that serves them in place of the site so that
+# the benchmarks need no network.
+#
+# A small fixed set of pages is kept in benchmarks/fixtures/: the subject
+# index, the search results page of one subject with the full 250 rows
+# and 20 course detail pages from it. Every machine then times the same
+# pages, so baselines can be compared. To refresh it from the site, or
+# to record a larger set elsewhere, use
+#
+#   python benchmarks/fixtures.py --year-term 20265 --subjects CSIS \
+#       --detail-pages 20
+#
+# Without --subjects the search results page of every subject is saved.
+
+import sys
+import json
+import hashlib
+import argparse
+import threading
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import http_client  # noqa: E402
+import scrape  # noqa: E402
+
+DEFAULT_FIXTURE_DIR = Path(__file__).resolve().parent / 'fixtures'
+
+# Description of the recorded pages, in the fixture directory.
+INDEX_FILE = 'fixtures.json'
+
+# Default number of course detail pages to record.
+DEFAULT_DETAIL_PAGES = 200
+
+
+def record(year_term, directory=DEFAULT_FIXTURE_DIR, campus_id=72,
+           detail_pages=DEFAULT_DETAIL_PAGES, subjects=None):
+    """
+    Save pages from the registration site for use by the benchmarks.
+
+    The detail pages are spread evenly over the courses of all of the
+    subjects, so they include every kind of detail page the term has.
+
+    Parameters
+    ----------
+    year_term : str
+        A year/term still in the search form.
+    directory : str or Path, optional
+        Where to save the pages.
+    campus_id : int, optional
+        The campus to record.
+    detail_pages : int, optional
+        Number of course detail pages to record.
+    subjects : list of str, optional
+        The subjects whose search results to record. The default is
+        every subject of the term.
+    """
+    directory = Path(directory)
+    (directory / 'search').mkdir(parents=True, exist_ok=True)
+    (directory / 'detail').mkdir(exist_ok=True)
+
+    url_params = dict(year_term=year_term, subject=None, course_id=None,
+                      campus_id=campus_id)
+    index_page = http_client.get(scrape.URL_ROOT.format(**url_params)).text
+    (directory / 'index.html').write_text(index_page, encoding='utf-8')
+
+    if subjects is None:
+        subjects = scrape.get_subject_list(url_params)
+    course_ids = []
+    for subject in subjects:
+        print(f'    Recording {subject}\r', end='', flush=True)
+        params = scrape.source_params(subject, url_params, year_term)
+        page = http_client.get(scrape.SUBJECT_SEARCH_URL.format(**params))
+        (directory / 'search' / f'{subject}.html').write_text(
+            page.text, encoding='utf-8')
+        try:
+            rows = scrape.results_table_rows(page.text)
+        except IndexError:
+            continue
+        course_ids.extend(row['ID #'] for row in rows)
+
+    step = max(1, len(course_ids) // detail_pages)
+    sample = course_ids[::step][:detail_pages]
+    for course_id in sample:
+        print(f'    Recording {course_id}\r', end='', flush=True)
+        params = dict(url_params, course_id=course_id)
+        page = http_client.get(scrape.COURSE_DETAIL_URL.format(**params))
+        (directory / 'detail' / f'{course_id}.html').write_text(
+            page.text, encoding='utf-8')
+
+    index = dict(year_term=year_term, campus_id=campus_id,
+                 subjects=subjects, course_ids=sample)
+    (directory / INDEX_FILE).write_text(json.dumps(index, indent=2))
+    print(f'Recorded {len(subjects)} subjects and {len(sample)} course '
+          f'details in {directory}')
+
+
+def load(directory=DEFAULT_FIXTURE_DIR):
+    """
+    Read recorded pages.
+
+    Returns
+    -------
+    dict
+        The contents of the fixture index, plus ``index_page``, and
+        ``search_pages`` and ``detail_pages``, dicts of page text keyed
+        by subject and course ID.
+    """
+    directory = Path(directory)
+    index_path = directory / INDEX_FILE
+    if not index_path.exists():
+        raise FileNotFoundError('No fixtures in {}; record some with '
+                                'benchmarks/fixtures.py'.format(directory))
+    fixtures = json.loads(index_path.read_text())
+    fixtures['index_page'] = (directory / 'index.html').read_text(
+        encoding='utf-8')
+    fixtures['search_pages'] = {
+        subject: (directory / 'search' / f'{subject}.html').read_text(
+            encoding='utf-8')
+        for subject in fixtures['subjects']
+    }
+    fixtures['detail_pages'] = {
+        course_id: (directory / 'detail' / f'{course_id}.html').read_text(
+            encoding='utf-8')
+        for course_id in fixtures['course_ids']
+    }
+    return fixtures
+
+
+def fingerprint(fixtures):
+    """
+    Return a checksum of the pages in ``fixtures``, to tell whether two
+    runs of the benchmarks used the same pages.
+    """
+    sha256 = hashlib.sha256(fixtures['index_page'].encode('utf-8'))
+    for pages in (fixtures['search_pages'], fixtures['detail_pages']):
+        for key in sorted(pages):
+            sha256.update(key.encode('utf-8'))
+            sha256.update(pages[key].encode('utf-8'))
+    return sha256.hexdigest()
+
+
+class _FixtureHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        fixtures = self.server.fixtures
+        url = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        page = None
+        if url.path.endswith('/basic.html'):
+            page = fixtures['index_page']
+        elif url.path.endswith('/advancedSubmit.html'):
+            page = fixtures['search_pages'].get(query.get('subject'))
+        elif url.path.endswith('/detail.html'):
+            page = fixtures['detail_pages'].get(query.get('courseid'))
+
+        if page is None:
+            self.send_error(404)
+            return
+        body = page.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FixtureServer:
+    """
+    Serve recorded pages on localhost in place of the registration site.
+
+    Use as a context manager; while it is running, ``url_root`` takes
+    the place of ``scrape.URL_COMMON_ROOT``.
+
+    Parameters
+    ----------
+    fixtures : dict
+        Recorded pages, as returned by ``load``.
+    """
+
+    def __init__(self, fixtures):
+        self.fixtures = fixtures
+        self._server = None
+        self._thread = None
+
+    @property
+    def url_root(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/registration/search/'
+
+    def __enter__(self):
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _FixtureHandler)
+        self._server.daemon_threads = True
+        self._server.fixtures = self.fixtures
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Record pages from the '
+                                     'registration site for the benchmarks')
+    parser.add_argument('--year-term', action='store', required=True,
+                        help='Code for year/term, a 5 digit number like '
+                        '20155 (spring of 2015). It must still be in the '
+                        'search form.')
+    parser.add_argument('--campus-id', action='store', type=int, default=72,
+                        help='Two digit code number for the campus.')
+    parser.add_argument('--detail-pages', action='store', type=int,
+                        default=DEFAULT_DETAIL_PAGES,
+                        help='Number of course detail pages to record.')
+    parser.add_argument('--subjects', action='store', nargs='+',
+                        default=None, metavar='SUBJECT',
+                        help='Subjects whose search results to record. The '
+                        'default is every subject of the term.')
+    parser.add_argument('--fixtures', action='store',
+                        default=str(DEFAULT_FIXTURE_DIR),
+                        help='Directory to save the pages in. The default '
+                        'replaces the fixed set kept with the benchmarks.')
+    http_client.add_arguments(parser)
+    args = parser.parse_args()
+
+    http_client.configure_from_args(args)
+    record(args.year_term, directory=args.fixtures,
+           campus_id=args.campus_id, detail_pages=args.detail_pages,
+           subjects=args.subjects)
@@ -0,0 +1,169 @@
+# A dead-letter queue for the work of a run that failed, so that one bad
+# page or a few minutes of outage does not stop the run. The main pass
+# sets failures aside here and carries on at full speed; at the end the
+# failures get a few more tries, spaced out, and whatever is still
+# failing is reported.
+#
+# Each failure is one line of a JSON lines file (dead_letters.jsonl in
+# the results directory of scrape.py): the source (subject, course
+# ID/year_term pair or CID), which try it was, the error and the URL.
+# The body of the page that could not be used, when there is one, is
+# saved in a directory beside the file, named like it without the
+# .jsonl, so it can be looked at later. A source that works on a later
+# try gets a line saying it was recovered.
+
+import json
+import threading
+from pathlib import Path
+
+import requests
+
+import metrics
+
+# Name of the dead-letter file in the results directory of a run.
+DEAD_LETTERS_FILE = 'dead_letters.jsonl'
+
+# Default number of extra passes over the failures at the end of a run,
+# and the wait, in seconds, before the first of them. The wait doubles
+# for each pass after that, to give an overloaded site time to recover.
+DEFAULT_RETRY_PASSES = 2
+DEFAULT_RETRY_DELAY = 30
+
+# The errors that put a source in the dead-letter queue rather than
+# stopping the run: a page without the expected table (IndexError) or
+# values (ValueError, RuntimeError), or a request that still failed
+# after the retries of the HTTP session.
+FAILURES = (IndexError, ValueError, RuntimeError,
+            requests.exceptions.RequestException)
+
+
+def _label(source):
+    # The same as writers.source_label, without loading polars, which
+    # get_cids.py does not otherwise need.
+    if isinstance(source, tuple):
+        return '-'.join(source)
+    return source
+
+
+def keep_page(error, url, content):
+    """
+    Attach the URL and body of the page that caused ``error`` to it, for
+    the dead-letter queue.
+    """
+    error.page_url = url
+    error.page_content = content
+
+
+def _page_of(error):
+    """
+    Return the URL and body of the page behind ``error``, as far as they
+    are known.
+    """
+    url = getattr(error, 'page_url', None)
+    content = getattr(error, 'page_content', None)
+    response = getattr(error, 'response', None)
+    request = getattr(error, 'request', None)
+    if response is not None:
+        url = url or response.url
+        if content is None:
+            content = response.text
+    elif request is not None:
+        url = url or request.url
+    return url, content
+
+
+class DeadLetterQueue:
+    """
+    The failures of a run, kept in a JSON lines file.
+
+    An existing file is read, so a resumed run knows what failed before.
+
+    Parameters
+    ----------
+    path : str or Path
+        The dead-letter file.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.pages_dir = self.path.with_suffix('')
+        self._lock = threading.Lock()
+        # The last entry for each source, in the order they first
+        # failed.
+        self.entries = {}
+        self._count = 0
+        if self.path.exists():
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The run died while writing this line.
+                        break
+                    self.entries[entry['source']] = entry
+                    self._count += 1
+
+    def _append(self, entry):
+        # Call with the lock held.
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+        self.entries[entry['source']] = entry
+        self._count += 1
+
+    def add(self, source, error):
+        """
+        Set aside a source that failed, with the reason and the page
+        that caused it.
+        """
+        label = _label(source)
+        url, content = _page_of(error)
+        with self._lock:
+            previous = self.entries.get(label)
+            attempt = 1 if previous is None else previous['attempt'] + 1
+            page = None
+            if content is not None:
+                self.pages_dir.mkdir(exist_ok=True)
+                page = f'{self._count:05d}-{label}.html'
+                (self.pages_dir / page).write_text(content)
+            self._append(dict(source=label, attempt=attempt,
+                              status='failed',
+                              error=f'{type(error).__name__}: {error}',
+                              url=url, page=page))
+        metrics.increment('dead_letters_total', error=type(error).__name__)
+
+    def resolve(self, source):
+        """
+        Note that a source that failed before has now worked.
+        """
+        label = _label(source)
+        with self._lock:
+            previous = self.entries.get(label)
+            if previous is None or previous['status'] != 'failed':
+                return
+            self._append(dict(previous, status='recovered',
+                              attempt=previous['attempt'] + 1))
+        metrics.increment('dead_letters_recovered_total')
+
+    def failed(self):
+        """
+        Labels of the sources that are still failing, in the order they
+        first failed.
+        """
+        return [label for label, entry in self.entries.items()
+                if entry['status'] == 'failed']
+
+    def report(self):
+        """
+        Return a description of the sources that could not be
+        recovered, one line each, or an empty string if there are none.
+        """
+        lines = []
+        for label in self.failed():
+            entry = self.entries[label]
+            tries = 'try' if entry['attempt'] == 1 else 'tries'
+            line = (f'    {label}: {entry["error"]} '
+                    f'({entry["attempt"]} {tries})')
+            if entry['page']:
+                line += f' (page saved as {self.pages_dir / entry["page"]})'
+            lines.append(line)
+        return '\n'.join(lines)
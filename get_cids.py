@@ -1,57 +1,548 @@
+import csv
 import time
-import datetime
 import argparse
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 
-from astropy.table import Table
+import http_client
+import metrics
+import work_queue
+from dead_letters import (DEAD_LETTERS_FILE, DEFAULT_RETRY_DELAY,
+                          DEFAULT_RETRY_PASSES, FAILURES, DeadLetterQueue)
 
-from scrape import COURSE_DETAIL_URL
+COURSE_DETAIL_URL = 'https://eservices.minnstate.edu/registration/search/detail.html?campusid={campus_id:03}&courseid={course_id}&yrtr={year_term}&rcid={campus_id:04}&localrcid={campus_id:04}&partnered=false&parent=search'
 
-COURSE_DETAIL_URL = 'https://eservices.minnstate.edu/registration/search/detail.html?campusid=072&courseid={course_id}&yrtr={year_term}&rcid=0072&localrcid=0072&partnered=false&parent=search'
+# Text that tells the two kinds of detail page apart. A course ID that
+# does not exist gives an error page, while a real course has the table
+# of class information.
+ERROR_MARKER = b'System Error'
+VALID_MARKER = b'myplantable'
 
+# Number of bytes to read at a time while looking for the markers.
+CHUNK_SIZE = 4096
 
-def class_exists_for_cid(cid, year_term):
-    course_url = COURSE_DETAIL_URL.format(course_id=cid, year_term=year_term)
-    result = requests.get(course_url)
-    return 'System Error' not in result.text
+# Once the answer is known, read the rest of the page anyway if no more
+# than this many bytes are left, so that the connection can be reused
+# instead of being closed.
+DRAIN_LIMIT = 16384
 
+# Default number of CIDs to probe at once.
+DEFAULT_WORKERS = 8
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Discover CID numbers')
+# Settings for incremental discovery from the good CIDs of earlier terms.
+# CIDs used in earlier terms that are no more than MAX_GAP apart are
+# grouped into one range, and each range is widened by PAD on both
+# sides. Past the highest CID found, probing goes on in blocks of
+# EXTEND_BLOCK until STOP_AFTER CIDs in a row have not been found.
+DEFAULT_MAX_GAP = 50
+DEFAULT_PAD = 10
+EXTEND_BLOCK = 50
+DEFAULT_STOP_AFTER = 200
+
+# Default number of CIDs in each unit of work of a sharded run, and the
+# name of the good CID file of each unit.
+DEFAULT_SHARD_SIZE = 250
+SHARD_CIDS_FILE = 'good-cids.csv'
+
+
+def page_is_valid(result):
+    """
+    Read a streamed detail page only until it is clear whether it is an
+    error page or a real course, and return ``True`` for a real course.
+    """
+    keep = max(len(ERROR_MARKER), len(VALID_MARKER)) - 1
+    previous = b''
+    chunks = result.iter_content(CHUNK_SIZE)
+    for chunk in chunks:
+        # Markers can be split across chunks, so search the end of the
+        # previous chunk too.
+        window = previous + chunk
+        if ERROR_MARKER in window:
+            valid = False
+            break
+        if VALID_MARKER in window:
+            valid = True
+            break
+        previous = window[-keep:]
+    else:
+        # Read the whole page without seeing the error.
+        return True
+
+    length = result.headers.get('Content-Length')
+    if length is not None and int(length) - result.raw.tell() <= DRAIN_LIMIT:
+        for _ in chunks:
+            pass
+    return valid
+
+
+def class_exists_for_cid(cid, year_term, campus_id=72):
+    course_url = COURSE_DETAIL_URL.format(course_id=cid, year_term=year_term,
+                                          campus_id=campus_id)
+    result = http_client.get(course_url, kind='cid_probe', stream=True)
+    try:
+        with metrics.timer('parse_seconds', stage='page_is_valid'):
+            return page_is_valid(result)
+    finally:
+        # Closing a partly read response drops its connection; a fully
+        # read one goes back to the pool.
+        result.close()
+
+
+def probe_cid(cid, year_term, campus_id=72):
+    """
+    Return whether the course ID exists, or the error if the site could
+    not be reached even after the retries of the HTTP session.
+    """
+    # Waiting here for the site to come back would hold up the CIDs
+    # after this one, so the error is handed back instead and the CID is
+    # tried again at the end of the run.
+    try:
+        return class_exists_for_cid(cid, year_term, campus_id)
+    except requests.exceptions.RequestException as error:
+        return error
+
+
+def probe_cids(cids, year_term, workers=DEFAULT_WORKERS, dead_letters=None,
+               campus_id=72):
+    """
+    Probe the course IDs of a campus, ``workers`` at a time, and return
+    those that exist, in the order given.
+
+    CIDs that could not be checked are left out and put in
+    ``dead_letters``; without a dead-letter queue the error is raised.
+    """
+    good_cids = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(probe_cid, cids, [year_term] * len(cids),
+                               [campus_id] * len(cids))
+        for cid, exists in zip(cids, results):
+            print(f'    Checking {cid} [{http_client.status()}]\r', end='',
+                  flush=True)
+            if isinstance(exists, Exception):
+                if dead_letters is None:
+                    raise exists
+                dead_letters.add(cid, exists)
+                continue
+            if dead_letters is not None:
+                dead_letters.resolve(cid)
+            if exists:
+                good_cids.append(cid)
+    return good_cids
+
+
+def retry_probes(year_term, dead_letters, workers=DEFAULT_WORKERS,
+                 passes=DEFAULT_RETRY_PASSES, delay=DEFAULT_RETRY_DELAY,
+                 campus_id=72):
+    """
+    Probe the CIDs in the dead-letter queue up to ``passes`` more times,
+    waiting ``delay`` seconds before the first pass and twice as long
+    before each pass after that, and return those found to exist.
+    """
+    good_cids = []
+    for retry_pass in range(1, passes + 1):
+        failed = dead_letters.failed()
+        if not failed:
+            break
+        print(f'Retry pass {retry_pass} of {passes} for {len(failed)} CIDs '
+              f'in {delay:g} s...')
+        time.sleep(delay)
+        good_cids += probe_cids(failed, year_term, workers=workers,
+                                dead_letters=dead_letters,
+                                campus_id=campus_id)
+        delay *= 2
+    return good_cids
+
+
+def read_seed_cids(paths):
+    """
+    Return the set of course IDs, as integers, in the good CID files of
+    earlier terms.
+    """
+    seed_cids = set()
+    for path in paths:
+        with open(path, newline='') as f:
+            seed_cids.update(int(row['ID #']) for row in csv.DictReader(f))
+    return seed_cids
+
+
+def write_good_cids(path, good_cids, year_term):
+    """
+    Write the good CIDs to a new CSV file with the columns "ID #" and
+    "year_term", the input ``scrape.py --cid-list`` expects.
+    """
+    with open(path, 'x', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['ID #', 'year_term'])
+        writer.writerows([cid, year_term] for cid in good_cids)
+
+
+def seed_ranges(seed_cids, max_gap=DEFAULT_MAX_GAP, pad=DEFAULT_PAD):
+    """
+    Group the seed CIDs into ranges where CIDs are dense, leaving out the
+    long runs that were empty in every earlier term.
+
+    Returns a list of ``(first, last)`` pairs, inclusive, in order.
+    """
+    ranges = []
+    for cid in sorted(seed_cids):
+        if ranges and cid - ranges[-1][1] <= max_gap:
+            ranges[-1][1] = cid
+        else:
+            ranges.append([cid, cid])
+    return [(max(1, first - pad), last + pad) for first, last in ranges]
+
+
+def discover_cids(year_term, seed_cids, workers=DEFAULT_WORKERS,
+                  max_gap=DEFAULT_MAX_GAP, stop_after=DEFAULT_STOP_AFTER,
+                  full_sweep=False, dead_letters=None, campus_id=72):
+    """
+    Find the good CIDs for a term starting from where they were in
+    earlier terms.
+
+    The ranges that were dense in earlier terms are probed first. Probing
+    then goes on past the highest CID found until ``stop_after`` CIDs in
+    a row do not exist, so there is no need to guess a maximum CID. With
+    ``full_sweep`` every CID up to the highest one probed that was
+    skipped is checked too, to confirm nothing was missed. CIDs that
+    could not be checked are put in ``dead_letters``.
+
+    Returns
+    -------
+    good_cids : list of str
+        The good CIDs, in order.
+    n_probes : int
+        Number of CIDs that were probed.
+    """
+    probed = set()
+    good = set()
+
+    def probe(cid_numbers):
+        to_probe = [cid for cid in cid_numbers if cid not in probed]
+        probed.update(to_probe)
+        found = probe_cids(['{:06d}'.format(cid) for cid in to_probe],
+                           year_term, workers=workers,
+                           dead_letters=dead_letters, campus_id=campus_id)
+        good.update(int(cid) for cid in found)
+        return found
+
+    for first, last in seed_ranges(seed_cids, max_gap=max_gap):
+        probe(range(first, last + 1))
+
+    # Keep going past the highest CID seen, this term or before, until
+    # there is a long enough run of CIDs that do not exist.
+    highest = max(good | seed_cids, default=0)
+    next_cid = max(probed, default=0) + 1
+    while next_cid - 1 - highest < stop_after:
+        probe(range(next_cid, next_cid + EXTEND_BLOCK))
+        next_cid += EXTEND_BLOCK
+        highest = max(good | {highest})
+
+    if full_sweep:
+        n_before = len(good)
+        probe(range(1, max(probed) + 1))
+        print(f'Full sweep found {len(good) - n_before} CIDs outside '
+              'the probed ranges')
+
+    good_cids = ['{:06d}'.format(cid) for cid in sorted(good)]
+    return good_cids, len(probed)
+
+
+def cids_from_search(year_term, campus_id=72, workers=DEFAULT_WORKERS,
+                     dead_letters=None, retry_passes=0,
+                     retry_delay=DEFAULT_RETRY_DELAY):
+    """
+    Get the good CIDs for a term from the subject search pages, one page
+    per subject, instead of probing every CID.
+
+    Subjects whose search fails are put in ``dead_letters``, and get
+    ``retry_passes`` more tries at the end, as in ``retry_probes``;
+    without a dead-letter queue the error is raised.
+
+    Returns
+    -------
+    list of str or None
+        The good CIDs, in order, or ``None`` if the term is not in the
+        search form any more, in which case probing is the only option.
+    """
+    # scrape.py brings in polars and the HTML parsers, which nothing
+    # else here needs, so only load it when it is used.
+    import scrape
+
+    url_params = dict(year_term=year_term, subject=None, course_id=None,
+                      campus_id=campus_id)
+    subjects = scrape.get_subject_list(url_params)
+    if not subjects:
+        return None
+
+    def subject_cids(subject):
+        print(f'    Checking {subject}\r', end='', flush=True)
+        params = scrape.source_params(subject, url_params, year_term)
+        try:
+            data_df = scrape.class_list_for_subject(params)
+        except FAILURES as error:
+            if dead_letters is None:
+                raise
+            dead_letters.add(subject, error)
+            return []
+        if dead_letters is not None:
+            dead_letters.resolve(subject)
+        if data_df.is_empty():
+            return []
+        return data_df['ID #'].to_list()
+
+    def search(subjects):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            cid_lists = list(executor.map(subject_cids, subjects))
+        return {int(cid) for cid_list in cid_lists for cid in cid_list}
+
+    cids = search(subjects)
+    delay = retry_delay
+    for retry_pass in range(1, retry_passes + 1):
+        failed = dead_letters.failed()
+        if not failed:
+            break
+        print(f'Retry pass {retry_pass} of {retry_passes} for {len(failed)} '
+              f'subjects in {delay:g} s...')
+        time.sleep(delay)
+        cids |= search(failed)
+        delay *= 2
+    return ['{:06d}'.format(cid) for cid in sorted(cids)]
+
+
+def probe_shard(claim, year_term, workers=DEFAULT_WORKERS, retry_passes=0,
+                retry_delay=DEFAULT_RETRY_DELAY, campus_id=72):
+    """
+    Probe the CIDs of one unit of a sharded run and write those that
+    exist to a good CID file in ``claim.shard_dir``. CIDs that could not
+    be checked get ``retry_passes`` more tries, as in ``retry_probes``.
+    """
+    claim.shard_dir.mkdir(parents=True)
+    dead_letters = DeadLetterQueue(claim.shard_dir / DEAD_LETTERS_FILE)
+    good_cids = probe_cids(claim.sources, year_term, workers=workers,
+                           dead_letters=dead_letters, campus_id=campus_id)
+    good_cids = sorted(good_cids + retry_probes(year_term, dead_letters,
+                                                workers=workers,
+                                                passes=retry_passes,
+                                                delay=retry_delay,
+                                                campus_id=campus_id))
+    write_good_cids(claim.shard_dir / SHARD_CIDS_FILE, good_cids, year_term)
+    return dict(good_cids=len(good_cids),
+                failed=len(dead_letters.failed()))
+
+
+def merge_good_cids(queue):
+    """
+    Combine the good CID files of every unit of a sharded run into the
+    usual ``<year_term>-good-cids.csv`` and return a record of the merge.
+    """
+    year_term = queue.settings['year_term']
+    good = set()
+    failed = []
+    for unit, _ in queue.units:
+        shard_dir = queue.shard_dir(unit, queue.done_record(unit)['attempt'])
+        good |= read_seed_cids([shard_dir / SHARD_CIDS_FILE])
+        failed += DeadLetterQueue(shard_dir / DEAD_LETTERS_FILE).failed()
+    good_cids = ['{:06d}'.format(cid) for cid in sorted(good)]
+    path = '{}-good-cids.csv'.format(year_term)
+    if good_cids:
+        write_good_cids(path, good_cids, year_term)
+    return dict(path=path, good_cids=len(good_cids), failed=failed)
+
+
+def probe_sharded(args):
+    """
+    Work on the sharded probe in the queue ``args.shard_queue``, making
+    the queue if this is the first worker, until every CID up to
+    ``args.max_cid`` has been checked, and then merge the good CIDs
+    unless another worker does.
+    """
+    max_cid = int(args.max_cid)
+    settings = dict(year_term=args.year_term, max_cid=max_cid,
+                    campus_id=args.campus_id)
+    queue = work_queue.WorkQueue.open(
+        args.shard_queue, settings,
+        lambda: ['{:06d}'.format(cid) for cid in range(1, max_cid + 1)],
+        args.shard_size, stale_after=args.stale_after)
+    print(f'Working on {queue.path}: {len(queue.unfinished())} of '
+          f'{len(queue.units)} units left.')
+    finished = work_queue.work(queue, partial(probe_shard,
+                                              year_term=args.year_term,
+                                              workers=args.workers,
+                                              retry_passes=args.retry_passes,
+                                              retry_delay=args.retry_delay,
+                                              campus_id=args.campus_id))
+    print(f'Finished {finished} units.')
+
+    record = work_queue.merge_once(queue, merge_good_cids)
+    if record is None:
+        print('Another worker is merging the good CIDs.')
+    else:
+        if record['worker'] != work_queue.worker_name():
+            print(f'Already merged by {record["worker"]}.')
+        print(f'Total of {record["good_cids"]} good CIDs found, in '
+              f'{record["path"]}')
+        if record['failed']:
+            print(f'Could not check {len(record["failed"])} CIDs: '
+                  f'{", ".join(record["failed"])}')
+
+    # Each worker keeps its own metrics, beside the queue.
+    metrics.write(queue.path / f'{work_queue.worker_name()}-'
+                  f'{metrics.JSON_FILE}')
+
+
+def main(argv=None, prog=None):
+    """
+    Find the good course IDs for a year/term and write them out.
+
+    ``argv`` is the list of command line arguments, by default those of
+    the script, and ``prog`` the name to use in the usage message.
+    """
+    parser = argparse.ArgumentParser(prog=prog,
+                                     description='Discover CID numbers')
     parser.add_argument('--year-term', action='store',
                         help='Code for year/term, a 5 digit '
                         'number like 20155 (spring of 2015)')
     parser.add_argument('--max-cid', action='store', default=4000,
                         help='The largest course ID number to look for.')
-    args = parser.parse_args()
+    parser.add_argument('--workers', action='store', type=int,
+                        default=DEFAULT_WORKERS,
+                        help='Number of course ID numbers to check at once.')
+    parser.add_argument('--from-search', action='store_true',
+                        help='Get the CIDs from the subject search pages, '
+                        'which only works for terms still in the search '
+                        'form. For other terms the CIDs are probed.')
+    parser.add_argument('--campus-id', action='store', type=int,
+                        default='72',
+                        help='Two digit code number for the campus whose '
+                        'CIDs are wanted.')
+    parser.add_argument('--seed', action='store', nargs='+', default=None,
+                        metavar='GOOD_CIDS_CSV',
+                        help='Good CID files from earlier terms. The ranges '
+                        'of CIDs used in those terms are checked first, '
+                        'long runs that were always empty are skipped, '
+                        'and --max-cid is not used.')
+    parser.add_argument('--max-gap', action='store', type=int,
+                        default=DEFAULT_MAX_GAP,
+                        help='With --seed, runs of more than this many '
+                        'CIDs that were empty in every earlier term are '
+                        'skipped.')
+    parser.add_argument('--stop-after', action='store', type=int,
+                        default=DEFAULT_STOP_AFTER,
+                        help='With --seed, stop looking once this many CIDs '
+                        'in a row past the highest one found do not exist.')
+    parser.add_argument('--full-sweep', action='store_true',
+                        help='With --seed, afterwards check every CID that '
+                        'was skipped to confirm none were missed.')
+    parser.add_argument('--retry-passes', action='store', type=int,
+                        default=DEFAULT_RETRY_PASSES,
+                        help='Number of extra passes, at the end of the run, '
+                        'over the CIDs that could not be checked.')
+    parser.add_argument('--retry-delay', action='store', type=float,
+                        default=DEFAULT_RETRY_DELAY,
+                        help='Seconds to wait before the first retry pass; '
+                        'the wait doubles for each pass after that.')
+    parser.add_argument('--shard-queue', action='store', metavar='DIR',
+                        help='Share the probing with other processes, on '
+                        'this or other machines, through a queue of work '
+                        'in DIR, which must be on a filesystem they all '
+                        'see. Start every worker with the same options; '
+                        'the last one to finish writes the good CID file. '
+                        'Cannot be used with --seed or --from-search.')
+    parser.add_argument('--shard-size', action='store', type=int,
+                        default=DEFAULT_SHARD_SIZE,
+                        help='Number of CIDs in each unit of work of the '
+                        '--shard-queue.')
+    parser.add_argument('--stale-after', action='store', type=float,
+                        default=work_queue.DEFAULT_STALE_AFTER,
+                        help='Seconds after which the unit of a worker of '
+                        'the --shard-queue that has stopped responding is '
+                        'given to another worker.')
+    parser.add_argument('--prometheus', action='store_true',
+                        help='As well as the metrics JSON file, write the '
+                        'timings and counts for the run in the Prometheus '
+                        'text format.')
+    http_client.add_arguments(parser)
+    args = parser.parse_args(argv)
 
-    year_term = args.year_term
-    max_cid = args.max_cid
+    http_client.configure_from_args(args, concurrency=args.workers)
+    run_start = time.perf_counter()
 
-    overall_table = None
+    if args.shard_queue:
+        if args.seed or args.from_search:
+            raise RuntimeError('--shard-queue only works when probing '
+                               'every CID up to --max-cid')
+        probe_sharded(args)
+        return
 
-    # Generate a date/time to use in naming directory with results
-    now = time.localtime()
-    formatted_datetime = datetime.datetime(*now[:-3]).isoformat()
-    formatted_datetime = formatted_datetime.replace(':', '-')
+    year_term = args.year_term
+    max_cid = args.max_cid
 
-    good_cids = []
     print(f'Working on {year_term}...', flush=True)
-    for cid in range(1, int(max_cid) + 1):
-        cid_str = '{:06d}'.format(cid)
-        print(f'    Checking {cid_str}\r', end='', flush=True)
-        failed = True
-        while failed:
-            try:
-                if class_exists_for_cid(cid_str, year_term):
-                    good_cids.append(cid_str)
-            except requests.exceptions.ConnectionError:
-                pass
-            else:
-                failed = False
+    # CIDs that cannot be checked are set aside, beside the CID file,
+    # and tried again at the end instead of holding up the rest.
+    dead_letters = DeadLetterQueue(f'{year_term}-{DEAD_LETTERS_FILE}')
+    good_cids = None
+    search_dead_letters = None
+    if args.from_search:
+        # Subjects whose search fails have a queue of their own, so that
+        # they are not probed as CIDs.
+        search_dead_letters = DeadLetterQueue(
+            f'{year_term}-search-{DEAD_LETTERS_FILE}')
+        good_cids = cids_from_search(year_term, campus_id=args.campus_id,
+                                     workers=args.workers,
+                                     dead_letters=search_dead_letters,
+                                     retry_passes=args.retry_passes,
+                                     retry_delay=args.retry_delay)
+        if good_cids is None:
+            print(f'{year_term} is not in the search form, probing CIDs '
+                  'instead')
+
+    if good_cids is None and args.seed:
+        seed_cids = read_seed_cids(args.seed)
+        good_cids, n_probes = discover_cids(year_term, seed_cids,
+                                            workers=args.workers,
+                                            max_gap=args.max_gap,
+                                            stop_after=args.stop_after,
+                                            full_sweep=args.full_sweep,
+                                            dead_letters=dead_letters,
+                                            campus_id=args.campus_id)
+        print(f'Checked {n_probes} CIDs')
+    elif good_cids is None:
+        cids = ['{:06d}'.format(cid) for cid in range(1, int(max_cid) + 1)]
+        good_cids = probe_cids(cids, year_term, workers=args.workers,
+                               dead_letters=dead_letters,
+                               campus_id=args.campus_id)
+    good_cids = sorted(good_cids + retry_probes(year_term, dead_letters,
+                                                workers=args.workers,
+                                                passes=args.retry_passes,
+                                                delay=args.retry_delay,
+                                                campus_id=args.campus_id))
     print(f'Total of {len(good_cids)} good CIDs found')
     if good_cids:
-        results = Table(data=[good_cids, [year_term] * len(good_cids)],
-                        names=['ID #', 'year_term'])
-        results.write('{}-good-cids.csv'.format(year_term))
+        write_good_cids('{}-good-cids.csv'.format(year_term), good_cids,
+                        year_term)
+    failed = dead_letters.failed()
+    if failed:
+        print(f'Could not check {len(failed)} CIDs, listed in '
+              f'{dead_letters.path}:')
+        print(dead_letters.report())
+    if search_dead_letters is not None and search_dead_letters.failed():
+        print(f'Could not search {len(search_dead_letters.failed())} '
+              'subjects, so their CIDs are missing; they are listed in '
+              f'{search_dead_letters.path}:')
+        print(search_dead_letters.report())
+
+    # There is no results directory, so the metrics go beside the CID
+    # file.
+    metrics.increment('good_cids_total', len(good_cids))
+    metrics.set_gauge('run_seconds', time.perf_counter() - run_start)
+    prometheus_path = None
+    if args.prometheus:
+        prometheus_path = f'{year_term}-{metrics.PROMETHEUS_FILE}'
+    metrics.write(f'{year_term}-{metrics.JSON_FILE}', prometheus_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# One command line for all of the scripts:
+#
+#   python headcounts.py scrape --year-term 20265
+#   python headcounts.py scrape-system --year-terms 20263 20265
+#   python headcounts.py get-cids --year-term 20265 --from-search
+#   python headcounts.py watch --year-term 20265
+#   python headcounts.py snapshots store add results_v2-*
+#   python headcounts.py query enrollments.sqlite history PHYS 160
+#
+# The module for a subcommand is only imported once that subcommand has
+# been chosen, so, for example, probing CIDs does not pay for loading
+# polars and the HTML parsers. With --startup-time, the time taken to get
+# to the start of the subcommand and the modules loaded on the way are
+# printed.
+
+import time
+
+_START = time.perf_counter()
+
+import sys  # noqa: E402
+import argparse  # noqa: E402
+import importlib  # noqa: E402
+
+# Module and description of each subcommand.
+COMMANDS = {
+    'scrape': ('scrape', 'Scrape one campus, by year/term or from a list '
+               'of course IDs.'),
+    'scrape-system': ('scrape_system', 'Scrape several campuses and '
+                      'year/terms at once.'),
+    'get-cids': ('get_cids', 'Find the good course IDs for a year/term.'),
+    'watch': ('watch', 'Scrape a term and keep polling it for changes.'),
+    'snapshots': ('snapshots', 'Keep many runs of a term as snapshots.'),
+    'query': ('query_store', 'Load runs into an indexed store and query '
+              'it.'),
+}
+
+# Libraries that are slow to import, reported by --startup-time.
+HEAVY_MODULES = ['polars', 'pyarrow', 'numpy', 'lxml', 'bs4', 'astropy',
+                 'requests']
+
+
+def startup_report(module_name, seconds, modules_before):
+    """
+    Return a line saying how long startup took, how many modules were
+    loaded for the subcommand and which of them are slow to import.
+    """
+    loaded = set(sys.modules) - modules_before
+    heavy = [name for name in HEAVY_MODULES if name in sys.modules]
+    return (f'Startup: {seconds * 1000:.1f} ms, {module_name} loaded '
+            f'{len(loaded)} modules; heavy modules loaded: '
+            f'{", ".join(heavy) or "none"}')
+
+
+def main(argv=None):
+    """
+    Run the subcommand named in ``argv``, by default the command line
+    arguments, with the rest of the arguments.
+    """
+    commands = '\n'.join(f'  {name:<15}{description}'
+                          for name, (_, description) in COMMANDS.items())
+    parser = argparse.ArgumentParser(
+        prog='headcounts',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='Scrape enrollment numbers from the MinnState '
+        'registration site.',
+        epilog=f'commands:\n{commands}\n\nRun "headcounts <command> '
+        '--help" for the options of a command.')
+    parser.add_argument('--startup-time', action='store_true',
+                        help='Print how long it took to start the command '
+                        'and which modules were loaded.')
+    parser.add_argument('command', choices=COMMANDS,
+                        help='The command to run.')
+    parser.add_argument('arguments', nargs=argparse.REMAINDER,
+                        help='Options for the command.')
+    args = parser.parse_args(argv)
+
+    module_name = COMMANDS[args.command][0]
+    modules_before = set(sys.modules)
+    module = importlib.import_module(module_name)
+    if args.startup_time:
+        print(startup_report(module_name, time.perf_counter() - _START,
+                             modules_before), file=sys.stderr)
+    module.main(args.arguments, prog=f'headcounts {args.command}')
+
+
+if __name__ == '__main__':
+    main()
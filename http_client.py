@@ -0,0 +1,311 @@
+# A single, shared HTTP session for everything that fetches pages from
+# the MinnState registration site. Using one requests.Session means the
+# TCP/TLS connection to eservices.minnstate.edu is set up once and then
+# reused from a pool, instead of being set up again for every page.
+#
+# Failed requests (connection errors, read errors and the usual
+# "try again later" status codes) are retried with exponential backoff
+# by urllib3 before an exception is ever seen by the caller.
+#
+# Every request also goes through a rate limiter (see rate_limiter.py)
+# that adapts the number of requests in flight to how well the site is
+# coping.
+#
+# The pages fetched can also be kept in an archive (see page_archive.py),
+# and an archive can be replayed: every page is then served from it,
+# and the network is not used at all.
+
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+from rate_limiter import AdaptiveLimiter
+
+# Number of connections kept open to the registration site.
+DEFAULT_POOL_SIZE = 10
+
+# Seconds to wait for a connection or for the next chunk of a response.
+DEFAULT_TIMEOUT = 30
+
+# Number of times a failed request is retried, and the factor for the
+# exponential backoff between attempts, which waits
+# backoff * 2 ** (attempt - 1) seconds.
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF = 0.5
+
+# Longest wait between attempts, in seconds.
+MAX_BACKOFF = 60
+
+# HTTP status codes that are worth trying again.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_session = None
+_limiter = None
+_archive = None
+_replay = None
+_settings = dict(pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF,
+                 concurrency=None, max_rate=None, adaptive=True)
+
+
+def configure(pool_size=None, timeout=None, retries=None, backoff=None,
+              concurrency=None, max_rate=None, adaptive=None):
+    """
+    Set up the shared session and rate limiter. Any setting that is
+    ``None`` keeps its current value. Calling this again replaces the
+    session and the limiter.
+
+    Parameters
+    ----------
+    pool_size : int, optional
+        Number of connections to keep open to each host.
+    timeout : float, optional
+        Connect/read timeout, in seconds, for each request.
+    retries : int, optional
+        Number of times to retry a failed request.
+    backoff : float, optional
+        Backoff factor, in seconds, for the delay between retries.
+    concurrency : int, optional
+        Largest number of requests in flight at once. By default this
+        is the pool size.
+    max_rate : float, optional
+        Largest number of requests to start per second; 0 for no limit.
+    adaptive : bool, optional
+        Whether to adapt the number of requests in flight to the
+        response of the site (see ``rate_limiter.AdaptiveLimiter``).
+
+    Returns
+    -------
+    requests.Session
+        The new shared session.
+    """
+    global _session, _limiter
+
+    new_settings = dict(pool_size=pool_size, timeout=timeout,
+                        retries=retries, backoff=backoff,
+                        concurrency=concurrency, max_rate=max_rate,
+                        adaptive=adaptive)
+    _settings.update({k: v for k, v in new_settings.items()
+                      if v is not None})
+
+    retry = Retry(total=_settings['retries'],
+                  backoff_factor=_settings['backoff'],
+                  backoff_max=MAX_BACKOFF,
+                  status_forcelist=RETRY_STATUSES,
+                  allowed_methods=['GET'],
+                  raise_on_status=False)
+
+    # Block rather than open (and then throw away) extra connections
+    # when every connection in the pool is busy.
+    adapter = HTTPAdapter(pool_connections=_settings['pool_size'],
+                          pool_maxsize=_settings['pool_size'],
+                          pool_block=True,
+                          max_retries=retry)
+
+    if _session is not None:
+        _session.close()
+    _session = requests.Session()
+    _session.mount('https://', adapter)
+    _session.mount('http://', adapter)
+
+    _limiter = AdaptiveLimiter(
+        _settings['concurrency'] or _settings['pool_size'],
+        max_rate=_settings['max_rate'] or None,
+        adaptive=_settings['adaptive'])
+    return _session
+
+
+def get_session():
+    """
+    Return the shared session, creating it with the current settings
+    if necessary.
+    """
+    if _session is None:
+        configure()
+    return _session
+
+
+def get_limiter():
+    """
+    Return the shared rate limiter, creating it and the session with
+    the current settings if necessary.
+    """
+    if _limiter is None:
+        configure()
+    return _limiter
+
+
+def get(url, kind='other', **kwargs):
+    """
+    Fetch ``url`` with the shared session, once the rate limiter allows
+    it. Takes the same keyword arguments as ``requests.get``; the
+    timeout defaults to the configured one.
+
+    ``kind`` names the sort of page being fetched (for example
+    ``'course_detail'``) in the metrics recorded for the request: the
+    time spent waiting on the rate limiter, the response time, and the
+    number of retries and errors.
+
+    The response has one more attribute, ``received``, the time
+    (``time.time()``) at which it arrived. When replaying an archive the
+    response comes from the archive instead, and ``received`` is the
+    time the page was first fetched.
+
+    With ``stream=True`` the body is still to be read when this returns,
+    so the request keeps its place in the rate limiter, and ``received``
+    is not final, until the response is closed: the caller must close
+    it (``response.close()`` or a ``with`` block) once it has read what
+    it needs.
+    """
+    if _replay is not None:
+        with metrics.timer('archive_read_seconds', kind=kind):
+            return _replay.response(url)
+
+    kwargs.setdefault('timeout', _settings['timeout'])
+    session = get_session()
+    limiter = get_limiter()
+    waiting = time.perf_counter()
+    start = limiter.acquire()
+    metrics.observe('rate_limit_wait_seconds',
+                    time.perf_counter() - waiting, kind=kind)
+    ok = False
+    streamed = False
+    try:
+        with metrics.timer('request_seconds', kind=kind):
+            response = session.get(url, **kwargs)
+        response.received = time.time()
+    except requests.exceptions.RequestException as error:
+        metrics.increment('request_errors_total', kind=kind,
+                          error=type(error).__name__)
+        raise
+    else:
+        retries = response.raw.retries
+        if retries is not None and retries.history:
+            metrics.increment('request_retries_total',
+                              len(retries.history), kind=kind)
+        # Still asking us to try again later after all of the retries.
+        ok = response.status_code not in RETRY_STATUSES
+        if not ok:
+            metrics.increment('request_errors_total', kind=kind,
+                              error=f'HTTP {response.status_code}')
+        if _archive is not None:
+            with metrics.timer('archive_write_seconds', kind=kind):
+                _archive.add(url, kind, response)
+        elif kwargs.get('stream'):
+            _release_on_close(response, limiter, start, ok)
+            streamed = True
+        return response
+    finally:
+        if not streamed:
+            limiter.release(start, ok=ok)
+
+
+def _release_on_close(response, limiter, start, ok):
+    """
+    Make closing the streamed ``response`` stamp ``received`` and free
+    its place in ``limiter``, so that both take in the time spent reading
+    the body. Only the first close does this.
+    """
+    close = response.close
+    released = False
+
+    def release_and_close():
+        nonlocal released
+        if not released:
+            released = True
+            response.received = time.time()
+            limiter.release(start, ok=ok)
+        close()
+
+    response.close = release_and_close
+
+
+def archive_to(archive):
+    """
+    Add every page fetched from now on to ``archive``, a
+    ``page_archive.PageArchive`` open for adding pages, or stop adding
+    them if it is ``None``.
+    """
+    global _archive
+    _archive = archive
+
+
+def replay_from(archive):
+    """
+    Serve every page from now on from ``archive``, a
+    ``page_archive.PageArchive`` open for reading, instead of fetching
+    it, or go back to fetching pages if it is ``None``.
+    """
+    global _replay
+    _replay = archive
+
+
+def backoff():
+    """
+    Tell the rate limiter that the site seems to be in trouble, for
+    problems that only the caller can see.
+    """
+    get_limiter().backoff()
+
+
+def status():
+    """
+    Current request rate and concurrency limit, for progress messages.
+    """
+    if _replay is not None:
+        return 'from the archive'
+    return get_limiter().status()
+
+
+def backoff_delay(attempt):
+    """
+    Delay, in seconds, before making attempt number ``attempt`` (counting
+    from 1) at something that has already failed.
+    """
+    return min(_settings['backoff'] * 2 ** (attempt - 1), MAX_BACKOFF)
+
+
+def add_arguments(parser):
+    """
+    Add the command line options for the HTTP session to an
+    ``argparse.ArgumentParser``.
+    """
+    parser.add_argument('--pool-size', action='store', type=int,
+                        default=None,
+                        help='Number of connections to keep open to the '
+                        'registration site (default {}, or the '
+                        'concurrency if that is larger).'
+                        .format(DEFAULT_POOL_SIZE))
+    parser.add_argument('--timeout', action='store', type=float,
+                        default=DEFAULT_TIMEOUT,
+                        help='Seconds to wait on the site before a request '
+                        'is retried.')
+    parser.add_argument('--retries', action='store', type=int,
+                        default=DEFAULT_RETRIES,
+                        help='Number of times a failed request is retried, '
+                        'with exponential backoff, before giving up.')
+    parser.add_argument('--max-rate', action='store', type=float,
+                        default=0,
+                        help='Largest number of requests to start per '
+                        'second. The default, 0, is no limit.')
+    parser.add_argument('--fixed-concurrency', action='store_true',
+                        help='Always keep the full concurrency in flight '
+                        'instead of adapting it to how well the site is '
+                        'responding.')
+
+
+def configure_from_args(args, concurrency=1):
+    """
+    Set up the shared session from parsed command line options (see
+    ``add_arguments``). The pool is made at least as large as
+    ``concurrency`` so that no request waits on a connection, and the
+    rate limiter allows up to ``concurrency`` requests in flight.
+    """
+    pool_size = args.pool_size or max(DEFAULT_POOL_SIZE, concurrency)
+    return configure(pool_size=pool_size, timeout=args.timeout,
+                     retries=args.retries, concurrency=concurrency,
+                     max_rate=args.max_rate,
+                     adaptive=not args.fixed_concurrency)
@@ -0,0 +1,153 @@
+# A journal of the progress of a scrape.py run, so that a run that dies
+# part way through can be picked up again with --resume instead of
+# starting the whole term over.
+#
+# The journal is a JSON lines file in the results directory. The first
+# line holds the settings of the run and the full list of sources
+# (subjects or course ID/year_term pairs). After that there is one line
+# for each source that has been dealt with, added once its rows are
+# safely in the output.
+
+import json
+import os
+from pathlib import Path
+
+from writers import source_label
+
+# Name of the journal file in the results directory.
+JOURNAL_FILE = 'journal.jsonl'
+
+# Status of a source that has been dealt with. A source with no courses
+# is finished too, since there is nothing to fetch for it next time. A
+# source that failed is recorded but will be tried again on resume.
+WRITTEN = 'written'
+EMPTY = 'empty'
+FAILED = 'failed'
+FINISHED = (WRITTEN, EMPTY)
+
+
+class RunJournal:
+    """
+    Append-only record of the sources finished by a run.
+
+    Use ``RunJournal.create`` for a new run and ``RunJournal.load`` to
+    resume one.
+
+    Parameters
+    ----------
+    destination : str or Path
+        The results directory of the run.
+    settings : dict
+        Settings needed to carry on the run (year/term or CID list,
+        campus and output format).
+    source_list : list
+        All of the sources of the run, in order.
+    entries : list of dict, optional
+        Journal lines already recorded for sources.
+    """
+
+    def __init__(self, destination, settings, source_list, entries=None):
+        self.path = Path(destination) / JOURNAL_FILE
+        self.settings = settings
+        self.source_list = source_list
+        self.status = {}
+        for entry in entries or []:
+            self.status[entry['source']] = entry['status']
+
+    @classmethod
+    def create(cls, destination, settings, source_list):
+        """
+        Start the journal for a new run.
+        """
+        journal = cls(destination, settings, source_list)
+        header = dict(settings=settings,
+                      sources=[list(source) if isinstance(source, tuple)
+                               else source for source in source_list])
+        journal._append(header)
+        return journal
+
+    @classmethod
+    def load(cls, destination):
+        """
+        Read the journal of an earlier run in ``destination``.
+        """
+        path = Path(destination) / JOURNAL_FILE
+        if not path.exists():
+            raise FileNotFoundError('No journal to resume from in '
+                                    '{}'.format(destination))
+        lines = []
+        with open(path) as f:
+            for line in f:
+                try:
+                    lines.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # The run died while writing this line.
+                    break
+        header, entries = lines[0], lines[1:]
+        # CID list sources are (course_id, year_term) pairs, which JSON
+        # turns into lists.
+        source_list = [tuple(source) if isinstance(source, list) else source
+                       for source in header['sources']]
+        return cls(destination, header['settings'], source_list, entries)
+
+    def _append(self, entry):
+        # Make sure each line is on disk before carrying on, so the
+        # journal never claims more than has been done.
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def record(self, source, status, rows=0):
+        """
+        Note that a source has been dealt with.
+
+        Parameters
+        ----------
+        source : str or tuple
+            The subject or ``(course_id, year_term)``.
+        status : str
+            One of ``WRITTEN``, ``EMPTY`` or ``FAILED``.
+        rows : int, optional
+            Number of rows written for the source.
+        """
+        label = source_label(source)
+        self._append(dict(source=label, status=status, rows=rows))
+        self.status[label] = status
+
+    def is_finished(self, source):
+        """
+        Whether the source needs no more work.
+        """
+        return self.status.get(source_label(source)) in FINISHED
+
+    def written_sources(self):
+        """
+        Labels of the sources whose rows are in the output.
+        """
+        return {label for label, status in self.status.items()
+                if status == WRITTEN}
+
+    def keep_written(self, labels):
+        """
+        Note that of the sources recorded as written only those in
+        ``labels`` are still in the output, as found by the writer when
+        resuming. The others are recorded as failed, so that they are
+        fetched again.
+
+        Returns
+        -------
+        list of str
+            The labels of the sources that are no longer written.
+        """
+        lost = sorted(self.written_sources() - set(labels))
+        for label in lost:
+            self.record(label, FAILED)
+        return lost
+
+    def remaining(self):
+        """
+        The sources still to be done, in order.
+        """
+        return [source for source in self.source_list
+                if not self.is_finished(source)]
@@ -0,0 +1,192 @@
+# Timing and counts for the stages of a run (fetching, parsing, building
+# tables and writing), so that when a run is slow it is clear where the
+# time went.
+#
+# Everything is recorded in one registry for the process. At the end of
+# a run it is written out as JSON and, optionally, in the Prometheus
+# text format so it can be picked up by the node exporter's textfile
+# collector.
+
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# Upper bounds, in seconds, of the histogram buckets.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+           2.5, 5, 10, 30, 60, float('inf'))
+
+# Names of the metrics files written to the results directory.
+JSON_FILE = 'metrics.json'
+PROMETHEUS_FILE = 'metrics.prom'
+
+# Prefix for the names of the Prometheus metrics.
+PROMETHEUS_PREFIX = 'headcounts_'
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_gauges = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def reset():
+    """
+    Forget everything recorded so far.
+    """
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+        _gauges.clear()
+
+
+def increment(name, amount=1, **labels):
+    """
+    Add ``amount`` to the counter ``name`` with the given labels.
+    """
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def set_gauge(name, value, **labels):
+    """
+    Set the gauge ``name`` with the given labels to ``value``.
+    """
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name, value, **labels):
+    """
+    Add ``value``, usually a time in seconds, to the histogram ``name``
+    with the given labels.
+    """
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = dict(
+                counts=[0] * len(BUCKETS), sum=0.0, count=0)
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram['counts'][i] += 1
+                break
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+@contextmanager
+def timer(name, **labels):
+    """
+    Time the block and add the time to the histogram ``name``.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def _bound_label(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+def to_dict():
+    """
+    Return everything recorded as a dict that can be written as JSON.
+
+    Histograms give the number of observations in each bucket (not
+    cumulative), keyed by the upper bound of the bucket, along with the
+    count, sum and mean.
+    """
+    with _lock:
+        counters = {}
+        for (name, labels), value in sorted(_counters.items()):
+            counters.setdefault(name, []).append(
+                dict(labels=dict(labels), value=value))
+        gauges = {}
+        for (name, labels), value in sorted(_gauges.items()):
+            gauges.setdefault(name, []).append(
+                dict(labels=dict(labels), value=value))
+        histograms = {}
+        for (name, labels), histogram in sorted(_histograms.items()):
+            histograms.setdefault(name, []).append(dict(
+                labels=dict(labels),
+                count=histogram['count'],
+                sum=histogram['sum'],
+                mean=histogram['sum'] / histogram['count'],
+                buckets={_bound_label(bound): n for bound, n
+                         in zip(BUCKETS, histogram['counts'])}))
+    return dict(counters=counters, gauges=gauges, histograms=histograms)
+
+
+def _prometheus_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    inside = ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                      for k, v in labels.items())
+    return '{' + inside + '}'
+
+
+def to_prometheus():
+    """
+    Return everything recorded in the Prometheus text format.
+    """
+    data = to_dict()
+    lines = []
+    for name, series in data['counters'].items():
+        full_name = PROMETHEUS_PREFIX + name
+        lines.append(f'# TYPE {full_name} counter')
+        for s in series:
+            lines.append(f'{full_name}{_prometheus_labels(s["labels"])} '
+                         f'{s["value"]}')
+    for name, series in data['gauges'].items():
+        full_name = PROMETHEUS_PREFIX + name
+        lines.append(f'# TYPE {full_name} gauge')
+        for s in series:
+            lines.append(f'{full_name}{_prometheus_labels(s["labels"])} '
+                         f'{s["value"]}')
+    for name, series in data['histograms'].items():
+        full_name = PROMETHEUS_PREFIX + name
+        lines.append(f'# TYPE {full_name} histogram')
+        for s in series:
+            cumulative = 0
+            for bound, n in s['buckets'].items():
+                cumulative += n
+                labels = _prometheus_labels(s['labels'], le=bound)
+                lines.append(f'{full_name}_bucket{labels} {cumulative}')
+            labels = _prometheus_labels(s['labels'])
+            lines.append(f'{full_name}_sum{labels} {s["sum"]}')
+            lines.append(f'{full_name}_count{labels} {s["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+def write(json_path, prometheus_path=None):
+    """
+    Write everything recorded to ``json_path`` and, if it is given,
+    ``prometheus_path``.
+    """
+    with open(json_path, 'w') as f:
+        json.dump(to_dict(), f, indent=2)
+    if prometheus_path is not None:
+        with open(prometheus_path, 'w') as f:
+            f.write(to_prometheus())
+
+
+def summary():
+    """
+    Return a short text summary of where the time went: the count and
+    mean of each histogram.
+    """
+    lines = []
+    for name, series in to_dict()['histograms'].items():
+        for s in series:
+            labels = ', '.join(f'{k}={v}' for k, v in s['labels'].items())
+            lines.append(f'  {name}[{labels}]: {s["count"]} x '
+                         f'{s["mean"] * 1000:.1f} ms = {s["sum"]:.2f} s')
+    return '\n'.join(lines)
@@ -0,0 +1,178 @@
+# An archive of the raw pages fetched during a run, so that the output
+# can be made again without the site: after the markup of the site
+# changes and the parsing is fixed, when a new column is added, or for
+# terms that are no longer on the site at all.
+#
+# Every page is compressed on its own with zlib and appended to one data
+# file, pages.zz in the results directory of the run, and a line giving
+# its URL, offset and length in the data file is then appended to the
+# index, pages.index.jsonl. Any page can be read back without reading
+# the rest, and a run that dies only loses the page it was writing; a
+# resumed run appends to the same archive. A page fetched more than once
+# (by a retry pass, say) is in the archive each time, and the last copy
+# is the one used.
+#
+# When replaying an archive (see http_client.replay_from) the pages are
+# served from here instead of the network.
+
+import json
+import zlib
+import threading
+from pathlib import Path
+
+import requests
+
+# Names of the data file and its index in the results directory.
+ARCHIVE_FILE = 'pages.zz'
+INDEX_FILE = 'pages.index.jsonl'
+
+# zlib compression level for the pages. The pages are mostly the same
+# markup over and over, so they shrink severalfold without going to the
+# slowest levels.
+COMPRESSION_LEVEL = 6
+
+
+class PageNotArchived(requests.exceptions.RequestException):
+    """
+    A page was asked for while replaying an archive that does not have
+    it. Since the network is never used instead, this counts as a failed
+    request.
+    """
+
+
+def archive_exists(directory):
+    """
+    Whether ``directory`` has an archive of pages in it.
+    """
+    return (Path(directory) / INDEX_FILE).exists()
+
+
+def _read_index(index_path):
+    """
+    Return the index entry of each page in an index file, keyed by URL.
+    """
+    entries = {}
+    with open(index_path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # The run died while writing this line.
+                break
+            entries[entry['url']] = entry
+    return entries
+
+
+class ArchivedResponse:
+    """
+    An archived page, with the parts of ``requests.Response`` that the
+    scraper uses.
+    """
+
+    def __init__(self, url, status_code, content, encoding, received):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.encoding = encoding
+        self.received = received
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding or 'utf-8',
+                                   errors='replace')
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+class PageArchive:
+    """
+    The archive of pages in a results directory, for adding pages or
+    reading them back.
+
+    Parameters
+    ----------
+    directory : str or Path
+        The results directory of the run.
+    mode : str, optional
+        ``'r'`` to read the archive, which must exist, or ``'a'`` to
+        add pages to it, making it if need be.
+    """
+
+    def __init__(self, directory, mode='r'):
+        directory = Path(directory)
+        self.path = directory / ARCHIVE_FILE
+        self.index_path = directory / INDEX_FILE
+        self.mode = mode
+        self._lock = threading.Lock()
+        if mode == 'r':
+            self.entries = _read_index(self.index_path)
+            self._data = open(self.path, 'rb')
+        elif mode == 'a':
+            self.entries = {}
+            self._data = open(self.path, 'ab')
+            self._index = open(self.index_path, 'a')
+        else:
+            raise ValueError(f'Unknown archive mode {mode!r}')
+
+    def close(self):
+        self._data.close()
+        if self.mode == 'a':
+            self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __contains__(self, url):
+        return url in self.entries
+
+    def add(self, url, kind, response):
+        """
+        Add the page ``response`` got from ``url``, which is of the given
+        kind (see ``http_client.get``).
+
+        ``response.content`` is read here, so for a streamed response
+        the whole page is held in memory.
+        """
+        # What requests would use to decode the text, so that the text
+        # read back is the same.
+        encoding = response.encoding or response.apparent_encoding
+        data = zlib.compress(response.content, COMPRESSION_LEVEL)
+        with self._lock:
+            offset = self._data.tell()
+            self._data.write(data)
+            self._data.flush()
+            entry = dict(url=url, kind=kind, offset=offset,
+                         length=len(data), status=response.status_code,
+                         encoding=encoding, received=response.received)
+            # The index line goes in only once the page is written, so
+            # every entry in the index points at a whole page.
+            self._index.write(json.dumps(entry) + '\n')
+            self._index.flush()
+            self.entries[url] = entry
+
+    def response(self, url):
+        """
+        Return the archived page of ``url`` as an ``ArchivedResponse``.
+
+        Raises
+        ------
+        PageNotArchived
+            If the page is not in the archive.
+        """
+        entry = self.entries.get(url)
+        if entry is None:
+            raise PageNotArchived(f'{url} is not in the archive '
+                                  f'{self.path}')
+        with self._lock:
+            self._data.seek(entry['offset'])
+            data = self._data.read(entry['length'])
+        return ArchivedResponse(url, entry['status'], zlib.decompress(data),
+                                entry['encoding'], entry['received'])
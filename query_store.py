@@ -0,0 +1,318 @@
+# An indexed local store of the results of many scrape.py runs, for
+# questions that span runs and terms, such as the enrollment history of a
+# course over the last ten terms or every section an instructor has
+# taught, without reading every all_enrollments.csv in full.
+#
+# The store is one SQLite file. Each run is loaded once, as a snapshot,
+# and loading the same results directories again skips the runs already
+# in the store, so it is cheap to load everything after each new run:
+#
+#   python query_store.py enrollments.sqlite ingest results_v2-* \
+#       */results_v2-*
+#   python query_store.py enrollments.sqlite history PHYS 160
+#   python query_store.py enrollments.sqlite instructor "Smith, J"
+#
+# The rows are in the table "enrollments", with the columns renamed as in
+# COLUMNS so they are easy to use in SQL, and indexed on the course ID,
+# the subject and course number, the instructor, and the year/term and
+# timestamp.
+
+import sqlite3
+import argparse
+from pathlib import Path
+
+import polars as pl
+
+from snapshots import read_results
+from writers import has_output
+
+# Name in the store of each column of all_enrollments.csv.
+COLUMNS = {
+    'ID #': 'course_id',
+    'Subj': 'subject',
+    '#': 'number',
+    'Sec': 'section',
+    'Title': 'title',
+    'Dates': 'dates',
+    'Days': 'days',
+    'Time': 'time',
+    'Size:': 'size',
+    'Enrolled:': 'enrolled',
+    'Cr/Hr': 'credits',
+    'Status': 'status',
+    'Instructor': 'instructor',
+    'Delivery Method': 'delivery_method',
+    'Book Cost': 'book_cost',
+    'Loc': 'location',
+    'LASC/WI': 'lasc_wi',
+    '18online': 'online_18',
+    'Tuition -resident': 'tuition_resident',
+    'Tuition unit': 'tuition_unit',
+    'Tuition -nonresident': 'tuition_nonresident',
+    'Course level': 'course_level',
+    'Approximate Course Fees': 'course_fees',
+    'timestamp': 'timestamp',
+    'year_term': 'year_term',
+}
+
+INTEGER_COLUMNS = ['size', 'enrolled']
+REAL_COLUMNS = ['timestamp']
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS snapshots (
+    snapshot_id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    label TEXT NOT NULL,
+    campus_id INTEGER NOT NULL,
+    rows INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS enrollments (
+    snapshot_id INTEGER NOT NULL REFERENCES snapshots,
+    campus_id INTEGER NOT NULL,
+    {columns}
+);
+CREATE INDEX IF NOT EXISTS enrollments_course_id
+    ON enrollments (course_id);
+CREATE INDEX IF NOT EXISTS enrollments_course
+    ON enrollments (subject, number);
+CREATE INDEX IF NOT EXISTS enrollments_instructor
+    ON enrollments (instructor);
+CREATE INDEX IF NOT EXISTS enrollments_term_time
+    ON enrollments (year_term, timestamp);
+'''.format(columns=',\n    '.join(
+    '{} {}'.format(name, 'INTEGER' if name in INTEGER_COLUMNS
+                   else 'REAL' if name in REAL_COLUMNS else 'TEXT')
+    for name in COLUMNS.values()))
+
+# Columns shown by the queries below.
+SHOWN_COLUMNS = ['year_term', 'campus_id', 'course_id', 'subject', 'number',
+                 'section', 'title', 'instructor', 'enrolled', 'size',
+                 'status', 'timestamp']
+
+
+class QueryStore:
+    """
+    The SQLite store of scrape.py results.
+
+    Parameters
+    ----------
+    path : str or Path
+        The store; it is created if it does not exist.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._db = sqlite3.connect(self.path)
+        self._db.executescript(SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def ingested(self):
+        """
+        Return the set of results directories, as absolute paths, that
+        are already in the store.
+        """
+        return {path for (path,) in
+                self._db.execute('SELECT path FROM snapshots')}
+
+    def ingest(self, results_dir, campus_id=None):
+        """
+        Load the output of one run, unless it is already in the store.
+
+        Parameters
+        ----------
+        results_dir : str or Path
+            The results directory of the run.
+        campus_id : int, optional
+            The campus of the run. By default it is taken from the name
+            of the directory the results directory is in, which is the
+            campus for every campus but MSUM (72); see
+            ``scrape.make_destination``.
+
+        Returns
+        -------
+        int or None
+            The number of rows loaded, or ``None`` if the run was
+            already in the store.
+        """
+        results_dir = Path(results_dir).resolve()
+        if str(results_dir) in self.ingested():
+            return None
+        if campus_id is None:
+            parent = results_dir.parent.name
+            campus_id = int(parent) if parent.isdigit() else 72
+
+        data_df = read_results(results_dir)
+        # Older runs lack some of the columns; they are left empty.
+        data_df = data_df.with_columns([
+            pl.lit(None, dtype=pl.Utf8).alias(col) for col in COLUMNS
+            if col not in data_df.columns
+        ]).rename(COLUMNS).with_columns(
+            pl.col(INTEGER_COLUMNS).cast(pl.Int64, strict=False)
+        )
+        names = ['snapshot_id', 'campus_id'] + list(COLUMNS.values())
+        insert = 'INSERT INTO enrollments ({}) VALUES ({})'.format(
+            ', '.join(names), ', '.join('?' * len(names)))
+
+        # One transaction, so a run is either all in the store or not
+        # in it at all.
+        with self._db:
+            cursor = self._db.execute(
+                'INSERT INTO snapshots (path, label, campus_id, rows) '
+                'VALUES (?, ?, ?, ?)',
+                (str(results_dir), results_dir.name, campus_id,
+                 len(data_df)))
+            snapshot_id = cursor.lastrowid
+            self._db.executemany(
+                insert,
+                ((snapshot_id, campus_id) + row for row in
+                 data_df.select(list(COLUMNS.values())).iter_rows()))
+        return len(data_df)
+
+    def query(self, sql, parameters=()):
+        """
+        Run any SQL query on the store and return the result as a
+        polars DataFrame.
+        """
+        cursor = self._db.execute(sql, parameters)
+        columns = [description[0] for description in cursor.description]
+        return pl.DataFrame(cursor.fetchall(), schema=columns, orient='row',
+                            infer_schema_length=None)
+
+    def _latest(self, where, parameters, terms=None):
+        """
+        The last row seen of each section matching ``where``, in the
+        last ``terms`` year/terms it appears in, or all of them.
+        """
+        term_filter = ''
+        if terms is not None:
+            term_filter = ('AND year_term IN (SELECT DISTINCT year_term '
+                           'FROM enrollments WHERE {} '
+                           'ORDER BY year_term DESC LIMIT ?)'.format(where))
+            parameters = tuple(parameters) * 2 + (terms,)
+        # With MAX() in the select list, SQLite takes the other columns
+        # from the row with the largest timestamp in each group.
+        sql = ('SELECT {}, MAX(timestamp) AS latest FROM enrollments '
+               'WHERE {} {} GROUP BY campus_id, year_term, course_id '
+               'ORDER BY year_term, campus_id, subject, number, section'
+               ).format(', '.join(SHOWN_COLUMNS), where, term_filter)
+        return self.query(sql, parameters).drop('latest')
+
+    def course_history(self, subject, number, terms=None):
+        """
+        Return the final enrollment of every section of a course, by
+        year/term.
+
+        Parameters
+        ----------
+        subject : str
+            The subject, e.g. PHYS.
+        number : str
+            The course number, e.g. 160.
+        terms : int, optional
+            Only include the last this many year/terms the course was
+            offered in.
+        """
+        return self._latest('subject = ? AND number = ?',
+                            (subject, str(number)), terms)
+
+    def instructor_sections(self, instructor, terms=None):
+        """
+        Return every section taught by an instructor, as last seen, by
+        year/term. The instructor must be given exactly as in the
+        results, e.g. "Smith, J".
+        """
+        return self._latest('instructor = ?', (instructor,), terms)
+
+    def course_id_history(self, course_id, year_term):
+        """
+        Return every snapshot of one section in a year/term, to follow
+        its enrollment over the registration period.
+        """
+        return self.query(
+            'SELECT {} FROM enrollments WHERE course_id = ? '
+            'AND year_term = ? ORDER BY timestamp'
+            .format(', '.join(SHOWN_COLUMNS)),
+            ('{:06d}'.format(int(course_id)), str(year_term)))
+
+
+def main(argv=None, prog=None):
+    """
+    Load runs into a query store, or query it.
+
+    ``argv`` is the list of command line arguments, by default those of
+    the script, and ``prog`` the name to use in the usage message.
+    """
+    parser = argparse.ArgumentParser(prog=prog,
+                                     description='Load scrape.py results '
+                                     'into an indexed SQLite store and '
+                                     'query it')
+    parser.add_argument('store', help='The SQLite file of the store.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    ingest_parser = commands.add_parser(
+        'ingest', help='Load results directories not yet in the store.')
+    ingest_parser.add_argument('results_dirs', nargs='+',
+                               help='Results directories of scrape.py runs.')
+    ingest_parser.add_argument('--campus-id', action='store', type=int,
+                               help='Campus of all of the runs, instead of '
+                               'taking it from their paths.')
+
+    history_parser = commands.add_parser(
+        'history', help='Final enrollment of a course in each term.')
+    history_parser.add_argument('subject', help='Subject, e.g. PHYS.')
+    history_parser.add_argument('number', help='Course number, e.g. 160.')
+    history_parser.add_argument('--terms', action='store', type=int,
+                                help='Only the last this many terms.')
+
+    instructor_parser = commands.add_parser(
+        'instructor', help='Every section taught by an instructor.')
+    instructor_parser.add_argument('instructor',
+                                   help='Name as in the results, e.g. '
+                                   '"Smith, J".')
+    instructor_parser.add_argument('--terms', action='store', type=int,
+                                   help='Only the last this many terms.')
+
+    section_parser = commands.add_parser(
+        'section', help='Every snapshot of one section in a term.')
+    section_parser.add_argument('course_id', help='The course ID.')
+    section_parser.add_argument('year_term', help='The year/term.')
+
+    sql_parser = commands.add_parser('sql', help='Run an SQL query.')
+    sql_parser.add_argument('sql', help='The query; the rows are in the '
+                            'table "enrollments".')
+
+    args = parser.parse_args(argv)
+    store = QueryStore(args.store)
+    try:
+        if args.command == 'ingest':
+            for results_dir in args.results_dirs:
+                if not has_output(results_dir):
+                    print(f'{results_dir}: no results, skipped')
+                    continue
+                rows = store.ingest(results_dir, campus_id=args.campus_id)
+                if rows is None:
+                    print(f'{results_dir}: already in the store')
+                else:
+                    print(f'{results_dir}: {rows} rows')
+            return
+
+        if args.command == 'history':
+            result = store.course_history(args.subject, args.number,
+                                          terms=args.terms)
+        elif args.command == 'instructor':
+            result = store.instructor_sections(args.instructor,
+                                               terms=args.terms)
+        elif args.command == 'section':
+            result = store.course_id_history(args.course_id, args.year_term)
+        else:
+            result = store.query(args.sql)
+        with pl.Config(tbl_rows=-1, tbl_cols=-1):
+            print(result)
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+# Keeps the requests to the registration site at the highest rate the
+# site handles well, rather than at a fixed, hand-tuned concurrency.
+#
+# Two limits apply to every request:
+#
+# + A token bucket caps the number of requests started per second, if a
+#   maximum rate is given.
+# + An AIMD (additive increase, multiplicative decrease) controller sets
+#   the number of requests that may be in flight at once. Every healthy
+#   response raises the limit a little, by about one for each round of
+#   requests, up to the maximum. A timeout, a connection error, a
+#   "try again later" status or a response much slower than usual cuts
+#   the limit in half, once for each round of requests.
+
+import time
+import threading
+from collections import deque
+
+# Concurrency limit to start from, so that a run ramps up to the
+# largest concurrency the site can take rather than starting there.
+INITIAL_LIMIT = 4
+
+# Factor the concurrency limit is multiplied by when the site is in
+# trouble.
+DECREASE_FACTOR = 0.5
+
+# Weight of each new response time in the running average of response
+# times, and how slowly the baseline for "usual" response times follows
+# that average when it rises.
+LATENCY_SMOOTHING = 0.2
+BASELINE_DRIFT = 0.01
+
+# Responses this many times slower than the baseline mean the site is
+# struggling.
+LATENCY_THRESHOLD = 2.0
+
+# Period, in seconds, over which the request rate is measured.
+RATE_WINDOW = 10
+
+
+class AdaptiveLimiter:
+    """
+    Thread-safe limit on the rate and concurrency of requests.
+
+    Wrap each request in ``acquire`` and ``release``::
+
+        start = limiter.acquire()
+        try:
+            ...
+        finally:
+            limiter.release(start, ok=...)
+
+    Parameters
+    ----------
+    max_concurrency : int
+        Largest number of requests in flight at once.
+    max_rate : float, optional
+        Largest number of requests to start per second, or ``None`` for
+        no limit.
+    adaptive : bool, optional
+        If ``False`` the concurrency limit stays at ``max_concurrency``.
+    min_concurrency : int, optional
+        Smallest the concurrency limit can become.
+    """
+
+    def __init__(self, max_concurrency, max_rate=None, adaptive=True,
+                 min_concurrency=1):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min(min_concurrency, max_concurrency)
+        self.max_rate = max_rate
+        self.adaptive = adaptive
+        if adaptive:
+            self._limit = float(min(INITIAL_LIMIT, max_concurrency))
+        else:
+            self._limit = float(max_concurrency)
+        self.in_flight = 0
+        self._condition = threading.Condition()
+
+        # Token bucket, allowing bursts of up to one second of requests.
+        self._burst = max(1.0, max_rate or 1.0)
+        self._tokens = self._burst
+        self._refilled = time.monotonic()
+
+        self._latency = None
+        self._baseline = None
+        self._decreased = float('-inf')
+        self._created = time.monotonic()
+        self._finished = deque()
+
+    @property
+    def limit(self):
+        """
+        The current concurrency limit.
+        """
+        return int(self._limit)
+
+    def acquire(self):
+        """
+        Wait until a request may start.
+
+        Returns
+        -------
+        float
+            The start time of the request, to pass to ``release``.
+        """
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._condition.wait()
+            self.in_flight += 1
+        if self.max_rate:
+            self._take_token()
+        return time.monotonic()
+
+    def _take_token(self):
+        while True:
+            with self._condition:
+                now = time.monotonic()
+                self._tokens = min(self._burst,
+                                   self._tokens
+                                   + (now - self._refilled) * self.max_rate)
+                self._refilled = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.max_rate
+            time.sleep(wait)
+
+    def release(self, start, ok=True):
+        """
+        Note that a request has finished.
+
+        Parameters
+        ----------
+        start : float
+            The value returned by ``acquire`` for the request.
+        ok : bool, optional
+            ``False`` if the request failed in a way that suggests the
+            site is overloaded.
+        """
+        now = time.monotonic()
+        with self._condition:
+            self.in_flight -= 1
+            self._finished.append(now)
+            self._forget_finished(now)
+            if ok:
+                self._success(now - start, start)
+            else:
+                self._decrease(start)
+            self._condition.notify_all()
+
+    def backoff(self):
+        """
+        Cut the concurrency limit because of a problem noticed by the
+        caller, such as an error page where one was not expected.
+        """
+        with self._condition:
+            # Treat it as coming from a request that started one
+            # response time ago.
+            self._decrease(time.monotonic() - (self._latency or 0))
+
+    def _success(self, latency, start):
+        if self._latency is None:
+            self._latency = self._baseline = latency
+        else:
+            self._latency += LATENCY_SMOOTHING * (latency - self._latency)
+            self._baseline = min(self._latency,
+                                 self._baseline + BASELINE_DRIFT
+                                 * (self._latency - self._baseline))
+        if self._latency > LATENCY_THRESHOLD * self._baseline:
+            self._decrease(start)
+        elif self.adaptive:
+            # One more for each round of requests at the current limit.
+            self._limit = min(self.max_concurrency,
+                              self._limit + 1 / self._limit)
+
+    def _decrease(self, start):
+        # Requests that were already in flight when the limit was last
+        # cut saw the same trouble, so only cut once for them.
+        if not self.adaptive or start < self._decreased:
+            return
+        self._limit = max(self.min_concurrency,
+                          self._limit * DECREASE_FACTOR)
+        self._decreased = time.monotonic()
+
+    def _forget_finished(self, now):
+        # Only the last RATE_WINDOW seconds count towards the rate, so
+        # older requests need not be kept, however rarely the rate is
+        # asked for.
+        while self._finished and self._finished[0] < now - RATE_WINDOW:
+            self._finished.popleft()
+
+    def requests_per_second(self):
+        """
+        The rate at which requests have finished over the last
+        ``RATE_WINDOW`` seconds.
+        """
+        with self._condition:
+            now = time.monotonic()
+            self._forget_finished(now)
+            period = min(RATE_WINDOW, now - self._created)
+            return len(self._finished) / period if period > 0 else 0.0
+
+    def status(self):
+        """
+        Short description of the current request rate and concurrency
+        limit, for progress messages.
+        """
+        return (f'{self.requests_per_second():.1f} req/s, '
+                f'concurrency {self.limit}')
@@ -8,20 +8,37 @@
 # the old scrape.py, which is why it still uses the same
 # column names and structure.
 
+import os
 import re
 import time
+import asyncio
 import datetime
 import argparse
 from pathlib import Path
+from functools import partial
 from collections import defaultdict
+from urllib.parse import urljoin
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 import requests
-from bs4 import BeautifulSoup
 import lxml.html
-import numpy as np
+import lxml.etree
 
 import polars as pl
 
+import http_client
+import metrics
+import work_queue
+from dead_letters import (DEAD_LETTERS_FILE, DEFAULT_RETRY_DELAY,
+                          DEFAULT_RETRY_PASSES, FAILURES, DeadLetterQueue,
+                          keep_page)
+from page_archive import PageArchive, archive_exists
+from static_cache import (DEFAULT_MAX_AGE, StaticAttributeCache,
+                          row_signature)
+from writers import (OUTPUT_FORMATS, open_writer, read_batches, source_label,
+                     sources_name)
+from journal import RunJournal, WRITTEN, EMPTY, FAILED
+
 # The URLs below have a few parameters that need to be substituted to
 # make them useful. Those parameters are:
 #
@@ -109,6 +126,28 @@ DESTINATION_DIR_BASE = 'results_v2'
 # Name of symlink to create to most recent scrape
 LATEST = 'latest'
 
+# Number of rows on a full page of search results; it is the
+# resultNumber in SUBJECT_SEARCH_URL.
+SEARCH_PAGE_SIZE = 250
+
+# Text, in lower case, of the link to the next page of search results.
+NEXT_PAGE_TEXTS = ('next', 'next >', 'next page', '>', '>>', '\u00bb')
+
+# Number of bytes of a page to parse at a time when parsing pages as
+# they arrive.
+STREAM_CHUNK_SIZE = 16384
+
+# Default number of page requests allowed in flight at once.
+DEFAULT_CONCURRENCY = 8
+
+# Default largest number of fetched pages waiting for a parser when
+# parsing in a separate pool of processes.
+DEFAULT_PARSE_QUEUE_SIZE = 64
+
+# Default number of subjects, or course IDs, in each unit of work of a
+# sharded run.
+DEFAULT_SHARD_SIZE = 10
+
 
 def get_subject_list(params):
     """
@@ -131,8 +170,12 @@ def get_subject_list(params):
     list
         List of course rubrics as strings.
     """
+    # BeautifulSoup is slow to import and only needed here, so it is not
+    # loaded by runs that work from a list of course IDs.
+    from bs4 import BeautifulSoup
+
     # print(URL_ROOT.format(**params))
-    result = requests.get(URL_ROOT.format(**params))
+    result = http_client.get(URL_ROOT.format(**params), kind='subject_index')
     soup = BeautifulSoup(result.text, "lxml")
     select_box = soup.find('select', id='subject')
     subjects = select_box.find_all('option', class_=params['year_term'])
@@ -194,7 +237,7 @@ def get_location(loc):
     return '\n'.join(locations)
 
 
-def scrape_class_data_from_results_table(page_content, page_type='search'):
+def results_table_rows(page_content, page_type='search'):
     """
     Given the html content of either a course search result page or
     an individual course page, scrape the useful data from the table.
@@ -206,16 +249,49 @@ def scrape_class_data_from_results_table(page_content, page_type='search'):
     page_type : str, optional
         The type of page to scrape. Either 'search' for a course
         search results page, or 'detail' for an individual course
-        detail page. Defaults to 'search'
-        '.
+        detail page. Defaults to 'search'.
+
     Returns
     -------
-    polars DataFrame
-        A DataFrame with one row for each course, and one column for
-        each column in the search results table.
+    list of dict
+        One dict for each course, whose keys are the column names of
+        the table, in order, and whose values are the table entries.
+    """
+    return _table_rows(lxml.html.fromstring(page_content), page_type)
+
+
+def results_page(page_content, page_url, page_type='search'):
+    """
+    Like ``results_table_rows``, but also return the URL of the next
+    page of search results, if there is one.
+
+    Parameters
+    ----------
+    page_content : str
+        The HTML content of the page to scrape.
+    page_url : str
+        The URL of the page, which links to the next page are relative
+        to.
+    page_type : str, optional
+        Either 'search' or 'detail'; detail pages never have a next
+        page.
+
+    Returns
+    -------
+    rows : list of dict
+        The rows of the table, as returned by ``results_table_rows``.
+    next_url : str or None
+        The URL of the next page of results.
     """
     lxml_parsed = lxml.html.fromstring(page_content)
+    rows = _table_rows(lxml_parsed, page_type)
+    next_url = None
+    if page_type == 'search':
+        next_url = _next_page_url(lxml_parsed, page_url)
+    return rows, next_url
+
 
+def _table_rows(lxml_parsed, page_type):
     # Grab the table of results...
     if page_type == 'search':
         results = lxml_parsed.findall(".//table[@id='resultsTable']")[0]
@@ -234,11 +310,7 @@ def scrape_class_data_from_results_table(page_content, page_type='search'):
     # ...and finally grab all of the rows in the table.
     hrows = results.findall('.//tbody/tr')
 
-    # Not clear why data is created and appended to, since it is not
-    # actually used for anything.
-    data = []
-
-    # Append the data for each row to the table (likely also slow)
+    rows = []
     for row in hrows:
         cols = row.findall('td')
         # Skip the first column, which is a set of buttons for user
@@ -248,30 +320,313 @@ def scrape_class_data_from_results_table(page_content, page_type='search'):
         # Last column is location
         loc = cols[-1]
         dat.append(get_location(loc))
-        data.append(dat)
+        rows.append(dict(zip(header_list, dat)))
+
+    return rows
+
+
+def _next_page_url(lxml_parsed, page_url):
+    """
+    Return the absolute URL the "next page" link of a page of search
+    results points to, or ``None`` if there is no such link.
+    """
+    for link in lxml_parsed.iter('a'):
+        if _is_next_link(link):
+            return urljoin(page_url, link.get('href'))
+    return None
+
+
+def _is_next_link(link):
+    href = link.get('href')
+    if not href or href.startswith(('#', 'javascript:')):
+        return False
+    return (link.get('rel') == 'next'
+            or decrap_item(link.text_content()).lower() in NEXT_PAGE_TEXTS)
+
+
+class ResultsTableStream:
+    """
+    Incremental parser for a page of search results, for use while the
+    page is still arriving.
+
+    Feed it the body of the page a chunk at a time; each call hands
+    back the rows of the results table that were completed by that
+    chunk, the same as ``results_table_rows`` would give for them, and
+    frees the parsed rows. Only one row of the table is ever held in
+    memory, however long the page is.
+
+    Parameters
+    ----------
+    page_url : str, optional
+        The URL of the page, which links to the next page are relative
+        to.
+    page_type : str, optional
+        Either 'search' or 'detail'; see ``results_table_rows``.
+    encoding : str, optional
+        Encoding of the chunks, if known.
+    """
+
+    def __init__(self, page_url='', page_type='search', encoding=None):
+        self.page_url = page_url
+        self.page_type = page_type
+        self.header_list = []
+        self.next_url = None
+        self.found_table = False
+        # How deep in tables inside the results table the parser is;
+        # zero when it is outside of the results table.
+        self._depth = 0
+        self._root = None
+        self._parser = lxml.etree.HTMLPullParser(
+            events=('start', 'end'), tag=('table', 'th', 'tr', 'a'),
+            encoding=encoding)
+        # Make HtmlElements, as lxml.html.fromstring does.
+        self._parser.set_element_class_lookup(
+            lxml.html.HtmlElementClassLookup())
+
+    def _is_results_table(self, table):
+        if self.page_type == 'search':
+            return table.get('id') == 'resultsTable'
+        return table.get('class') == 'myplantable'
+
+    def feed(self, chunk):
+        """
+        Parse the next chunk of the page and return the rows it
+        completed.
+        """
+        self._parser.feed(chunk)
+        return self._rows()
+
+    def close(self):
+        """
+        Finish parsing the page and return the last rows.
+
+        Raises ``IndexError``, as ``results_table_rows`` does, if the
+        page has no results table.
+        """
+        self._root = self._parser.close()
+        rows = self._rows()
+        if not self.found_table:
+            raise IndexError('No results table in page')
+        return rows
 
-    # Yay stackoverflow: https://stackoverflow.com/a/6473724/3486425
-    data = list(map(list, zip(*data)))
+    def parsed_page(self):
+        """
+        Return the page parsed so far, as HTML, for the dead-letter
+        queue, or ``None`` if there is nothing to return.
+
+        Only the rows of the results table are freed as they are
+        parsed, so a page without one is returned whole.
+        """
+        if self._root is None:
+            try:
+                self._root = self._parser.close()
+            except lxml.etree.XMLSyntaxError:
+                return None
+        return lxml.html.tostring(self._root, encoding='unicode')
+
+    def _rows(self):
+        rows = []
+        for event, element in self._parser.read_events():
+            tag = element.tag
+            if event == 'start':
+                # Only the first results table counts, like the
+                # [0] in results_table_rows.
+                if tag == 'table' and (self._depth or (
+                        not self.found_table
+                        and self._is_results_table(element))):
+                    self.found_table = True
+                    self._depth += 1
+                continue
 
-    if not data:
+            if tag == 'a':
+                if (self.next_url is None and self.page_type == 'search'
+                        and _is_next_link(element)):
+                    self.next_url = urljoin(self.page_url,
+                                            element.get('href'))
+            elif not self._depth:
+                continue
+            elif tag == 'table':
+                self._depth -= 1
+            elif tag == 'th':
+                self.header_list.append(decrap_item(element.text_content()))
+            elif (tag == 'tr' and self._depth == 1
+                  and element.getparent().tag == 'tbody'):
+                # Rows of tables inside the results table are left as
+                # part of the text of the row they are in.
+                cols = element.findall('td')
+                dat = [decrap_item(c.text_content()) for c in cols[1:-1]]
+                dat.append(get_location(cols[-1]))
+                rows.append(dict(zip(self.header_list, dat)))
+                # Done with this row, and with the rows before it.
+                element.clear()
+                parent = element.getparent()
+                while element.getprevious() is not None:
+                    del parent[0]
+        return rows
+
+
+def stream_results_page(page_url, kind='subject_search', page_type='search'):
+    """
+    Fetch a page of search results and parse it as it arrives, so that
+    picking out the rows overlaps with the download.
+
+    Returns
+    -------
+    rows : list of dict
+        The rows of the table, as returned by ``results_table_rows``.
+    next_url : str or None
+        The URL of the next page of results.
+    """
+    result = http_client.get(page_url, kind=kind, stream=True)
+    try:
+        table = ResultsTableStream(page_url, page_type,
+                                   encoding=result.encoding)
+        rows = []
+        parse_time = 0
+        for chunk in result.iter_content(STREAM_CHUNK_SIZE):
+            start = time.perf_counter()
+            rows.extend(table.feed(chunk))
+            parse_time += time.perf_counter() - start
+        start = time.perf_counter()
+        rows.extend(table.close())
+        parse_time += time.perf_counter() - start
+    except FAILURES as error:
+        keep_page(error, page_url, table.parsed_page())
+        raise
+    finally:
+        result.close()
+    metrics.observe('parse_seconds', parse_time,
+                    stage='stream_results_page')
+    return rows, table.next_url
+
+
+def _add_search_page(rows, page_rows, next_url, seen, list_url):
+    """
+    Add a page of search results to ``rows`` and return the URL of the
+    next page to fetch, or ``None`` once every page has been fetched.
+
+    ``seen`` is the set of URLs fetched so far. Paging stops if the
+    site hands back a page that has already been fetched, or whose
+    classes are all already in ``rows``, so a site that ignores the
+    page number cannot send this round in circles.
+    """
+    ids = {row['ID #'] for row in rows}
+    if rows and page_rows and all(row['ID #'] in ids for row in page_rows):
+        return None
+    rows.extend(page_rows)
+
+    if next_url is None:
+        if len(page_rows) >= SEARCH_PAGE_SIZE:
+            # There is no way to tell whether the site simply stopped
+            # here, so say so rather than quietly dropping classes.
+            metrics.increment('truncated_searches_total')
+            print(f'\nWarning: the last page of search results from '
+                  f'{list_url} is full but has no link to a next page; '
+                  'some classes may be missing.')
+        return None
+    if next_url in seen:
+        return None
+    seen.add(next_url)
+    return next_url
+
+
+def search_result_rows(list_url, kind='subject_search', stream=False):
+    """
+    Fetch a page of search results and every page after it, following
+    the "next page" links, and return the rows from all of them.
+
+    Parameters
+    ----------
+    list_url : str
+        URL of the first page of results.
+    kind : str, optional
+        Kind of request, for the metrics; see ``http_client.get``.
+    stream : bool, optional
+        If ``True`` parse each page as it arrives; see
+        ``stream_results_page``.
+
+    Returns
+    -------
+    list of dict
+        One dict for each course, as returned by
+        ``results_table_rows``.
+    """
+    rows = []
+    url = list_url
+    seen = {url}
+    while url is not None:
+        if stream:
+            page_rows, next_url = stream_results_page(url, kind)
+        else:
+            result = http_client.get(url, kind=kind)
+            try:
+                with metrics.timer('parse_seconds', stage='results_page'):
+                    page_rows, next_url = results_page(result.text, url)
+            except IndexError as error:
+                keep_page(error, url, result.text)
+                raise
+        url = _add_search_page(rows, page_rows, next_url, seen, list_url)
+    return rows
+
+
+def rows_to_frame(rows):
+    """
+    Make a DataFrame, with every column a string, from the rows
+    returned by ``results_table_rows``.
+
+    Parameters
+    ----------
+    rows : list of dict
+        One dict for each course.
+
+    Returns
+    -------
+    polars DataFrame
+        A DataFrame with one row for each course, and one column for
+        each column in the search results table.
+    """
+    if not rows:
         # So apparently a subject which has no courses can be listed...
         return pl.DataFrame()  # Return an empty DataFrame
 
-    # At this point headers is a list of column names and data is
-    # a list of lists, where each inner list is the data for one
-    # column. So we can create a table with the headers as column names
-    # and the data as the column data.
-
     # Create a polars DataFrame from the data and headers, all the
     # columns are strings, so we can use pl.Utf8 as the dtype.
     headcounts_df = pl.DataFrame(
-        {colname: pl.Series(name=colname, values=coldata, dtype=pl.Utf8)
-         for colname, coldata in zip(header_list, data)}
+        {colname: pl.Series(name=colname,
+                            values=[row[colname] for row in rows],
+                            dtype=pl.Utf8)
+         for colname in rows[0]}
     )
     return headcounts_df
 
 
-def class_list_for_subject(params):
+def scrape_class_data_from_results_table(page_content, page_type='search'):
+    """
+    Given the html content of either a course search result page or
+    an individual course page, scrape the useful data from the table.
+
+    Parameters
+    ----------
+    page_content : str
+        The HTML content of the page to scrape.
+    page_type : str, optional
+        The type of page to scrape. Either 'search' for a course
+        search results page, or 'detail' for an individual course
+        detail page. Defaults to 'search'.
+
+    Returns
+    -------
+    polars DataFrame
+        A DataFrame with one row for each course, and one column for
+        each column in the search results table.
+    """
+    with metrics.timer('parse_seconds', stage='results_table_rows'):
+        rows = results_table_rows(page_content, page_type)
+    with metrics.timer('build_seconds', stage='rows_to_frame'):
+        return rows_to_frame(rows)
+
+
+def class_list_for_subject(params, stream=False):
     """
     Return a table with one row for each class offered in a subject (aka
     course rubric).
@@ -290,6 +645,9 @@ def class_list_for_subject(params):
         The year/term in "fiscal year" notation. See the documentation
         for ``get_subject_list`` for a description of that notation.
 
+    stream : bool, optional
+        If ``True`` parse the search results as they arrive.
+
     Returns
     -------
 
@@ -298,12 +656,69 @@ def class_list_for_subject(params):
         results in which each row is one course.
     """
 
-    # Get and parse the course list for this subject
+    # Get and parse the course list for this subject, every page of it
     list_url = SUBJECT_SEARCH_URL.format(**params)
-    result = requests.get(list_url)
+    rows = search_result_rows(list_url, stream=stream)
 
-    # Convert the result text to a DataFrame
-    return scrape_class_data_from_results_table(result.text)
+    # Convert the rows to a DataFrame
+    with metrics.timer('build_seconds', stage='rows_to_frame'):
+        return rows_to_frame(rows)
+
+
+def class_lists_for_term(params, stream=False):
+    """
+    Return the class list of every subject in a year/term, from one
+    search across all subjects rather than one search per subject.
+
+    All of the pages of results are fetched, so this takes a handful of
+    requests for a whole term.
+
+    Parameters
+    ----------
+    params : dict
+        Dictionary of parameters for substitution in URLs; the subject
+        is ignored.
+    stream : bool, optional
+        If ``True`` parse the search results as they arrive.
+
+    Returns
+    -------
+    dict
+        The class list of each subject that has classes, as returned by
+        ``class_list_for_subject``, keyed by subject.
+
+    Raises
+    ------
+    IndexError
+        If the search found no classes at all, which means the site did
+        not do the search rather than that the term has no classes.
+    """
+    list_url = SUBJECT_SEARCH_URL.format(**dict(params, subject=''))
+    rows = search_result_rows(list_url, kind='term_search', stream=stream)
+    if not rows:
+        raise IndexError(f'The search across all subjects at {list_url} '
+                         'found no classes')
+
+    by_subject = defaultdict(list)
+    for row in rows:
+        by_subject[row['Subj']].append(row)
+    with metrics.timer('build_seconds', stage='rows_to_frame'):
+        return {subject: rows_to_frame(subject_rows)
+                for subject, subject_rows in by_subject.items()}
+
+
+def _listed_classes(class_lists, params, stream=False):
+    """
+    Class list function for subjects whose class lists have already
+    been fetched by ``class_lists_for_term``.
+
+    A subject that is not in ``class_lists`` is searched on its own,
+    since the search across all subjects may have been cut short; only
+    its own search can say that it has no classes.
+    """
+    if params['subject'] in class_lists:
+        return class_lists[params['subject']]
+    return class_list_for_subject(params, stream=stream)
 
 
 def class_list_for_cid(params):
@@ -328,76 +743,156 @@ def class_list_for_cid(params):
     """
 
     course_url = COURSE_DETAIL_URL.format(**params)
-    result = requests.get(course_url)
+    result = http_client.get(course_url, kind='course_detail')
 
     # Convert the result text to a DataFrame
-    return scrape_class_data_from_results_table(result.text,
-                                                page_type='detail')
+    try:
+        return scrape_class_data_from_results_table(result.text,
+                                                    page_type='detail')
+    except FAILURES as error:
+        keep_page(error, course_url, result.text)
+        raise
+
+
+# Text that marks an error page and that marks an 18 On-Line course.
+SYSTEM_ERROR = 'System Error'
+ONLINE_18_MARKER = '18 On-Line'
 
+# Course level is the word after the "Course Level" heading. Any number of
+# things can follow it.
+COURSE_LEVEL_PATTERN = re.compile(r'Course Level\s+(\w+)\s+(Description|General/Liberal|Lectures/Labs|Corequisites|Add To Wait List|Minnesota Transfer Curriculum Goal|Non-Course Prerequisites)')
 
-def course_detail(params):
+
+def _first_text_owner_of_tail(node):
     """
-    Parse enrollment size information from detail page for a course.
+    Return the parent of ``node`` if the tail of ``node`` is the first
+    text node of the parent, otherwise ``None``.
+    """
+    owner = node.getparent()
+    if owner is None or owner.text is not None:
+        return None
+    for sibling in node.itersiblings(preceding=True):
+        if sibling.tail is not None:
+            return None
+    return owner
 
-    Note that a failed search for a course gives a result whose values are
-    -1, but no exception is raised.
+
+def _first_key_elements(root, keys):
+    """
+    Find for each key the first element whose first text node contains
+    it, i.e. the first match of the XPath ``.//*[contains(text(), $key)]``,
+    in one pass over the tree for all of the keys.
 
     Parameters
     ----------
-
-    cid : str
-        Course ID number, with leading zeros to pad it to six digits.
+    root : lxml.html.HtmlElement
+        Root of the parsed page.
+    keys : list of str
+        The text to look for.
 
     Returns
     -------
-
     dict
-        A dict whose keys are the sizes in SIZE_KEYS and whose values are
-        either the enrollment number, if the course lookup is successful,
-        or **-1 if the course lookup fails**.
+        Maps each key that was found to the matching element.
     """
-
-    def parse_size_cap(element):
-        """
-        Handle extracting the actual size from the matched element in the XML
-        tree.
-        """
+    found = {}
+
+    def add(key, element, from_tail):
+        if key not in found:
+            found[key] = element
+        elif from_tail and any(ancestor is element
+                               for ancestor in found[key].iterancestors()):
+            # The tail of a child is reached after the text of the
+            # descendants of earlier children, but its element comes
+            # before them.
+            found[key] = element
+
+    for node in root.iter():
+        if node is root:
+            continue
+        text = node.text
+        if text is not None:
+            for key in keys:
+                # The text of a comment is not a text node.
+                if key in text and isinstance(node.tag, str):
+                    add(key, node, False)
+        tail = node.tail
+        if tail is not None:
+            for key in keys:
+                if key in tail:
+                    owner = _first_text_owner_of_tail(node)
+                    if owner is not None and owner is not root:
+                        add(key, owner, True)
+    return found
+
+
+def _value_after_key(elements, key):
+    """
+    Return the text after the colon following ``key``, or an empty
+    string if the key was not found.
+    """
+    try:
+        # The value follows the key in the text of the parent element.
+        element = elements[key]
         return element.getparent().text_content().split(':')[1].strip()
+    except (KeyError, IndexError):
+        return ''
 
-    # Get and parse the course detail page.
-    course_url = COURSE_DETAIL_URL.format(**params)
-    result = requests.get(course_url)
-    lxml_parsed = lxml.html.fromstring(result.text)
 
+def parse_course_detail(page_content, course_url='', static=None):
+    """
+    Extract the enrollment, tuition, LASC and course level information
+    from the HTML of a course detail page.
+
+    The parsed page is walked once to find all of the enrollment and
+    tuition values, instead of being searched once for each of them.
+
+    Parameters
+    ----------
+    page_content : str
+        HTML of the course detail page.
+    course_url : str, optional
+        URL the page came from, used in messages.
+    static : dict, optional
+        The values of everything but the enrollment (see
+        ``static_cache``). If given, only the enrollment is taken from
+        the page.
+
+    Returns
+    -------
+    dict
+        See ``course_detail``.
+    """
     # Check for an error in the page text, and return sizes of -1 to indicate
     # error.
-    if 'System Error' in result.text:
-        print("Errored on {}".format(params['course_id']))
-        print("URL: ", course_url)
+    if SYSTEM_ERROR in page_content:
         return {k: -1 for k in SIZE_KEYS}
 
-    if TUITION_PER_CREDIT_KEYS[0] in result.text:
+    lxml_parsed = lxml.html.fromstring(page_content)
+
+    if static is not None:
+        elements = _first_key_elements(lxml_parsed, SIZE_KEYS)
+        to_get = {key: int(_value_after_key(elements, key))
+                  for key in SIZE_KEYS}
+        to_get.update(static)
+        return to_get
+
+    if TUITION_PER_CREDIT_KEYS[0] in page_content:
         tuition_keys = TUITION_PER_CREDIT_KEYS
         tuition_unit = 'credit'
     else:
-        # if TUITION_COURSE_KEYS[0] in result.text:
         tuition_keys = TUITION_COURSE_KEYS
         tuition_unit = 'course'
 
     lasc_areas = [lasc_area_label(area) for area in LASC_AREAS
-                  if area in result.text]
+                  if area in page_content]
 
-    # Define an xpath expression to the class sizes. The value $key
-    # will be filled in below with one of the SIZE_KEYS.
-    xpath_expr = './/*[contains(text(), $key)]'
-    to_get = {}
+    keys = SIZE_KEYS + tuition_keys
+    elements = _first_key_elements(lxml_parsed, keys)
 
-    for key in SIZE_KEYS + tuition_keys:
-        foo = lxml_parsed.xpath(xpath_expr, key=key)
-        try:
-            value = parse_size_cap(foo[0])
-        except IndexError:
-            value = ''
+    to_get = {}
+    for key in keys:
+        value = _value_after_key(elements, key)
         # Make the sizes integers
         if key in SIZE_KEYS:
             value = int(value)
@@ -414,19 +909,20 @@ def course_detail(params):
     # Add a couple last things to the results...
     to_get[TUITION_UNIT] = tuition_unit
     to_get[LASC_WI] = ','.join(lasc_areas)
-    to_get[ONLINE_18] = '18 On-Line' in result.text
+    to_get[ONLINE_18] = ONLINE_18_MARKER in page_content
 
-    # So....how do you get free floating text in a web page out of that page?
-    # Any suggestions, MnSCU? Didn't think so. How about a regex for what
-    # we need, which is sandwiched between two divs that contain text that is
-    # easy to find? Note the actual text is not in any element, not even a <p>.
+    # The course level is free floating text, not in any element, between
+    # two divs that contain text that is easy to find. If it appears more
+    # than once, use the last match on the line of the first match, which
+    # is what a search for '.*Course Level...' would find, without that
+    # search's backtracking over every long line of the page.
     all_the_text = lxml_parsed.text_content()
-    matches = re.search(r'.*Course Level\s+(\w+)\s+(Description|General/Liberal|Lectures/Labs|Corequisites|Add To Wait List|Minnesota Transfer Curriculum Goal|Non-Course Prerequisites)',
-                        all_the_text)
-
-    # Oh ha, ha, turns out any number of things can follow Course Level.
+    matches = list(COURSE_LEVEL_PATTERN.finditer(all_the_text))
     if matches:
-        to_get[COURSE_LEVEL] = matches.groups(1)[0]
+        line_end = all_the_text.find('\n', matches[0].start())
+        if line_end >= 0:
+            matches = [m for m in matches if m.start() < line_end]
+        to_get[COURSE_LEVEL] = matches[-1].group(1)
     else:
         to_get[COURSE_LEVEL] = 'Unknown'
         raise RuntimeError('Failed to find "Course Level" '
@@ -435,73 +931,475 @@ def course_detail(params):
     return to_get
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Scrape enrollment numbers '
-                                     'from public MnSCU search site')
-    parser.add_argument('--year-term', action='store',
-                        help='Code for year/term, a 5 digit '
-                        'number like 20155 (spring of 2015)')
-    parser.add_argument('--cid-list', action='store',
-                        help='CSV that has at least two columns, "ID #", a '
-                        'course ID number, and "year_term" a year/term code.')
-    parser.add_argument('--campus-id', action='store', type=int,
-                        default='72',
-                        help='Two digit code number for the campus data '
-                        'should be gathered for.')
-    args = parser.parse_args()
+def course_detail(params, static=None):
+    """
+    Parse enrollment size information from detail page for a course.
 
-    year_term = args.year_term
-    cid_list = args.cid_list
+    A listed course should never give an error page, so one raises a
+    ``RuntimeError``, after telling the rate limiter to back off, rather
+    than returning sizes of -1 as ``parse_course_detail`` does.
 
-    if year_term and cid_list:
-        raise RuntimeError('Can only use one of '
-                           '--year-term and --cid-list')
-    elif not (year_term or cid_list):
-        raise RuntimeError('Must use exactly one of '
-                           '--year-term and --cid-list')
+    Parameters
+    ----------
 
-    # print(year_term)
+    params : dict
+        Dictionary of parameters for substitution in URLs. This must
+        include the keys 'campus_id', 'course_id', and 'year_term'.
+
+    static : dict, optional
+        Cached values of everything but the enrollment; see
+        ``parse_course_detail``.
+
+    Returns
+    -------
+
+    dict
+        A dict whose keys are the sizes in SIZE_KEYS and whose values are
+        the enrollment numbers, and the tuition, LASC, 18online and
+        course level columns.
+    """
+    size_info, _ = _timed_course_detail(params, static)
+    return size_info
 
-    # Define dict used for passing parameters. Values will mostly be
-    # filled in later. Make sure campus_id is an integer because we
-    # need to do some integer formatting on it.
-    url_params = dict(year_term=None, subject=None,
-                      course_id=None, campus_id=args.campus_id)
 
+def source_params(source, url_params, year_term=None):
+    """
+    Return a copy of the URL parameters filled in for one item of the
+    source list.
+
+    Parameters
+    ----------
+    source : str or tuple
+        Either a subject (when scraping a whole year/term) or a
+        ``(course_id, year_term)`` pair (when scraping a list of CIDs).
+    url_params : dict
+        Dictionary of parameters for substitution in URLs. It is not
+        modified.
+    year_term : str, optional
+        The year/term being scraped, if scraping by subject.
+
+    Returns
+    -------
+    dict
+        New parameter dictionary for this source.
+    """
+    params = url_params.copy()
     if year_term:
-        url_params['year_term'] = args.year_term
-        # Grab the list of subjects for this year/term
-        subjects = get_subject_list(url_params)
-        source_list = subjects
+        params['year_term'] = year_term
+        params['subject'] = source
+    else:
+        params['course_id'], params['year_term'] = source
+    return params
 
-    if cid_list:
-        inp_data = pl.read_csv(cid_list)
-        cids = inp_data['ID #'].to_list()
-        year_terms = inp_data['year_term'].to_list()
-        source_list = [('{:06d}'.format(int(c)), str(y)) for
-                       c, y in zip(cids, year_terms)]
 
-    # Quit if there is no data to scrape.
-    if len(source_list) == 0:
-        raise RuntimeError(f'No data found for {url_params}')
+def _error_page(course_url, page_content):
+    """
+    Return the error to raise for the detail page of a listed course
+    that is an error page, with the page attached for the dead-letter
+    queue.
 
-    # Make backup copy of muteable url_params dict
-    original_url_params = url_params.copy()
+    A listed course should not give an error page; the site is likely
+    overloaded, so the rate limiter is told to back off.
+    """
+    http_client.backoff()
+    error = RuntimeError(f'The detail page {course_url} is an error page')
+    keep_page(error, course_url, page_content)
+    return error
 
-    # print "Trying {}".format(subjects[0])
 
-    # Define composite dataframe to hold all of the data across all
-    # courses as an empty polars DataFrame.
-    composite_df = pl.DataFrame()
+def _timed_course_detail(params, static=None):
+    """
+    Fetch the course detail, as ``course_detail`` does, and return it
+    with the time at which the page arrived.
+    """
+    # Get and parse the course detail page.
+    course_url = COURSE_DETAIL_URL.format(**params)
+    result = http_client.get(course_url, kind='course_detail')
+    try:
+        with metrics.timer('parse_seconds', stage='parse_course_detail'):
+            to_get = parse_course_detail(result.text, course_url, static)
+    except FAILURES as error:
+        keep_page(error, course_url, result.text)
+        raise
+
+    if to_get[SIZE_KEYS[0]] == -1:
+        raise _error_page(course_url, result.text)
+
+    return to_get, result.received
+
+
+def _cached_static(cache, params, row):
+    """
+    Return the signature of a class list row and the cached static
+    attributes of its course, if there is a cache and they can be used.
+    """
+    if cache is None:
+        return None, None
+    signature = row_signature(row)
+    static = cache.lookup(params['campus_id'], params['year_term'],
+                          row['ID #'], signature)
+    return signature, static
+
+
+def _cache_static(cache, params, row, signature, size_info):
+    """
+    Save the static attributes of a course from a full parse of its
+    detail page.
+    """
+    if cache is None or size_info[SIZE_KEYS[0]] == -1:
+        return
+    static = {k: v for k, v in size_info.items() if k not in SIZE_KEYS}
+    cache.store(params['campus_id'], params['year_term'], row['ID #'],
+                signature, static)
+
+
+async def _fetch_source(source, params, list_function, semaphore,
+                        cache=None, dead_letters=None):
+    """
+    Fetch the class list for one source and then the detail page of
+    every class in it, with at most ``semaphore`` requests in flight.
+
+    If anything fails the source goes in ``dead_letters`` and its class
+    list is returned as ``None``.
+    """
+    try:
+        async with semaphore:
+            data_df = await asyncio.to_thread(list_function, params)
+
+        if data_df.is_empty():
+            return source, data_df, [], []
+
+        size_infos, timestamps = await gather_course_details(
+            data_df, params, semaphore, cache)
+    except FAILURES as error:
+        if dead_letters is not None:
+            dead_letters.add(source, error)
+        return source, None, [], []
+    return source, data_df, size_infos, timestamps
+
+
+async def _gather_all(coroutines):
+    """
+    Run the coroutines together and return their results, or, as soon
+    as one of them fails, cancel the rest and raise its error.
+    """
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+async def gather_course_details(data_df, params, semaphore, cache=None):
+    """
+    Fetch the detail page of every class in a class list, with at most
+    ``semaphore`` requests in flight.
+
+    The blocking fetches run in the default executor of the loop.
+
+    Parameters
+    ----------
+    data_df : polars DataFrame
+        The class list.
+    params : dict
+        URL parameters for the source the class list is for.
+    semaphore : asyncio.Semaphore
+        Limits the number of requests in flight; it may be shared with
+        other sources.
+    cache : static_cache.StaticAttributeCache, optional
+        Cache of static course attributes. Courses found in it only
+        have their enrollment taken from the detail page.
+
+    Returns
+    -------
+    size_infos, timestamps : list
+        The result of ``course_detail`` and the time it was received for
+        each row of ``data_df``.
+    """
+    async def one_course(row):
+        detail_params = dict(params, course_id=row['ID #'])
+        signature, static = _cached_static(cache, detail_params, row)
+        async with semaphore:
+            size_info, timestamp = await asyncio.to_thread(
+                _timed_course_detail, detail_params, static)
+        if static is None:
+            _cache_static(cache, detail_params, row, signature, size_info)
+        return size_info, timestamp
+
+    details = await _gather_all(one_course(row) for row
+                                in data_df.iter_rows(named=True))
+    size_infos = [size_info for size_info, _ in details]
+    timestamps = [timestamp for _, timestamp in details]
+    return size_infos, timestamps
+
+
+def _fetch_page(url, kind):
+    """
+    Return the body of the page at ``url``, which is of the given kind
+    (see ``http_client.get``), and the time at which it arrived.
+    """
+    result = http_client.get(url, kind=kind)
+    return result.text, result.received
+
+
+async def _parse_in_pool(parse_queue, function, *args):
+    """
+    Hand a page to the parser stage of the pipeline and wait for the
+    result. Waits for room in the queue if the parsers are behind.
+    """
+    future = asyncio.get_running_loop().create_future()
+    await parse_queue.put((function, args, future))
+    return await future
+
+
+async def _parse_worker(parse_queue, pool):
+    """
+    Parser stage of the pipeline: run each page in the queue through
+    its parsing function in the process pool and pass back the result.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        function, args, future = await parse_queue.get()
+        try:
+            # The time includes handing the page to the process and the
+            # result back.
+            with metrics.timer('parse_seconds', stage=function.__name__):
+                result = await loop.run_in_executor(pool, function, *args)
+        except Exception as error:
+            if not future.cancelled():
+                future.set_exception(error)
+        else:
+            if not future.cancelled():
+                future.set_result(result)
 
+
+async def _pipeline_class_list(params, page_type, semaphore, parse_queue):
+    """
+    Fetch every page of the class list for one source, handing each
+    page to the parsers, and return the rows.
+    """
+    if page_type == 'search':
+        list_url = SUBJECT_SEARCH_URL.format(**params)
+        kind = 'subject_search'
+    else:
+        list_url = COURSE_DETAIL_URL.format(**params)
+        kind = 'course_detail'
+
+    rows = []
+    url = list_url
+    seen = {url}
+    while url is not None:
+        async with semaphore:
+            body, _ = await asyncio.to_thread(_fetch_page, url, kind)
+        try:
+            page_rows, next_url = await _parse_in_pool(
+                parse_queue, results_page, body, url, page_type)
+        except IndexError as error:
+            keep_page(error, url, body)
+            raise
+        url = _add_search_page(rows, page_rows, next_url, seen, list_url)
+    return rows
+
+
+async def _pipeline_source(source, params, page_type, semaphore,
+                           parse_queue, cache=None, class_lists=None,
+                           dead_letters=None):
+    """
+    Fetcher stage of the pipeline for one source: fetch the class list,
+    unless it is in ``class_lists`` already, and then the detail page of
+    every class in it, handing each page to the parsers rather than
+    parsing it here.
+
+    If anything fails the source goes in ``dead_letters`` and its class
+    list is returned as ``None``.
+    """
+    try:
+        return await _pipeline_source_details(source, params, page_type,
+                                              semaphore, parse_queue, cache,
+                                              class_lists)
+    except FAILURES as error:
+        if dead_letters is not None:
+            dead_letters.add(source, error)
+        return source, None, [], []
+
+
+async def _pipeline_source_details(source, params, page_type, semaphore,
+                                   parse_queue, cache, class_lists):
+    """
+    The work of ``_pipeline_source``, which deals with any failure.
+    """
+    if class_lists is not None and params['subject'] in class_lists:
+        data_df = class_lists[params['subject']]
+    else:
+        # Subjects missing from class_lists are searched on their own;
+        # see _listed_classes.
+        rows = await _pipeline_class_list(params, page_type, semaphore,
+                                          parse_queue)
+
+        # Final stage: the DataFrame is assembled here, in this process.
+        with metrics.timer('build_seconds', stage='rows_to_frame'):
+            data_df = rows_to_frame(rows)
+    if data_df.is_empty():
+        return source, data_df, [], []
+
+    async def one_course(row):
+        an_id = row['ID #']
+        detail_params = dict(params, course_id=an_id)
+        course_url = COURSE_DETAIL_URL.format(**detail_params)
+        signature, static = _cached_static(cache, detail_params, row)
+        async with semaphore:
+            body, timestamp = await asyncio.to_thread(_fetch_page,
+                                                      course_url,
+                                                      'course_detail')
+        try:
+            size_info = await _parse_in_pool(parse_queue,
+                                             parse_course_detail, body,
+                                             course_url, static)
+        except FAILURES as error:
+            keep_page(error, course_url, body)
+            raise
+        if size_info[SIZE_KEYS[0]] == -1:
+            raise _error_page(course_url, body)
+        if static is None:
+            _cache_static(cache, detail_params, row, signature, size_info)
+        return size_info, timestamp
+
+    details = await _gather_all(one_course(row) for row
+                                in data_df.iter_rows(named=True))
+    size_infos = [size_info for size_info, _ in details]
+    timestamps = [timestamp for _, timestamp in details]
+    return source, data_df, size_infos, timestamps
+
+
+def fetch_sources(source_list, url_params, year_term=None,
+                  concurrency=DEFAULT_CONCURRENCY, parsers=0,
+                  queue_size=DEFAULT_PARSE_QUEUE_SIZE, cache=None,
+                  class_lists=None, stream=False, dead_letters=None):
+    """
+    Fetch the class list and course details for every item in the
+    source list, running up to ``concurrency`` requests at once across
+    all of the sources.
+
+    Results are yielded in the same order as ``source_list`` no matter
+    which order the requests finish in, so the output of a concurrent
+    run is the same as that of a serial one.
+
+    If ``parsers`` is non-zero the work is split into a pipeline: the
+    fetchers only download pages and put them on a queue of at most
+    ``queue_size`` pages, a pool of ``parsers`` processes turns the
+    pages into rows, and the DataFrames are assembled from the rows as
+    the last stage. Parsing then uses several cores and never holds up
+    the network requests.
+
+    Parameters
+    ----------
+    source_list : list
+        Subjects or ``(course_id, year_term)`` pairs; see
+        ``source_params``.
+    url_params : dict
+        Dictionary of parameters for substitution in URLs.
+    year_term : str, optional
+        The year/term being scraped, if scraping by subject.
+    concurrency : int, optional
+        Largest number of requests in flight at any one time.
+    parsers : int, optional
+        Number of parser processes, or 0 to parse in the fetching threads.
+    queue_size : int, optional
+        Largest number of fetched pages waiting to be parsed.
+    cache : static_cache.StaticAttributeCache, optional
+        Cache of static course attributes to use and fill in.
+    class_lists : dict, optional
+        Class lists of the subjects, from ``class_lists_for_term``. If
+        given, only the course details are fetched, except for subjects
+        missing from it, which are searched on their own.
+    stream : bool, optional
+        Parse the subject search results as they arrive. Not used with
+        ``parsers``, since the parsers need whole pages.
+    dead_letters : dead_letters.DeadLetterQueue, optional
+        Where to record the sources that fail, and why.
+
+    Yields
+    ------
+    tuple
+        ``(source, data_df, size_infos, timestamps)``. ``data_df`` is
+        ``None`` if the source failed, and
+        ``size_infos`` and ``timestamps`` hold the result of
+        ``course_detail`` and the time it was received for each row of
+        ``data_df``.
+    """
+    loop = asyncio.new_event_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+    pool = ProcessPoolExecutor(max_workers=parsers) if parsers else None
+    tasks = []
+    workers = []
+    try:
+        semaphore = asyncio.Semaphore(concurrency)
+        if pool is None:
+            if class_lists is not None:
+                list_function = partial(_listed_classes, class_lists,
+                                        stream=stream)
+            elif year_term:
+                list_function = partial(class_list_for_subject, stream=stream)
+            else:
+                list_function = class_list_for_cid
+            coroutines = [
+                _fetch_source(source,
+                              source_params(source, url_params, year_term),
+                              list_function, semaphore, cache, dead_letters)
+                for source in source_list
+            ]
+        else:
+            page_type = 'search' if year_term else 'detail'
+            parse_queue = asyncio.Queue(maxsize=queue_size)
+            # Twice as many workers as processes keeps the pool busy
+            # while results are handed back.
+            workers = [loop.create_task(_parse_worker(parse_queue, pool))
+                       for _ in range(2 * parsers)]
+            coroutines = [
+                _pipeline_source(source,
+                                 source_params(source, url_params,
+                                               year_term),
+                                 page_type, semaphore, parse_queue, cache,
+                                 class_lists, dead_letters)
+                for source in source_list
+            ]
+        tasks = [loop.create_task(coroutine) for coroutine in coroutines]
+
+        # Running the loop until each task in turn is done lets all of
+        # the other tasks make progress in the meantime.
+        for task in tasks:
+            yield loop.run_until_complete(task)
+    finally:
+        for task in tasks + workers:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, *workers,
+                                               return_exceptions=True))
+        loop.run_until_complete(loop.shutdown_default_executor())
+        loop.close()
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+
+def make_destination(campus_id, now=None):
+    """
+    Make the directory for the results of a run for one campus and
+    return its name.
+
+    The directory is named for the date and time of the run, ``now`` (a
+    ``time.struct_time``, by default the current time). MSUM results go
+    in the current directory and those of other campuses in a directory
+    named for the campus.
+    """
     # Generate a date/time to use in naming directory with results
-    now = time.localtime()
+    now = now or time.localtime()
     formatted_datetime = datetime.datetime(*now[:-3]).isoformat()
     formatted_datetime = formatted_datetime.replace(':', '-')
     destination = '-'.join([DESTINATION_DIR_BASE, formatted_datetime])
-    if args.campus_id != 72:
+    if campus_id != 72:
         # Sorry other campuses, you get separate folders.
-        p = Path(str(args.campus_id)) / destination
+        p = Path(str(campus_id)) / destination
         destination = str(p)
 
     # Make the directory
@@ -509,142 +1407,684 @@ if __name__ == '__main__':
         Path(destination).mkdir(parents=True, exist_ok=False)
     except OSError:
         raise OSError('Destination folder %s already exists' % destination)
+    return destination
+
+
+def add_course_details(data_df, size_infos, timestamps, year_term):
+    """
+    Add the course detail columns, timestamp and year/term to the class
+    list for a subject and put the columns in ``DESIRED_ORDER``.
+
+    Parameters
+    ----------
+    data_df : polars DataFrame
+        The class list, one row per course.
+    size_infos : list of dict
+        Result of ``course_detail`` for each row of ``data_df``.
+    timestamps : list of float
+        Time at which the detail for each row was fetched.
+    year_term : str
+        The year/term of the classes.
+
+    Returns
+    -------
+    polars DataFrame
+        The completed table for the subject.
+    """
+    # Collect the course detail fields into one typed column each,
+    # turning empty strings into nulls as they go in, so that they are
+    # properly recognized as missing values in polars.
+    results = defaultdict(list)
+    for size_info in size_infos:
+        for k, v in size_info.items():
+            results[k].append(v)
+
+    detail_columns = {}
+    for k in SIZE_KEYS:
+        detail_columns[k] = pl.Series(name=k, values=results[k],
+                                      dtype=pl.Int64)
+
+    # Because polars casts booleans to strings as lowercase, to match
+    # the old astropy code, we need to convert the boolean values
+    # to strings.
+    for k in EXTRA_COLUMNS:
+        col_values = results[k]
+        # If the first value in column is boolean, typecast using
+        # str() convert booleans to capitalized string
+        if isinstance(col_values[0], bool):
+            col_values = [str(v) for v in col_values]
+        detail_columns[k] = pl.Series(
+            name=k, values=[None if v == '' else v for v in col_values],
+            dtype=pl.Utf8)
+
+    detail_columns['timestamp'] = pl.Series(name='timestamp',
+                                            values=timestamps,
+                                            dtype=pl.Float64)
+
+    # Build the finished table in one go, with the columns in the
+    # desired order: the class list columns with empty strings made
+    # null, the detail columns from above and the year/term.
+    year_term = str(year_term)
+    columns = []
+    for col in DESIRED_ORDER:
+        if col in detail_columns:
+            columns.append(pl.lit(detail_columns[col]).alias(col))
+        elif col == 'year_term':
+            columns.append(pl.lit(year_term if year_term else None,
+                                  dtype=pl.Utf8).alias(col))
+        else:
+            columns.append(pl.when(pl.col(col) == '').then(None)
+                           .otherwise(pl.col(col)).alias(col))
+    data_df = data_df.select(columns)
+    return data_df
+
+
+def make_source_list(url_params, year_term=None, cid_list=None):
+    """
+    Return the sources to scrape: the subjects of the year/term, or the
+    ``(course_id, year_term)`` pairs in the CID list.
+    """
+    if year_term:
+        # Grab the list of subjects for this year/term
+        return get_subject_list(dict(url_params, year_term=year_term))
+
+    inp_data = pl.read_csv(cid_list)
+    cids = inp_data['ID #'].to_list()
+    year_terms = inp_data['year_term'].to_list()
+    return [('{:06d}'.format(int(c)), str(y)) for
+            c, y in zip(cids, year_terms)]
+
+
+def fetch_options(args, url_params, year_term):
+    """
+    Return the keyword arguments for ``fetch_sources`` given by the
+    command line arguments, loading the static attribute cache and
+    doing the search across all subjects if they were asked for.
+    """
+    cache = None
+    if args.static_cache:
+        cache = StaticAttributeCache(
+            args.static_cache, max_age=args.static_cache_max_age * 86400,
+            refresh=args.refresh_static_cache)
+
+    class_lists = None
+    if args.bulk_search and year_term:
+        try:
+            class_lists = class_lists_for_term(
+                dict(url_params, year_term=year_term),
+                stream=args.stream_parse)
+        except (IndexError, requests.exceptions.RequestException):
+            print("The search across all subjects did not work, so "
+                  "searching each subject in turn.")
+        else:
+            print(f"Found {sum(len(c) for c in class_lists.values())} "
+                  f"classes in {len(class_lists)} subjects.")
+
+    return dict(concurrency=args.concurrency, parsers=args.parsers,
+                queue_size=args.parse_queue_size, cache=cache,
+                class_lists=class_lists, stream=args.stream_parse)
 
-    temp_paths = []
+
+def scrape_sources(sources, writer, journal, url_params, year_term=None,
+                   dead_letters=None, **options):
+    """
+    Fetch the sources and write each one out, and record it in the
+    journal, as soon as it is done. Sources that fail are set aside in
+    ``dead_letters``, if it is given, and those that failed before and
+    now work are marked as recovered.
+
+    Parameters
+    ----------
+    sources : list
+        Subjects or ``(course_id, year_term)`` pairs.
+    writer : writers.StreamingCSVWriter or writers.DatasetWriter
+        Where the rows go.
+    journal : journal.RunJournal
+        The journal of the run.
+    url_params : dict
+        Dictionary of parameters for substitution in URLs.
+    year_term : str, optional
+        The year/term being scraped, if scraping by subject.
+    dead_letters : dead_letters.DeadLetterQueue, optional
+        Where to record the sources that fail.
+    **options
+        Passed on to ``fetch_sources``.
+
+    Returns
+    -------
+    list
+        The sources that failed or had no courses.
+    """
     bads = []
 
-    # Process each course rubric (aka subject)
-    print(f"Processing {len(source_list)} subjects...")
-    for source in source_list:
+    # Process each course rubric (aka subject). The pages are fetched
+    # concurrently, but the results come back in the original order.
+    for source, data_df, size_infos, timestamps in fetch_sources(
+            sources, url_params, year_term=year_term,
+            dead_letters=dead_letters, **options):
         # Notify user of progress
-        print(f"{source}", end="", flush=True)
+        print(f"{source} [{http_client.status()}]", end="", flush=True)
 
-        # Pull list of classes for subject. Note that this is dataframe
-        # from which most of the course information is derived.
-        try:
-            if year_term:
-                url_params['year_term'] = year_term
-                url_params['subject'] = source
-                data_df = class_list_for_subject(url_params)
-            elif cid_list:
-                url_params['year_term'] = source[1]
-                url_params['course_id'] = source[0]
-                data_df = class_list_for_cid(url_params)
-
-            # Check for an empty DataFrame, which can happen if there are
-            # no courses listed for a subject.
-            if data_df.is_empty():
-                # This can happen, for example, if there are no courses listed
-                # for a subject...
-                bads.append(source)
-                print(" (No courses) .. ", end="", flush=True)
-                continue
-        except IndexError:
+        # Something failed; the reason is in the dead-letter queue.
+        if data_df is None:
             bads.append(source)
+            journal.record(source, FAILED)
+            metrics.increment('sources_total', status=FAILED)
             print(" (Failed)", end="", flush=True)
             continue
 
-        # Get the IDs of the courses from the DataFrame.
-        IDs = data_df['ID #']
-
-        # Create a mew results dictionary to hold data (it defaults
-        # to empty lists for each key).
-        results = defaultdict(list)
-        timestamps = []
+        # Check for an empty DataFrame, which can happen if there are
+        # no courses listed for a subject.
+        if data_df.is_empty():
+            # This can happen, for example, if there are no courses listed
+            # for a subject...
+            bads.append(source)
+            journal.record(source, EMPTY)
+            metrics.increment('sources_total', status=EMPTY)
+            if dead_letters is not None:
+                dead_letters.resolve(source)
+            print(" (No courses) .. ", end="", flush=True)
+            continue
 
         use_year_term = year_term or source[1]
-        url_params['year_term'] = use_year_term
-
-        # Obtain the enrollment and enrollment cap, and add a timestamp.
-        original_course_id = url_params['course_id']
-        for an_id in IDs:
-            url_params['course_id'] = an_id
-            size_info = course_detail(url_params)
-            for k, v in size_info.items():
-                results[k].append(v)
-            timestamps.append(time.time())
-
-        # Reset the url_params to the original values, so that
-        # we can use it again for the next subject.
-        url_params['course_id'] = original_course_id
-
-        # Add columns from course detail to the polars dataframe
-        for k in SIZE_KEYS:
-            data_df = data_df.with_columns(
-                pl.Series(name=k, values=results[k], dtype=pl.Int64)
-            )
-
-        # Because polars casts booleans to strings as lowercase, to match
-        # the old astropy code, we need to convert the boolean values
-        # to strings.
-        for k in EXTRA_COLUMNS:
-            col_values = results[k]
-            # If the first value in column is boolean, typecast using
-            # str() convert booleans to capitalized string
-            if isinstance(col_values[0], bool):
-                col_values = [str(v) for v in col_values]
-            # Add the column to the DataFrame
-            data_df = data_df.with_columns(
-                pl.Series(name=k, values=col_values, dtype=pl.Utf8)
-            )
-
-        # Add a timestamp column to the table
-        data_df = data_df.with_columns(
-            pl.Series(name='timestamp', values=timestamps, dtype=pl.Float64)
-        )
-
-        # Add a year_term column to the table
-        data_df = data_df.with_columns(
-            pl.Series(name='year_term', values=[str(use_year_term)] * len(data_df),
-                      dtype=pl.Utf8)
-        )
-
-        # Reorder columns to be in the desired order.
-        data_df = data_df.select(DESIRED_ORDER)
-
-        # Replace all empty strings with None, so that they are
-        # properly recognized as missing values in polars.
-        data_df = data_df.with_columns([
-            pl.when(pl.col(col).cast(pl.Utf8) == '').then(None).otherwise(pl.col(col)).alias(col)
-            for col in data_df.columns if data_df.schema[col] == pl.Utf8
-        ])
-
-        # Add the table to the overall table...
-        if composite_df.is_empty():
-            composite_df = data_df
-        else:
-            composite_df = pl.concat([composite_df, data_df])
-
-        # ...but also write out this individual table in case we have a
-        # failure along the way.
-        temp_file = source + '.csv'
-        temp_path = Path(destination) / temp_file
-        data_df.write_csv(temp_path)
-        temp_paths.append(temp_path)
+        with metrics.timer('build_seconds', stage='add_course_details'):
+            data_df = add_course_details(data_df, size_infos, timestamps,
+                                         use_year_term)
+
+        # Add the table to the overall table.
+        with metrics.timer('write_seconds', stage='write_batch'):
+            writer.write_batch(data_df, source)
+        journal.record(source, WRITTEN, rows=len(data_df))
+        metrics.increment('sources_total', status=WRITTEN)
+        metrics.increment('courses_total', len(data_df))
+        if dead_letters is not None:
+            dead_letters.resolve(source)
 
         print(f" .. ", end="", flush=True)
 
-    print(" Done.")
-    print(f"Processed {len(source_list) - len(bads)} subjects, "
-          f"failed on {len(bads)} subjects. A total of {len(composite_df)} "
-          "courses were processed.")
-    
-    # Write out a file for the overall (i.e. all subjects) table.
-    composite_df.write_csv(Path(destination) /  'all_enrollments.csv')
+    return bads
 
-    # Verify that the table wrote out correctly
-    from_disk = pl.read_csv(Path(destination) / 'all_enrollments.csv')
 
-    if len(from_disk) != len(composite_df):
-        raise RuntimeError('Enrollment data did not properly write to disk!')
+def retry_failed(sources, writer, journal, dead_letters, url_params,
+                 year_term=None, passes=DEFAULT_RETRY_PASSES,
+                 delay=DEFAULT_RETRY_DELAY, **options):
+    """
+    Give the sources in the dead-letter queue up to ``passes`` more
+    tries, waiting ``delay`` seconds before the first pass and twice as
+    long before each pass after that.
 
-    for path in temp_paths:
-        Path(path).unlink()
+    Parameters
+    ----------
+    sources : list
+        The sources of the run.
+    writer, journal, url_params, year_term, **options
+        As for ``scrape_sources``.
+    dead_letters : dead_letters.DeadLetterQueue
+        The failures of the run so far.
+    passes : int, optional
+        Largest number of passes.
+    delay : float, optional
+        Seconds to wait before the first pass.
 
-    # symlink LATEST to this run of the scraper.
+    Returns
+    -------
+    list
+        The sources that still failed.
+    """
+    def still_failed():
+        failed = set(dead_letters.failed())
+        return [source for source in sources
+                if source_label(source) in failed]
+
+    for retry_pass in range(1, passes + 1):
+        failed = still_failed()
+        if not failed:
+            break
+        print(f"\nRetry pass {retry_pass} of {passes} for {len(failed)} "
+              f"{sources_name(sources)} in {delay:g} s...")
+        time.sleep(delay)
+        scrape_sources(failed, writer, journal, url_params,
+                       year_term=year_term, dead_letters=dead_letters,
+                       **options)
+        delay *= 2
+    return still_failed()
+
+
+def link_latest(destination):
+    """
+    Point the ``LATEST`` symlink at the results directory of a run.
+    """
     latest_path = Path(LATEST)
     try:
         latest_path.unlink()
     except FileNotFoundError:
         pass
     latest_path.symlink_to(destination)
+
+
+def scrape_shard(claim, settings, url_params, retry_passes=0,
+                 retry_delay=DEFAULT_RETRY_DELAY, **options):
+    """
+    Scrape the sources of one unit of a sharded run into a results
+    directory of its own, ``claim.shard_dir``, laid out like that of an
+    ordinary run.
+
+    Sources that fail get ``retry_passes`` more tries at the end of the
+    unit, as in ``retry_failed``.
+
+    Returns
+    -------
+    dict
+        The number of rows written, of sources that failed or had no
+        courses, and of sources that failed even when retried, to record
+        about the unit.
+    """
+    destination = claim.shard_dir
+    destination.mkdir(parents=True)
+    journal = RunJournal.create(destination, settings, claim.sources)
+    writer = open_writer(destination, settings['campus_id'],
+                         output_format=settings['output_format'])
+    dead_letters = DeadLetterQueue(destination / DEAD_LETTERS_FILE)
+
+    print(f"Processing {claim.unit}, {len(claim.sources)} "
+          f"{sources_name(claim.sources)}...")
+    bads = scrape_sources(claim.sources, writer, journal, url_params,
+                          year_term=settings['year_term'],
+                          dead_letters=dead_letters, **options)
+    failed = retry_failed(claim.sources, writer, journal, dead_letters,
+                          url_params, year_term=settings['year_term'],
+                          passes=retry_passes, delay=retry_delay, **options)
+    bads = [source for source in bads
+            if journal.status[source_label(source)] != WRITTEN]
+    writer.close()
+    if options.get('cache') is not None:
+        options['cache'].save()
+    print(" Done.")
+    if not writer.verify():
+        raise RuntimeError('Enrollment data did not properly write to disk!')
+    return dict(rows=writer.rows, bads=len(bads), failed=len(failed))
+
+
+def merge_shards(queue):
+    """
+    Combine the output of every unit of a sharded run into a new results
+    directory, exactly as if one process had scraped all of the sources
+    in order, and return a record of the merge.
+
+    The journal of the merged run says which sources failed, so the run
+    can be finished with ``--resume`` like any other; why they failed is
+    in the dead-letter queue of each shard.
+    """
+    settings = queue.settings
+    destination = make_destination(settings['campus_id'])
+    journal = RunJournal.create(destination, settings, queue.source_list)
+    writer = open_writer(destination, settings['campus_id'],
+                         output_format=settings['output_format'])
+
+    failed = []
+    for unit, sources in queue.units:
+        shard_dir = queue.shard_dir(unit, queue.done_record(unit)['attempt'])
+        shard_journal = RunJournal.load(shard_dir)
+        rows = {}
+        with metrics.timer('write_seconds', stage='merge_shard'):
+            for label, data_df in read_batches(shard_dir):
+                writer.write_batch(data_df, label)
+                rows[label] = len(data_df)
+        for source in sources:
+            label = source_label(source)
+            status = shard_journal.status.get(label, FAILED)
+            journal.record(source, status, rows=rows.get(label, 0))
+            if status == FAILED:
+                failed.append(label)
+    writer.close()
+
+    if not writer.verify():
+        raise RuntimeError('Enrollment data did not properly write to disk!')
+    link_latest(destination)
+    return dict(destination=str(Path(destination).resolve()),
+                rows=writer.rows, failed=failed)
+
+
+def run_sharded(args, url_params):
+    """
+    Work on the sharded run in the queue ``args.shard_queue``, making
+    the queue if this is the first worker, until every unit is done, and
+    then merge the shards unless another worker does.
+    """
+    settings = dict(year_term=args.year_term, cid_list=args.cid_list,
+                    campus_id=args.campus_id,
+                    output_format=args.output_format)
+    queue = work_queue.WorkQueue.open(
+        args.shard_queue, settings,
+        partial(make_source_list, url_params, args.year_term, args.cid_list),
+        args.shard_size, stale_after=args.stale_after)
+    unfinished = queue.unfinished()
+    print(f"Working on {queue.path}: {len(unfinished)} of "
+          f"{len(queue.units)} units left.")
+
+    # Only set up the cache and class lists if there is work left.
+    options = {}
+    if unfinished:
+        options = fetch_options(args, url_params, args.year_term)
+    finished = work_queue.work(
+        queue, partial(scrape_shard, settings=settings,
+                       url_params=url_params, retry_passes=args.retry_passes,
+                       retry_delay=args.retry_delay, **options))
+    print(f"Finished {finished} units.")
+
+    record = work_queue.merge_once(queue, merge_shards)
+    if record is None:
+        print("Another worker is merging the shards.")
+    elif record['worker'] != work_queue.worker_name():
+        print(f"Already merged by {record['worker']}: {record['rows']} "
+              f"courses in {record['destination']}.")
+    else:
+        print(f"Merged {record['rows']} courses into "
+              f"{record['destination']}.")
+        if record['failed']:
+            print(f"Could not recover {len(record['failed'])} "
+                  f"{sources_name(queue.source_list)}; use --resume on the "
+                  "merged results to try them again: "
+                  f"{', '.join(record['failed'])}")
+
+    # Each worker keeps its own metrics, beside the queue.
+    metrics.write(queue.path / f'{work_queue.worker_name()}-'
+                  f'{metrics.JSON_FILE}')
+
+
+def main(argv=None, prog=None):
+    """
+    Scrape one campus, by year/term or from a list of course IDs.
+
+    ``argv`` is the list of command line arguments, by default those of
+    the script, and ``prog`` the name to use in the usage message.
+    """
+    parser = argparse.ArgumentParser(prog=prog,
+                                     description='Scrape enrollment numbers '
+                                     'from public MnSCU search site')
+    parser.add_argument('--year-term', action='store',
+                        help='Code for year/term, a 5 digit '
+                        'number like 20155 (spring of 2015)')
+    parser.add_argument('--cid-list', action='store',
+                        help='CSV that has at least two columns, "ID #", a '
+                        'course ID number, and "year_term" a year/term code.')
+    parser.add_argument('--campus-id', action='store', type=int,
+                        default='72',
+                        help='Two digit code number for the campus data '
+                        'should be gathered for.')
+    parser.add_argument('--concurrency', action='store', type=int,
+                        default=DEFAULT_CONCURRENCY,
+                        help='Largest number of page requests to have in '
+                        'flight at once.')
+    parser.add_argument('--parsers', action='store', type=int, default=0,
+                        help='Parse pages in a pool of this many processes, '
+                        'separate from the fetching. The default, 0, '
+                        'parses pages as they are fetched.')
+    parser.add_argument('--stream-parse', action='store_true',
+                        help='Parse the subject search results as they '
+                        'arrive, row by row, rather than once each page '
+                        'has been read in full. Cannot be used with '
+                        '--parsers.')
+    parser.add_argument('--parse-queue-size', action='store', type=int,
+                        default=DEFAULT_PARSE_QUEUE_SIZE,
+                        help='Largest number of fetched pages waiting to be '
+                        'parsed when using --parsers.')
+    parser.add_argument('--output-format', action='store', default='csv',
+                        choices=sorted(OUTPUT_FORMATS),
+                        help='Write all_enrollments.csv (the default), or '
+                        'a Parquet or Arrow IPC dataset, all_enrollments/, '
+                        'partitioned by campus and year/term.')
+    parser.add_argument('--bulk-search', action='store_true',
+                        help='Get the class lists of all of the subjects '
+                        'from one search, a page at a time, instead of '
+                        'one search per subject. Only used with '
+                        '--year-term.')
+    parser.add_argument('--retry-passes', action='store', type=int,
+                        default=DEFAULT_RETRY_PASSES,
+                        help='Number of extra passes, at the end of the run, '
+                        'over the subjects or course IDs that failed.')
+    parser.add_argument('--retry-delay', action='store', type=float,
+                        default=DEFAULT_RETRY_DELAY,
+                        help='Seconds to wait before the first retry pass; '
+                        'the wait doubles for each pass after that.')
+    parser.add_argument('--resume', action='store', metavar='RESULTS_DIR',
+                        help='Carry on with an interrupted run whose results '
+                        'are in RESULTS_DIR, fetching only the subjects or '
+                        'course IDs that were not finished.')
+    parser.add_argument('--archive-pages', action='store_true',
+                        help='Keep every page fetched, compressed, in '
+                        'pages.zz in the results directory, so that the '
+                        'output can be made again with --reparse.')
+    parser.add_argument('--reparse', action='store', metavar='RESULTS_DIR',
+                        help='Make the output of the run in RESULTS_DIR, '
+                        'which used --archive-pages, again from its pages, '
+                        'into a new results directory, without using the '
+                        'network. Parses with --parsers processes, by '
+                        'default one per core.')
+    parser.add_argument('--shard-queue', action='store', metavar='DIR',
+                        help='Share the run with other processes, on this '
+                        'or other machines, through a queue of work in '
+                        'DIR, which must be on a filesystem they all see. '
+                        'Start every worker with the same options; the '
+                        'last one to finish merges the output.')
+    parser.add_argument('--shard-size', action='store', type=int,
+                        default=DEFAULT_SHARD_SIZE,
+                        help='Number of subjects, or course IDs, in each '
+                        'unit of work of the --shard-queue.')
+    parser.add_argument('--stale-after', action='store', type=float,
+                        default=work_queue.DEFAULT_STALE_AFTER,
+                        help='Seconds after which the unit of a worker of '
+                        'the --shard-queue that has stopped responding is '
+                        'given to another worker.')
+    parser.add_argument('--prometheus', action='store_true',
+                        help='As well as metrics.json, write the timings '
+                        'and counts for the run to metrics.prom, in the '
+                        'Prometheus text format.')
+    parser.add_argument('--static-cache', action='store', metavar='DIR',
+                        help='Keep the course attributes that do not change '
+                        'during a term (tuition, LASC/WI, 18online, course '
+                        'level) in DIR, and on later runs only read the '
+                        'enrollment from the detail pages.')
+    parser.add_argument('--static-cache-max-age', action='store',
+                        type=float, default=DEFAULT_MAX_AGE / 86400,
+                        help='Days after which cached course attributes '
+                        'are read from the detail page again.')
+    parser.add_argument('--refresh-static-cache', action='store_true',
+                        help='Read every course attribute from the detail '
+                        'pages, replacing what is in the cache.')
+    http_client.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    http_client.configure_from_args(args, concurrency=args.concurrency)
+    run_start = time.perf_counter()
+
+    journal = None
+    if args.resume:
+        if args.shard_queue:
+            raise RuntimeError('Can only use one of --resume and '
+                               '--shard-queue')
+        if args.year_term or args.cid_list:
+            raise RuntimeError('--resume carries on with the settings of '
+                               'the earlier run; do not give --year-term '
+                               'or --cid-list')
+        # Pick up the settings and sources of the interrupted run.
+        journal = RunJournal.load(args.resume)
+        if 'year_terms' in journal.settings:
+            raise RuntimeError(f'{args.resume} is from scrape_system.py; '
+                               'resume it with scrape_system.py --resume')
+        args.campus_id = journal.settings['campus_id']
+        args.output_format = journal.settings['output_format']
+        args.year_term = journal.settings['year_term']
+        args.cid_list = journal.settings['cid_list']
+
+    reparsed = None
+    if args.reparse:
+        if args.resume or args.shard_queue or args.archive_pages:
+            raise RuntimeError('Cannot use --resume, --shard-queue or '
+                               '--archive-pages with --reparse')
+        if args.year_term or args.cid_list:
+            raise RuntimeError('--reparse uses the settings of the archived '
+                               'run; do not give --year-term or --cid-list')
+        if not archive_exists(args.reparse):
+            raise RuntimeError(f'There is no archive of pages in '
+                               f'{args.reparse}; the run needs to have used '
+                               '--archive-pages')
+        reparsed = RunJournal.load(args.reparse)
+        args.campus_id = reparsed.settings['campus_id']
+        args.output_format = reparsed.settings['output_format']
+        args.year_term = reparsed.settings['year_term']
+        args.cid_list = reparsed.settings['cid_list']
+
+        # Every page now comes from the archive.
+        replay = PageArchive(args.reparse)
+        http_client.replay_from(replay)
+        # The archive has the search across all subjects only if the
+        # run used it.
+        term_url = SUBJECT_SEARCH_URL.format(
+            campus_id=args.campus_id, year_term=args.year_term, subject='')
+        args.bulk_search = bool(args.year_term) and term_url in replay
+        # Whatever is missing from the archive will still be missing
+        # on another try.
+        args.retry_passes = 0
+        if not (args.parsers or args.stream_parse):
+            args.parsers = os.cpu_count()
+
+    if args.archive_pages and args.shard_queue:
+        raise RuntimeError('Can only use one of --archive-pages and '
+                           '--shard-queue')
+
+    year_term = args.year_term
+    cid_list = args.cid_list
+
+    if args.stream_parse and args.parsers:
+        raise RuntimeError('Can only use one of --stream-parse and '
+                           '--parsers')
+
+    if year_term and cid_list:
+        raise RuntimeError('Can only use one of '
+                           '--year-term and --cid-list')
+    elif not (year_term or cid_list):
+        raise RuntimeError('Must use exactly one of '
+                           '--year-term and --cid-list')
+
+    # print(year_term)
+
+    # Define dict used for passing parameters. Values will mostly be
+    # filled in later. Make sure campus_id is an integer because we
+    # need to do some integer formatting on it.
+    url_params = dict(year_term=None, subject=None,
+                      course_id=None, campus_id=args.campus_id)
+
+    if args.shard_queue:
+        run_sharded(args, url_params)
+        return
+
+    if journal is not None:
+        source_list = journal.source_list
+    elif reparsed is not None:
+        source_list = reparsed.source_list
+    else:
+        if year_term:
+            url_params['year_term'] = args.year_term
+        source_list = make_source_list(url_params, year_term, cid_list)
+
+    # Quit if there is no data to scrape.
+    if len(source_list) == 0:
+        raise RuntimeError(f'No data found for {url_params}')
+
+    # print "Trying {}".format(subjects[0])
+
+    if journal is not None:
+        destination = args.resume
+    else:
+        destination = make_destination(args.campus_id)
+
+        settings = dict(year_term=year_term, cid_list=cid_list,
+                        campus_id=args.campus_id,
+                        output_format=args.output_format)
+        journal = RunJournal.create(destination, settings, source_list)
+
+    noun = sources_name(source_list)
+
+    # Each subject is appended to the overall (i.e. all subjects) table
+    # on disk as soon as it is done, so memory use does not grow with the
+    # size of the term and a failure part way through keeps what has
+    # been done so far. The journal records each subject once it is on
+    # disk, so that a resumed run only does what is missing.
+    resume_sources = journal.written_sources() if args.resume else None
+    writer = open_writer(destination, args.campus_id,
+                         output_format=args.output_format,
+                         resume_sources=resume_sources)
+    if args.resume:
+        # Whatever did not survive in the output is fetched again.
+        lost = journal.keep_written(writer.sources())
+        if lost:
+            print(f"{len(lost)} {noun} were damaged or missing in the "
+                  "output and will be fetched again.")
+
+    remaining = journal.remaining()
+    if len(remaining) < len(source_list):
+        print(f"Resuming {destination}: "
+              f"{len(source_list) - len(remaining)} {noun} already done.")
+
+    # A resumed run adds its pages to the archive it already has.
+    archive = None
+    if args.archive_pages:
+        archive = PageArchive(destination, mode='a')
+        http_client.archive_to(archive)
+    if reparsed is not None:
+        print(f"Reparsing the pages archived in {args.reparse}.")
+
+    options = fetch_options(args, url_params, year_term)
+
+    # Failures are set aside, with the reason and the page, instead of
+    # stopping the run, and tried again once everything else is done.
+    dead_letters = DeadLetterQueue(Path(destination) / DEAD_LETTERS_FILE)
+
+    print(f"Processing {len(remaining)} {noun}...")
+    bads = scrape_sources(remaining, writer, journal, url_params,
+                          year_term=year_term, dead_letters=dead_letters,
+                          **options)
+    failed = retry_failed(remaining, writer, journal, dead_letters,
+                          url_params, year_term=year_term,
+                          passes=args.retry_passes, delay=args.retry_delay,
+                          **options)
+    bads = [source for source in bads
+            if journal.status[source_label(source)] != WRITTEN]
+    writer.close()
+    if options['cache'] is not None:
+        options['cache'].save()
+    if archive is not None:
+        http_client.archive_to(None)
+        archive.close()
+
+    print(" Done.")
+    print(f"Processed {len(source_list) - len(bads)} {noun}, "
+          f"failed on {len(bads)} {noun}. A total of {writer.rows} "
+          "courses were processed.")
+    if failed:
+        print(f"Could not recover {len(failed)} {noun}, listed in "
+              f"{dead_letters.path}; use --resume to try them again:")
+        print(dead_letters.report())
+
+    # Verify that the table wrote out correctly, using the manifest
+    # rather than reading the whole table back in. The output of a
+    # resumed run was partly written by another process, so it is
+    # checksummed as well.
+    if not writer.verify(checksum=bool(args.resume)):
+        raise RuntimeError('Enrollment data did not properly write to disk!')
+
+    metrics.set_gauge('run_seconds', time.perf_counter() - run_start)
+    prometheus_path = None
+    if args.prometheus:
+        prometheus_path = Path(destination) / metrics.PROMETHEUS_FILE
+    metrics.write(Path(destination) / metrics.JSON_FILE, prometheus_path)
+    print("Time spent in each stage:")
+    print(metrics.summary())
+
+    # symlink LATEST to this run of the scraper.
+    link_latest(destination)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,408 @@
+# Scrape several campuses and year/terms in one run, sharing one budget
+# of requests between all of them, instead of running scrape.py once for
+# each campus and term.
+#
+# The work is done in two passes. The first fetches the class list of
+# every subject of every campus and term, which gives the number of
+# detail pages each subject needs. The second fetches the detail pages,
+# largest subjects first, so that one big subject left until the end
+# does not set the time the whole run takes.
+#
+# Each campus gets the usual results directory (see
+# scrape.make_destination), holding all of the terms scraped for it,
+# with a journal and a dead-letter queue as for scrape.py. A subject
+# that fails is set aside and tried again at the end instead of stopping
+# the run, and an interrupted run can be carried on with --resume and
+# the results directories of its campuses.
+
+import time
+import asyncio
+import argparse
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import http_client
+from dead_letters import (DEAD_LETTERS_FILE, DEFAULT_RETRY_DELAY,
+                          DEFAULT_RETRY_PASSES, FAILURES, DeadLetterQueue)
+from journal import RunJournal, WRITTEN, EMPTY, FAILED
+from scrape import (DEFAULT_CONCURRENCY, get_subject_list,
+                    class_list_for_subject, source_params,
+                    gather_course_details, add_course_details,
+                    make_destination)
+from writers import OUTPUT_FORMATS, open_writer, source_label
+
+# Codes of all of the MinnState campuses, from the table in the README.
+CAMPUS_IDS = [
+    203, 202, 152, 70, 301, 304, 211, 163, 204, 310, 157, 144, 302, 411,
+    76, 305, 213, 142, 72, 71, 209, 156, 153, 303, 263, 205, 155, 308,
+    307, 306, 206, 309, 75, 73, 208, 147, 74,
+]
+
+
+def subject_lists(campus_ids, year_terms, workers=DEFAULT_CONCURRENCY):
+    """
+    Get the list of subjects for every campus and year/term.
+
+    Returns
+    -------
+    dict
+        Subjects keyed by ``(campus_id, year_term)``. Terms that are not
+        in the search form of a campus have no subjects, and neither do
+        those whose subjects could not be fetched.
+    """
+    keys = [(campus_id, year_term) for campus_id in campus_ids
+            for year_term in year_terms]
+
+    def subjects_for(key):
+        campus_id, year_term = key
+        url_params = dict(year_term=year_term, subject=None,
+                          course_id=None, campus_id=campus_id)
+        try:
+            return get_subject_list(url_params)
+        except FAILURES as error:
+            print(f'Could not get the subjects for campus {campus_id} in '
+                  f'{year_term}: {type(error).__name__}: {error}')
+            return []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(keys, executor.map(subjects_for, keys)))
+
+
+def unit_source(unit):
+    """
+    The source, in the journal and dead-letter queue of its campus, of a
+    unit of work: its ``(subject, year_term)``.
+    """
+    _, year_term, subject = unit
+    return (subject, year_term)
+
+
+def class_lists(units, workers=DEFAULT_CONCURRENCY, dead_letters=None):
+    """
+    Fetch the class list of every unit of work.
+
+    Parameters
+    ----------
+    units : list of tuple
+        ``(campus_id, year_term, subject)`` for each subject to scrape.
+    workers : int, optional
+        Number of class lists to fetch at once.
+    dead_letters : dict, optional
+        The ``dead_letters.DeadLetterQueue`` of each campus, keyed by
+        campus, where units that fail are recorded.
+
+    Returns
+    -------
+    list
+        The class list (a polars DataFrame) of each unit, in order, or
+        ``None`` where it could not be fetched or parsed.
+    """
+    def class_list(unit):
+        campus_id, year_term, subject = unit
+        print(f'    Listing {campus_id} {year_term} {subject}\r',
+              end='', flush=True)
+        url_params = dict(year_term=None, subject=None, course_id=None,
+                          campus_id=campus_id)
+        try:
+            return class_list_for_subject(
+                source_params(subject, url_params, year_term))
+        except FAILURES as error:
+            if dead_letters is not None:
+                dead_letters[campus_id].add(unit_source(unit), error)
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(class_list, units))
+
+
+def largest_first(units, data_dfs):
+    """
+    Order the units of work that have classes by their number of
+    classes, most first. Units of the same size keep their order.
+    """
+    work = [(unit, data_df) for unit, data_df in zip(units, data_dfs)
+            if data_df is not None and not data_df.is_empty()]
+    return sorted(work, key=lambda item: len(item[1]), reverse=True)
+
+
+async def _details_for_unit(index, unit, data_df, semaphore,
+                            dead_letters=None):
+    campus_id, year_term, subject = unit
+    url_params = dict(year_term=None, subject=None, course_id=None,
+                      campus_id=campus_id)
+    params = source_params(subject, url_params, year_term)
+    try:
+        size_infos, timestamps = await gather_course_details(
+            data_df, params, semaphore)
+    except FAILURES as error:
+        if dead_letters is not None:
+            dead_letters[campus_id].add(unit_source(unit), error)
+        return index, None, None
+    return index, size_infos, timestamps
+
+
+def fetch_details(work, concurrency=DEFAULT_CONCURRENCY, dead_letters=None):
+    """
+    Fetch the course details for every unit of work, with up to
+    ``concurrency`` requests in flight across all of them.
+
+    Requests are started in the order of ``work``, so putting the
+    largest units first gets them going first. Results are yielded as
+    each unit finishes.
+
+    Parameters
+    ----------
+    work : list
+        ``(unit, data_df)`` pairs, as returned by ``largest_first``.
+    concurrency : int, optional
+        Largest number of requests in flight at any one time.
+    dead_letters : dict, optional
+        The ``dead_letters.DeadLetterQueue`` of each campus, keyed by
+        campus, where units that fail are recorded.
+
+    Yields
+    ------
+    tuple
+        ``(unit, data_df, size_infos, timestamps)``; see
+        ``scrape.fetch_sources``. ``data_df`` is ``None`` if the unit
+        failed.
+    """
+    loop = asyncio.new_event_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+    tasks = []
+    try:
+        semaphore = asyncio.Semaphore(concurrency)
+        tasks = [loop.create_task(_details_for_unit(index, unit, data_df,
+                                                    semaphore, dead_letters))
+                 for index, (unit, data_df) in enumerate(work)]
+        pending = set(tasks)
+        while pending:
+            done, pending = loop.run_until_complete(
+                asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED))
+            for index, size_infos, timestamps in sorted(
+                    (task.result() for task in done),
+                    key=lambda result: result[0]):
+                unit, data_df = work[index]
+                if size_infos is None:
+                    data_df = None
+                yield unit, data_df, size_infos, timestamps
+    finally:
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks,
+                                               return_exceptions=True))
+        loop.run_until_complete(loop.shutdown_default_executor())
+        loop.close()
+
+
+def scrape_units(units, campuses, concurrency=DEFAULT_CONCURRENCY):
+    """
+    Fetch the class lists and then the course details of the units of
+    work, and write each unit out, and record it in the journal of its
+    campus, as soon as it is done. Units that fail are set aside in the
+    dead-letter queue of their campus, and those that failed before and
+    now work are marked as recovered.
+
+    Parameters
+    ----------
+    units : list of tuple
+        ``(campus_id, year_term, subject)`` for each subject to scrape.
+    campuses : dict
+        The ``writer``, ``journal`` and ``dead_letters`` of each campus,
+        keyed by campus.
+    concurrency : int, optional
+        Largest number of requests in flight at any one time.
+    """
+    dead_letters = {campus_id: campus['dead_letters']
+                    for campus_id, campus in campuses.items()}
+
+    def record(unit, status, rows=0):
+        campus = campuses[unit[0]]
+        campus['journal'].record(unit_source(unit), status, rows=rows)
+        if status != FAILED:
+            campus['dead_letters'].resolve(unit_source(unit))
+
+    print(f'Getting class lists for {len(units)} subjects...', flush=True)
+    data_dfs = class_lists(units, workers=concurrency,
+                           dead_letters=dead_letters)
+    for unit, data_df in zip(units, data_dfs):
+        if data_df is None:
+            record(unit, FAILED)
+        elif data_df.is_empty():
+            record(unit, EMPTY)
+    work = largest_first(units, data_dfs)
+
+    n_details = sum(len(data_df) for _, data_df in work)
+    print(f'\nGetting {n_details} course details for {len(work)} '
+          'subjects...', flush=True)
+    for unit, data_df, size_infos, timestamps in fetch_details(
+            work, concurrency=concurrency, dead_letters=dead_letters):
+        campus_id, year_term, subject = unit
+        print(f'{campus_id} {year_term} {subject} '
+              f'[{http_client.status()}]', end='', flush=True)
+        if data_df is None:
+            # The reason is in the dead-letter queue.
+            record(unit, FAILED)
+            print(' (Failed) .. ', end='', flush=True)
+            continue
+        data_df = add_course_details(data_df, size_infos, timestamps,
+                                     year_term)
+        campuses[campus_id]['writer'].write_batch(data_df,
+                                                  unit_source(unit))
+        record(unit, WRITTEN, rows=len(data_df))
+        print(' .. ', end='', flush=True)
+
+
+def open_campus(destination, journal, output_format, resume=False):
+    """
+    Return the ``writer``, ``journal`` and ``dead_letters`` of the
+    results directory of a campus, for ``scrape_units``.
+    """
+    resume_sources = journal.written_sources() if resume else None
+    writer = open_writer(destination, journal.settings['campus_id'],
+                         output_format=output_format,
+                         resume_sources=resume_sources)
+    if resume:
+        # Whatever did not survive in the output is fetched again.
+        lost = journal.keep_written(writer.sources())
+        if lost:
+            print(f'{destination}: {len(lost)} subjects were damaged or '
+                  'missing in the output and will be fetched again.')
+    dead_letters = DeadLetterQueue(Path(destination) / DEAD_LETTERS_FILE)
+    return dict(destination=destination, writer=writer, journal=journal,
+                dead_letters=dead_letters)
+
+
+def main(argv=None, prog=None):
+    """
+    Scrape several campuses and year/terms at once.
+
+    ``argv`` is the list of command line arguments, by default those of
+    the script, and ``prog`` the name to use in the usage message.
+    """
+    parser = argparse.ArgumentParser(prog=prog,
+                                     description='Scrape enrollment numbers '
+                                     'for several campuses and year/terms '
+                                     'at once')
+    parser.add_argument('--year-terms', action='store', nargs='+',
+                        metavar='YEAR_TERM',
+                        help='Codes for the year/terms, 5 digit numbers '
+                        'like 20155 (spring of 2015).')
+    parser.add_argument('--campus-ids', action='store', nargs='+', type=int,
+                        default=CAMPUS_IDS, metavar='CAMPUS_ID',
+                        help='Code numbers of the campuses. The default is '
+                        'every MinnState campus.')
+    parser.add_argument('--concurrency', action='store', type=int,
+                        default=DEFAULT_CONCURRENCY,
+                        help='Largest number of page requests to have in '
+                        'flight at once, across all campuses and terms.')
+    parser.add_argument('--output-format', action='store', default='csv',
+                        choices=sorted(OUTPUT_FORMATS),
+                        help='Format of the output of each campus; see '
+                        'scrape.py.')
+    parser.add_argument('--retry-passes', action='store', type=int,
+                        default=DEFAULT_RETRY_PASSES,
+                        help='Number of extra passes, at the end of the run, '
+                        'over the subjects that failed.')
+    parser.add_argument('--retry-delay', action='store', type=float,
+                        default=DEFAULT_RETRY_DELAY,
+                        help='Seconds to wait before the first retry pass; '
+                        'the wait doubles for each pass after that.')
+    parser.add_argument('--resume', action='store', nargs='+',
+                        metavar='RESULTS_DIR',
+                        help='Carry on with an interrupted run, given the '
+                        'results directories of its campuses, fetching only '
+                        'the subjects that were not finished.')
+    http_client.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.resume and args.year_terms:
+        raise RuntimeError('--resume carries on with the settings of the '
+                           'earlier run; do not give --year-terms')
+    elif not (args.resume or args.year_terms):
+        raise RuntimeError('Must use one of --year-terms and --resume')
+
+    http_client.configure_from_args(args, concurrency=args.concurrency)
+
+    campuses = {}
+    if args.resume:
+        for destination in args.resume:
+            journal = RunJournal.load(destination)
+            settings = journal.settings
+            campuses[settings['campus_id']] = open_campus(
+                destination, journal, settings['output_format'],
+                resume=True)
+    else:
+        print('Getting subject lists...', flush=True)
+        subjects = subject_lists(args.campus_ids, args.year_terms,
+                                 workers=args.concurrency)
+        for (campus_id, year_term), subject_list in subjects.items():
+            if not subject_list:
+                print(f'No subjects for campus {campus_id} in {year_term}')
+
+        # One results directory, with its journal, for each campus with
+        # any subjects, all named for the same time.
+        now = time.localtime()
+        for campus_id in args.campus_ids:
+            source_list = [(subject, year_term)
+                           for year_term in args.year_terms
+                           for subject in subjects[(campus_id, year_term)]]
+            if not source_list:
+                continue
+            destination = make_destination(campus_id, now=now)
+            settings = dict(year_terms=args.year_terms, campus_id=campus_id,
+                            output_format=args.output_format)
+            journal = RunJournal.create(destination, settings, source_list)
+            campuses[campus_id] = open_campus(destination, journal,
+                                              args.output_format)
+
+    def remaining(failed_only=False):
+        units = []
+        for campus_id, campus in campuses.items():
+            failed = set(campus['dead_letters'].failed())
+            sources = campus['journal'].remaining()
+            units.extend((campus_id, year_term, subject)
+                         for subject, year_term in sources
+                         if not failed_only
+                         or source_label((subject, year_term)) in failed)
+        return units
+
+    scrape_units(remaining(), campuses, concurrency=args.concurrency)
+
+    # Failures are tried again once everything else is done.
+    delay = args.retry_delay
+    for retry_pass in range(1, args.retry_passes + 1):
+        failed = remaining(failed_only=True)
+        if not failed:
+            break
+        print(f'\nRetry pass {retry_pass} of {args.retry_passes} for '
+              f'{len(failed)} subjects in {delay:g} s...')
+        time.sleep(delay)
+        scrape_units(failed, campuses, concurrency=args.concurrency)
+        delay *= 2
+
+    print(' Done.')
+    for campus_id, campus in campuses.items():
+        writer = campus['writer']
+        writer.close()
+        # Verify that the table wrote out correctly, using the manifest
+        # rather than reading the whole table back in, and checksumming
+        # it too if it was partly written by an earlier run.
+        if not writer.verify(checksum=bool(args.resume)):
+            raise RuntimeError(f'Enrollment data for campus {campus_id} '
+                               'did not properly write to disk!')
+        print(f'Campus {campus_id}: {writer.rows} courses in {writer.path}')
+
+    failed = remaining(failed_only=True)
+    if failed:
+        print(f'Could not recover {len(failed)} subjects; use --resume with '
+              'the results directories to try them again:')
+        for campus in campuses.values():
+            report = campus['dead_letters'].report()
+            if report:
+                print(f"  {campus['destination']}:")
+                print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,390 @@
+# A compact store for many scrapes of the same term.
+#
+# During registration the same term is scraped many times a day, and
+# from one run to the next almost everything stays the same: only a few
+# columns (enrollment, status) of a few rows change. Rather than keep a
+# full copy of every run, the store keeps, for each campus and term,
+#
+# + one base snapshot, the first run added, in full, and
+# + for every later run, a delta against the base: the rows of the run,
+#   in order, keyed on "ID #", with only the cells that differ from the
+#   base filled in.
+#
+# A delta has the columns "ID #", "timestamp" (which is different for
+# every row of every run, so it is always stored), a bit mask saying
+# which of the other columns differ from the base, and those columns,
+# null wherever the value is the same as in the base. Columns that
+# rarely change are then almost entirely null and take next to no room
+# in Parquet. Rows that are new since the base have every bit set, and
+# rows that have gone are simply not in the delta.
+#
+# Because every delta is against the base, rebuilding any snapshot takes
+# one join, and following one course through every snapshot only reads
+# that course's rows.
+#
+# The layout is
+#
+#   <store>/<campus_id>/<year_term>/snapshots.json
+#   <store>/<campus_id>/<year_term>/base.parquet
+#   <store>/<campus_id>/<year_term>/delta-00001.parquet
+#   ...
+
+import json
+import argparse
+from pathlib import Path
+
+import polars as pl
+
+from writers import (TIMESTAMP_COLUMN, YEAR_TERM_COLUMN, read_dataset,
+                     OUTPUT_FORMATS, has_output)
+
+# The column the rows of a snapshot are matched on.
+KEY_COLUMN = 'ID #'
+
+# Names of the files in the directory for each campus and term.
+INDEX_FILE = 'snapshots.json'
+BASE_FILE = 'base.parquet'
+DELTA_FILE = 'delta-{:05d}.parquet'
+
+# Extra columns used in the deltas. _occurrence tells apart rows that
+# share an ID #, should there ever be any.
+CHANGED_COLUMN = '_changed'
+OCCURRENCE_COLUMN = '_occurrence'
+
+# Largest number of columns, besides the key and timestamp, the bit
+# mask can cover.
+MAX_DATA_COLUMNS = 62
+
+
+def read_results(results_dir):
+    """
+    Read the output of a scrape.py run, in either format, with every
+    column a string except the timestamp. A run that wrote no rows gives
+    an empty DataFrame.
+    """
+    results_dir = Path(results_dir)
+    csv_path = results_dir / ('all_enrollments' + OUTPUT_FORMATS['csv'])
+    if csv_path.exists():
+        if csv_path.stat().st_size == 0:
+            # Nothing at all is written until the first batch.
+            return pl.DataFrame()
+        data_df = pl.read_csv(csv_path, infer_schema_length=0)
+    else:
+        data_df = read_dataset(results_dir / 'all_enrollments')
+    return data_df.with_columns([
+        pl.col(col).cast(pl.Float64) if col == TIMESTAMP_COLUMN
+        else pl.col(col).cast(pl.Utf8)
+        for col in data_df.columns
+    ])
+
+
+def _with_occurrence(data_df):
+    return data_df.with_columns(
+        pl.col(KEY_COLUMN).cum_count().over(KEY_COLUMN)
+        .alias(OCCURRENCE_COLUMN)
+    )
+
+
+def _bit(i):
+    """
+    Expression that is true where bit ``i`` of the change mask is set.
+    """
+    return (pl.col(CHANGED_COLUMN) // (1 << i)) % 2 == 1
+
+
+class SnapshotStore:
+    """
+    Base snapshots and deltas for many runs, one set per campus and
+    year/term.
+
+    Parameters
+    ----------
+    root : str or Path
+        Directory of the store. It is created if necessary.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def term_dir(self, campus_id, year_term):
+        return self.root / str(campus_id) / str(year_term)
+
+    def snapshots(self, campus_id, year_term):
+        """
+        Return the index of the snapshots of a term: a dict with the
+        ``columns`` of the table and a list of ``snapshots``, each with
+        its number, label, file, number of rows and time of the first
+        row.
+        """
+        index_path = self.term_dir(campus_id, year_term) / INDEX_FILE
+        if not index_path.exists():
+            return dict(columns=None, snapshots=[])
+        with open(index_path) as f:
+            return json.load(f)
+
+    def added(self, campus_id):
+        """
+        Return the set of results directories, as resolved paths, that
+        have been added to the store for a campus.
+        """
+        paths = set()
+        for index_path in (self.root / str(campus_id)).glob(
+                f'*/{INDEX_FILE}'):
+            with open(index_path) as f:
+                paths.update(entry.get('path') for entry
+                             in json.load(f)['snapshots'])
+        paths.discard(None)
+        return paths
+
+    def _write_index(self, campus_id, year_term, index):
+        index_path = self.term_dir(campus_id, year_term) / INDEX_FILE
+        tmp_path = index_path.with_name(index_path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f, indent=2)
+        tmp_path.replace(index_path)
+
+    def add(self, data_df, campus_id, label, path=None):
+        """
+        Add the output of one run to the store.
+
+        Parameters
+        ----------
+        data_df : polars DataFrame
+            The output of the run, as read by ``read_results``. If it
+            covers several year/terms, each goes to its own snapshots.
+        campus_id : int
+            The campus the run was for.
+        label : str
+            Name for the snapshot, usually the name of the results
+            directory.
+        path : str, optional
+            The resolved path of the results directory, recorded so that
+            the run is not added again; see ``added``.
+
+        Returns
+        -------
+        list of dict
+            The index entry of each snapshot added.
+        """
+        entries = []
+        year_terms = data_df[YEAR_TERM_COLUMN].unique(maintain_order=True)
+        for year_term in year_terms:
+            term_df = data_df.filter(pl.col(YEAR_TERM_COLUMN) == year_term)
+            entries.append(self._add_term(term_df, campus_id, year_term,
+                                          label, path))
+        return entries
+
+    def _add_term(self, term_df, campus_id, year_term, label, path):
+        term_dir = self.term_dir(campus_id, year_term)
+        term_dir.mkdir(parents=True, exist_ok=True)
+        index = self.snapshots(campus_id, year_term)
+        number = len(index['snapshots'])
+
+        if number == 0:
+            data_columns = [col for col in term_df.columns
+                            if col not in (KEY_COLUMN, TIMESTAMP_COLUMN)]
+            if len(data_columns) > MAX_DATA_COLUMNS:
+                raise ValueError('Too many columns for a snapshot store')
+            index['columns'] = term_df.columns
+            file_name = BASE_FILE
+            term_df.write_parquet(term_dir / file_name,
+                                  compression='zstd')
+        else:
+            if term_df.columns != index['columns']:
+                raise ValueError('Columns of {} do not match those of the '
+                                 'earlier snapshots of {} for campus '
+                                 '{}'.format(label, year_term, campus_id))
+            file_name = DELTA_FILE.format(number)
+            delta = self._delta(term_df, term_dir, index['columns'])
+            delta.write_parquet(term_dir / file_name, compression='zstd')
+
+        entry = dict(number=number, label=label, path=path, file=file_name,
+                     rows=len(term_df),
+                     first_timestamp=term_df[TIMESTAMP_COLUMN].min())
+        index['snapshots'].append(entry)
+        self._write_index(campus_id, year_term, index)
+        return entry
+
+    def _delta(self, term_df, term_dir, columns):
+        """
+        Return the delta of ``term_df`` against the base snapshot.
+        """
+        data_columns = [col for col in columns
+                        if col not in (KEY_COLUMN, TIMESTAMP_COLUMN)]
+        base = _with_occurrence(pl.read_parquet(term_dir / BASE_FILE)
+                                .drop(TIMESTAMP_COLUMN))
+        base = base.rename({col: col + '_base' for col in data_columns})
+        base = base.with_columns(pl.lit(True).alias('_in_base'))
+
+        joined = _with_occurrence(term_df).join(
+            base, on=[KEY_COLUMN, OCCURRENCE_COLUMN], how='left',
+            maintain_order='left')
+
+        new_row = pl.col('_in_base').is_null()
+        changed = [new_row | ~pl.col(col).eq_missing(pl.col(col + '_base'))
+                   for col in data_columns]
+        mask = pl.sum_horizontal([flag.cast(pl.Int64) * (1 << i)
+                                  for i, flag in enumerate(changed)])
+        return joined.select(
+            [pl.col(KEY_COLUMN), pl.col(TIMESTAMP_COLUMN),
+             mask.alias(CHANGED_COLUMN)]
+            + [pl.when(flag).then(pl.col(col)).otherwise(None).alias(col)
+               for col, flag in zip(data_columns, changed)]
+        )
+
+    def rebuild(self, campus_id, year_term, number=-1):
+        """
+        Rebuild a snapshot exactly as the run wrote it.
+
+        Parameters
+        ----------
+        campus_id : int
+            The campus.
+        year_term : str
+            The year/term.
+        number : int, optional
+            The number of the snapshot; negative numbers count back from
+            the latest.
+
+        Returns
+        -------
+        polars DataFrame
+            The table of the run, with every column a string except the
+            timestamp.
+        """
+        index = self.snapshots(campus_id, year_term)
+        entry = index['snapshots'][number]
+        term_dir = self.term_dir(campus_id, year_term)
+        base = pl.read_parquet(term_dir / BASE_FILE)
+        if entry['number'] == 0:
+            return base
+        delta = pl.read_parquet(term_dir / entry['file'])
+        return _apply_delta(delta, base, index['columns'])
+
+    def history(self, campus_id, year_term, course_id,
+                columns=('Enrolled:', 'Size:', 'Status')):
+        """
+        Follow one course through every snapshot of a term.
+
+        Only the rows for the course are read from each snapshot.
+
+        Returns
+        -------
+        polars DataFrame
+            One row per snapshot the course is in, with the snapshot
+            number and label, the timestamp and the chosen columns.
+        """
+        index = self.snapshots(campus_id, year_term)
+        term_dir = self.term_dir(campus_id, year_term)
+        course = pl.col(KEY_COLUMN) == str(course_id)
+
+        base = pl.scan_parquet(term_dir / BASE_FILE).filter(course).collect()
+        frames = []
+        for entry in index['snapshots']:
+            if entry['number'] == 0:
+                found = base
+            else:
+                delta = (pl.scan_parquet(term_dir / entry['file'])
+                         .filter(course).collect())
+                found = _apply_delta(delta, base, index['columns'])
+            frames.append(found.select(
+                [pl.lit(entry['number']).alias('snapshot'),
+                 pl.lit(entry['label']).alias('label'),
+                 pl.col(KEY_COLUMN), pl.col(TIMESTAMP_COLUMN)]
+                + list(columns)))
+        return pl.concat(frames)
+
+
+def _apply_delta(delta, base, columns):
+    """
+    Fill in the cells of a delta that are the same as in the base.
+    """
+    data_columns = [col for col in columns
+                    if col not in (KEY_COLUMN, TIMESTAMP_COLUMN)]
+    base = _with_occurrence(base.drop(TIMESTAMP_COLUMN))
+    base = base.rename({col: col + '_base' for col in data_columns})
+    joined = _with_occurrence(delta).join(
+        base, on=[KEY_COLUMN, OCCURRENCE_COLUMN], how='left',
+        maintain_order='left')
+    selected = []
+    for col in columns:
+        if col in data_columns:
+            i = data_columns.index(col)
+            selected.append(pl.when(_bit(i)).then(pl.col(col))
+                            .otherwise(pl.col(col + '_base')).alias(col))
+        else:
+            selected.append(pl.col(col))
+    return joined.select(selected)
+
+
+def main(argv=None, prog=None):
+    """
+    Add runs to a snapshot store, or read them back.
+
+    ``argv`` is the list of command line arguments, by default those of
+    the script, and ``prog`` the name to use in the usage message.
+    """
+    parser = argparse.ArgumentParser(prog=prog,
+                                     description='Keep scrape.py results '
+                                     'as base snapshots and deltas')
+    parser.add_argument('store', help='Directory of the snapshot store.')
+    parser.add_argument('--campus-id', action='store', type=int,
+                        default='72',
+                        help='Two digit code number for the campus.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    add_parser = commands.add_parser('add', help='Add the results of runs.')
+    add_parser.add_argument('results_dirs', nargs='+',
+                            help='Results directories of scrape.py runs, '
+                            'oldest first.')
+
+    rebuild_parser = commands.add_parser(
+        'rebuild', help='Write a snapshot out as all_enrollments.csv.')
+    rebuild_parser.add_argument('--year-term', action='store',
+                                required=True)
+    rebuild_parser.add_argument('--snapshot', action='store', type=int,
+                                default=-1,
+                                help='Snapshot number; the default is the '
+                                'latest.')
+    rebuild_parser.add_argument('csv', help='CSV file to write.')
+
+    history_parser = commands.add_parser(
+        'history', help='Show one course in every snapshot.')
+    history_parser.add_argument('--year-term', action='store',
+                                required=True)
+    history_parser.add_argument('--course-id', action='store',
+                                required=True)
+
+    args = parser.parse_args(argv)
+    store = SnapshotStore(args.store)
+
+    if args.command == 'add':
+        added = store.added(args.campus_id)
+        for results_dir in args.results_dirs:
+            path = str(Path(results_dir).resolve())
+            label = Path(path).name
+            if path in added:
+                print(f'{label}: already in the store, skipped')
+                continue
+            if not has_output(results_dir):
+                print(f'{label}: no results, skipped')
+                continue
+            data_df = read_results(results_dir)
+            if data_df.is_empty():
+                print(f'{label}: no rows, skipped')
+                continue
+            for entry in store.add(data_df, args.campus_id, label, path):
+                print(f'{label}: snapshot {entry["number"]}, '
+                      f'{entry["rows"]} rows')
+            added.add(path)
+    elif args.command == 'rebuild':
+        store.rebuild(args.campus_id, args.year_term,
+                      args.snapshot).write_csv(args.csv)
+    else:
+        with pl.Config(tbl_rows=-1):
+            print(store.history(args.campus_id, args.year_term,
+                                args.course_id))
+
+
+if __name__ == '__main__':
+    main()
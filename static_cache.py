@@ -0,0 +1,134 @@
+# Persistent cache of the parts of the course detail that do not change
+# during a term (tuition, tuition unit, LASC/WI, 18online and course
+# level), so that repeat scrapes of a term only need to pick the
+# enrollment numbers out of each detail page.
+#
+# An entry is used only if all of these hold:
+#
+# + it is younger than the maximum age (a week by default),
+# + the row for the course in the subject search results, leaving out
+#   the columns that change with enrollment, is the same as when the
+#   entry was made, since an edit to the course shows up there, and
+# + the cache is not being refreshed.
+#
+# Otherwise the whole detail page is parsed and the entry replaced. The
+# entries for each campus and term are kept in a JSON file,
+#
+#   <cache dir>/<campus_id>/<year_term>.json
+
+import os
+import json
+import time
+import hashlib
+import threading
+from pathlib import Path
+
+import metrics
+
+# Default largest age of an entry, in seconds.
+DEFAULT_MAX_AGE = 7 * 24 * 60 * 60
+
+# Columns of the search results that change along with the enrollment,
+# and so are left out of the signature of a course.
+VOLATILE_SEARCH_COLUMNS = ('Status',)
+
+
+def row_signature(row):
+    """
+    Return a short string that changes whenever the non-volatile
+    columns of a course's search results row change.
+
+    Parameters
+    ----------
+    row : dict
+        The search results row, keyed by column name.
+    """
+    stable = {k: v for k, v in row.items()
+              if k not in VOLATILE_SEARCH_COLUMNS}
+    encoded = json.dumps(stable, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(encoded).hexdigest()
+
+
+class StaticAttributeCache:
+    """
+    Cache of static course attributes keyed by campus, year/term and
+    course ID. It is safe to use from several threads.
+
+    Parameters
+    ----------
+    directory : str or Path
+        Where the cache is kept. It is created if necessary.
+    max_age : float, optional
+        Largest age, in seconds, of an entry that is used.
+    refresh : bool, optional
+        If ``True`` no entry is used, but new ones are still saved.
+    """
+
+    def __init__(self, directory, max_age=DEFAULT_MAX_AGE, refresh=False):
+        self.directory = Path(directory)
+        self.max_age = max_age
+        self.refresh = refresh
+        self._terms = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def _path(self, campus_id, year_term):
+        return self.directory / str(campus_id) / f'{year_term}.json'
+
+    def _entries(self, campus_id, year_term):
+        # Call with the lock held.
+        key = (str(campus_id), str(year_term))
+        if key not in self._terms:
+            path = self._path(*key)
+            if path.exists():
+                with open(path) as f:
+                    self._terms[key] = json.load(f)
+            else:
+                self._terms[key] = {}
+        return self._terms[key]
+
+    def lookup(self, campus_id, year_term, course_id, signature):
+        """
+        Return the cached attributes of a course, or ``None`` if there
+        are none that can be used.
+        """
+        with self._lock:
+            entry = self._entries(campus_id, year_term).get(course_id)
+        if entry is None:
+            result = 'miss'
+        elif self.refresh:
+            result = 'refresh'
+        elif time.time() - entry['cached'] > self.max_age:
+            result = 'expired'
+        elif entry['signature'] != signature:
+            result = 'changed'
+        else:
+            result = 'hit'
+        metrics.increment('static_cache_total', result=result)
+        return entry['attributes'] if result == 'hit' else None
+
+    def store(self, campus_id, year_term, course_id, signature, attributes):
+        """
+        Save the static attributes of a course.
+        """
+        entry = dict(signature=signature, cached=time.time(),
+                     attributes=attributes)
+        with self._lock:
+            self._entries(campus_id, year_term)[course_id] = entry
+            self._dirty.add((str(campus_id), str(year_term)))
+
+    def save(self):
+        """
+        Write out the entries of every term that has changed.
+        """
+        with self._lock:
+            for key in sorted(self._dirty):
+                path = self._path(*key)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                # Several workers of a sharded run may share the cache,
+                # so each writes its own temporary file.
+                tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+                with open(tmp_path, 'w') as f:
+                    json.dump(self._terms[key], f)
+                tmp_path.replace(path)
+            self._dirty.clear()
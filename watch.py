@@ -0,0 +1,504 @@
+# Watch a term during registration, polling the sections whose
+# enrollment is most likely to change most often, instead of scraping
+# the whole term again and again.
+#
+# A watch starts with a full scrape of the term, written to the usual
+# results directory (see scrape.make_destination). After that each
+# section's detail page is polled on its own schedule: sections that are
+# nearly full, or whose enrollment changed recently, are polled every
+# --min-interval seconds, while nearly empty sections that have not
+# changed for a long time are polled only every --max-interval seconds.
+# Only the enrollment is read from the page, since nothing else on it
+# changes during a term. Every change is appended to updates.csv in the
+# results directory as soon as it is seen. Subjects whose initial scrape
+# fails are set aside in the dead-letter queue and tried again, as in
+# scrape.py.
+#
+# The subject searches are run again every --relist-interval seconds to
+# pick up sections that have been added or cancelled. All of the
+# requests go through the one pooled session of http_client, so its
+# connections to the site stay open for the whole watch.
+
+import csv
+import time
+import heapq
+import random
+import argparse
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import http_client
+import metrics
+from scrape import (DEFAULT_CONCURRENCY, SIZE_KEYS, get_subject_list,
+                    class_list_for_subject, source_params, course_detail,
+                    fetch_sources, add_course_details, make_destination,
+                    link_latest)
+from dead_letters import (DEAD_LETTERS_FILE, DEFAULT_RETRY_DELAY,
+                          DEFAULT_RETRY_PASSES, DeadLetterQueue)
+from writers import OUTPUT_FORMATS, open_writer
+
+# Default shortest and longest times, in seconds, between polls of a
+# section.
+DEFAULT_MIN_INTERVAL = 60
+DEFAULT_MAX_INTERVAL = 30 * 60
+
+# Time, in seconds, over which the effect of a change in enrollment on
+# how often a section is polled falls by half.
+RECENT_CHANGE_HALF_LIFE = 10 * 60
+
+# Default time, in seconds, between runs of the subject searches.
+DEFAULT_RELIST_INTERVAL = 30 * 60
+
+# Name and columns of the file of changes, in the results directory.
+UPDATES_FILE = 'updates.csv'
+UPDATE_COLUMNS = ['ID #', 'Subj', '#', 'Sec', 'Size:', 'Enrolled:',
+                  'timestamp', 'year_term']
+
+# Columns of the class list kept for each section, for the updates.
+SECTION_COLUMNS = ['ID #', 'Subj', '#', 'Sec']
+
+
+def poll_interval(enrolled, size, since_change=None,
+                  min_interval=DEFAULT_MIN_INTERVAL,
+                  max_interval=DEFAULT_MAX_INTERVAL):
+    """
+    Return how long to wait, in seconds, before polling a section again.
+
+    The wait goes from ``max_interval`` for an empty section that has
+    never changed down to ``min_interval`` for one that is full or has
+    just changed.
+
+    Parameters
+    ----------
+    enrolled, size : int
+        The enrollment and size of the section.
+    since_change : float, optional
+        Seconds since the enrollment last changed, or ``None`` if it has
+        not changed since the watch started.
+    min_interval, max_interval : float, optional
+        Shortest and longest wait.
+    """
+    if size > 0:
+        fullness = min(max(enrolled / size, 0), 1)
+    else:
+        fullness = 1
+    if since_change is None:
+        recency = 0
+    else:
+        recency = 0.5 ** (since_change / RECENT_CHANGE_HALF_LIFE)
+    # Squaring the fullness keeps most of the polling for the sections
+    # that are close to full.
+    urgency = max(fullness ** 2, recency)
+    return max_interval - (max_interval - min_interval) * urgency
+
+
+class TermWatch:
+    """
+    The sections of one campus and year/term being watched, and when
+    each is next due to be polled.
+
+    Parameters
+    ----------
+    url_params : dict
+        Dictionary of parameters for substitution in URLs, with the
+        campus and year/term filled in.
+    updates_path : str or Path
+        CSV file the changes are appended to.
+    min_interval, max_interval : float, optional
+        Shortest and longest time between polls of a section; see
+        ``poll_interval``.
+    """
+
+    def __init__(self, url_params, updates_path,
+                 min_interval=DEFAULT_MIN_INTERVAL,
+                 max_interval=DEFAULT_MAX_INTERVAL):
+        self.url_params = url_params
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.sections = {}
+        self.polls = 0
+        self.changes = 0
+        # Heap of (due time, course ID). Sections that are rescheduled or
+        # dropped leave stale entries behind, which are skipped.
+        self._queue = []
+        self._file = open(updates_path, 'w', newline='')
+        self._updates = csv.writer(self._file, lineterminator='\n')
+        self._updates.writerow(UPDATE_COLUMNS)
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def add(self, subject, data_df, size_infos=None, now=None):
+        """
+        Start watching the sections in a class list.
+
+        Parameters
+        ----------
+        subject : str
+            The subject of the class list.
+        data_df : polars DataFrame
+            The class list.
+        size_infos : list of dict, optional
+            The result of ``course_detail`` for each row, if the detail
+            pages have already been read and written out. If not, each
+            section is polled as soon as possible and written out as a
+            change.
+        now : float, optional
+            The current time.
+        """
+        now = now or time.time()
+        params = source_params(subject, self.url_params,
+                               self.url_params['year_term'])
+        rows = data_df.select(SECTION_COLUMNS).iter_rows(named=True)
+        for i, row in enumerate(rows):
+            course_id = row['ID #']
+            section = dict(params=dict(params, course_id=course_id),
+                           row=row, static=None, enrolled=None, size=None,
+                           changed=None, due=now)
+            self.sections[course_id] = section
+            if size_infos is None:
+                heapq.heappush(self._queue, (now, course_id))
+                continue
+            size_info = size_infos[i]
+            if size_info[SIZE_KEYS[0]] != -1:
+                section['static'] = _static_attributes(size_info)
+                section['enrolled'] = size_info['Enrolled:']
+                section['size'] = size_info['Size:']
+            self._schedule(course_id, now)
+
+    def drop(self, course_ids):
+        """
+        Stop watching the given sections.
+        """
+        for course_id in course_ids:
+            self.sections.pop(course_id, None)
+
+    def _schedule(self, course_id, now):
+        section = self.sections[course_id]
+        if section['enrolled'] is None:
+            # The page could not be read; try again, but not soon.
+            interval = self.max_interval
+        else:
+            since_change = None
+            if section['changed'] is not None:
+                since_change = now - section['changed']
+            interval = poll_interval(section['enrolled'], section['size'],
+                                     since_change, self.min_interval,
+                                     self.max_interval)
+        # A little randomness keeps sections that were added together
+        # from all coming due at the same moment.
+        section['due'] = now + interval * random.uniform(0.8, 1)
+        heapq.heappush(self._queue, (section['due'], course_id))
+
+    def next_due(self):
+        """
+        Return the time the next section is due, or ``None`` if there
+        are no sections.
+        """
+        while self._queue:
+            due, course_id = self._queue[0]
+            section = self.sections.get(course_id)
+            if section is not None and section['due'] == due:
+                return due
+            heapq.heappop(self._queue)
+        return None
+
+    def due(self, now, limit):
+        """
+        Return the IDs of up to ``limit`` sections due to be polled by
+        ``now``, most overdue first.
+        """
+        course_ids = []
+        while len(course_ids) < limit:
+            due = self.next_due()
+            if due is None or due > now:
+                break
+            course_ids.append(heapq.heappop(self._queue)[1])
+        return course_ids
+
+    def poll(self, course_id):
+        """
+        Fetch the enrollment of a section. Runs in a worker thread.
+
+        Returns
+        -------
+        size_info : dict or None
+            See ``scrape.course_detail``, or ``None`` if the page could
+            not be fetched or read.
+        timestamp : float
+            The time the page arrived.
+        """
+        section = self.sections[course_id]
+        try:
+            size_info = course_detail(section['params'], section['static'])
+        except (requests.exceptions.RequestException, RuntimeError,
+                ValueError):
+            size_info = None
+        return size_info, time.time()
+
+    def record(self, course_id, size_info, timestamp):
+        """
+        Take in the result of ``poll``, write out any change and
+        schedule the next poll. Returns whether the enrollment changed.
+        """
+        section = self.sections.get(course_id)
+        if section is None:
+            # Dropped while it was being polled.
+            return False
+        self.polls += 1
+        if size_info is None or size_info[SIZE_KEYS[0]] == -1:
+            metrics.increment('watch_polls_total', result='error')
+            changed = False
+        else:
+            changed = self._update(section, size_info, timestamp)
+            metrics.increment('watch_polls_total',
+                              result='changed' if changed else 'same')
+        self._schedule(course_id, timestamp)
+        return changed
+
+    def _update(self, section, size_info, timestamp):
+        """
+        Store a successful read of a section and, if the enrollment or
+        size changed, write it out. Returns whether it changed.
+        """
+        if section['static'] is None:
+            section['static'] = _static_attributes(size_info)
+        enrolled, size = size_info['Enrolled:'], size_info['Size:']
+        if (enrolled, size) == (section['enrolled'], section['size']):
+            return False
+
+        section['enrolled'], section['size'] = enrolled, size
+        section['changed'] = timestamp
+        self.changes += 1
+        row = section['row']
+        self._updates.writerow([row['ID #'], row['Subj'], row['#'],
+                                row['Sec'], size, enrolled, timestamp,
+                                self.url_params['year_term']])
+        self._file.flush()
+        return True
+
+
+def _static_attributes(size_info):
+    return {k: v for k, v in size_info.items() if k not in SIZE_KEYS}
+
+
+def relist(watch, subjects, executor):
+    """
+    Run the subject searches again, start watching any new sections and
+    stop watching those that are gone.
+
+    Returns
+    -------
+    added, dropped : int
+        The number of sections added and dropped.
+    """
+    params = [source_params(subject, watch.url_params,
+                            watch.url_params['year_term'])
+              for subject in subjects]
+
+    def class_list(subject_params):
+        try:
+            return class_list_for_subject(subject_params)
+        except (IndexError, requests.exceptions.RequestException):
+            return None
+
+    listed = set()
+    added = 0
+    for subject, data_df in zip(subjects, executor.map(class_list, params)):
+        if data_df is None:
+            # Keep the sections of a subject whose search failed.
+            listed.update(course_id for course_id, section
+                          in watch.sections.items()
+                          if section['params']['subject'] == subject)
+            continue
+        if data_df.is_empty():
+            continue
+        course_ids = data_df['ID #'].to_list()
+        listed.update(course_ids)
+        new = data_df.filter(~data_df['ID #'].is_in(list(watch.sections)))
+        if not new.is_empty():
+            watch.add(subject, new)
+            added += len(new)
+
+    gone = [course_id for course_id in watch.sections
+            if course_id not in listed]
+    watch.drop(gone)
+    return added, len(gone)
+
+
+def run(watch, subjects, concurrency=DEFAULT_CONCURRENCY,
+        relist_interval=DEFAULT_RELIST_INTERVAL, duration=None):
+    """
+    Poll the sections as they come due, and run the subject searches
+    again every ``relist_interval`` seconds, until ``duration`` seconds
+    have passed or forever if it is ``None``.
+    """
+    start = time.time()
+    end = None if duration is None else start + duration
+    next_relist = start + relist_interval
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while end is None or time.time() < end:
+            now = time.time()
+            if now >= next_relist:
+                added, dropped = relist(watch, subjects, executor)
+                print(f"\nRelisted: {added} sections added, {dropped} "
+                      "dropped.")
+                next_relist = now + relist_interval
+
+            # Taking only a couple of rounds of requests at a time lets
+            # a busy section that comes due meanwhile go ahead of the
+            # rest of a large batch.
+            course_ids = watch.due(now, 2 * concurrency)
+            if not course_ids:
+                wake = min(t for t in (watch.next_due(), next_relist, end)
+                           if t is not None)
+                time.sleep(max(0, wake - time.time()))
+                continue
+
+            results = executor.map(watch.poll, course_ids)
+            for course_id, (size_info, timestamp) in zip(course_ids,
+                                                         results):
+                watch.record(course_id, size_info, timestamp)
+            print(f"\r{watch.polls} polls, {watch.changes} changes, "
+                  f"{len(watch.sections)} sections "
+                  f"[{http_client.status()}]", end="", flush=True)
+
+
+def scrape_subjects(subjects, writer, watch, url_params, dead_letters,
+                    concurrency=DEFAULT_CONCURRENCY):
+    """
+    Scrape the subjects in full, as scrape.py does, writing each one out
+    and starting to watch its sections. Subjects that fail are set aside
+    in the dead-letter queue, and those that failed before and now work
+    are marked as recovered.
+    """
+    year_term = url_params['year_term']
+    for source, data_df, size_infos, timestamps in fetch_sources(
+            subjects, url_params, year_term=year_term,
+            concurrency=concurrency, dead_letters=dead_letters):
+        if data_df is None:
+            # The reason is in the dead-letter queue.
+            continue
+        if not data_df.is_empty():
+            writer.write_batch(add_course_details(data_df, size_infos,
+                                                  timestamps, year_term),
+                               source)
+            watch.add(source, data_df, size_infos)
+        dead_letters.resolve(source)
+
+
+def main(argv=None, prog=None):
+    """
+    Scrape a term and then watch it for changes in enrollment.
+
+    ``argv`` is the list of command line arguments, by default those of
+    the script, and ``prog`` the name to use in the usage message.
+    """
+    parser = argparse.ArgumentParser(prog=prog,
+                                     description='Scrape a term and keep '
+                                     'polling its sections for changes in '
+                                     'enrollment, the fullest and most '
+                                     'active most often')
+    parser.add_argument('--year-term', action='store', required=True,
+                        help='Code for year/term, a 5 digit number like '
+                        '20155 (spring of 2015).')
+    parser.add_argument('--campus-id', action='store', type=int,
+                        default='72',
+                        help='Two digit code number for the campus.')
+    parser.add_argument('--concurrency', action='store', type=int,
+                        default=DEFAULT_CONCURRENCY,
+                        help='Largest number of page requests to have in '
+                        'flight at once.')
+    parser.add_argument('--min-interval', action='store', type=float,
+                        default=DEFAULT_MIN_INTERVAL,
+                        help='Seconds between polls of a section that is '
+                        'full or has just changed.')
+    parser.add_argument('--max-interval', action='store', type=float,
+                        default=DEFAULT_MAX_INTERVAL,
+                        help='Seconds between polls of an empty section '
+                        'that has not changed.')
+    parser.add_argument('--relist-interval', action='store', type=float,
+                        default=DEFAULT_RELIST_INTERVAL,
+                        help='Seconds between runs of the subject searches, '
+                        'to find added and cancelled sections.')
+    parser.add_argument('--duration', action='store', type=float,
+                        help='Stop after this many seconds. The default is '
+                        'to watch until interrupted.')
+    parser.add_argument('--output-format', action='store', default='csv',
+                        choices=sorted(OUTPUT_FORMATS),
+                        help='Format of the initial scrape; see scrape.py. '
+                        'The updates are always CSV.')
+    parser.add_argument('--retry-passes', action='store', type=int,
+                        default=DEFAULT_RETRY_PASSES,
+                        help='Number of extra passes, at the end of the '
+                        'initial scrape, over the subjects that failed.')
+    parser.add_argument('--retry-delay', action='store', type=float,
+                        default=DEFAULT_RETRY_DELAY,
+                        help='Seconds to wait before the first retry pass; '
+                        'the wait doubles for each pass after that.')
+    http_client.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    http_client.configure_from_args(args, concurrency=args.concurrency)
+
+    url_params = dict(year_term=args.year_term, subject=None,
+                      course_id=None, campus_id=args.campus_id)
+    subjects = get_subject_list(url_params)
+    if not subjects:
+        raise RuntimeError(f'No data found for {url_params}')
+
+    destination = make_destination(args.campus_id)
+    watch = TermWatch(url_params, Path(destination) / UPDATES_FILE,
+                      min_interval=args.min_interval,
+                      max_interval=args.max_interval)
+
+    # The initial scrape, exactly as scrape.py would do it.
+    print(f"Scraping {len(subjects)} subjects...")
+    writer = open_writer(destination, args.campus_id,
+                         output_format=args.output_format)
+    dead_letters = DeadLetterQueue(Path(destination) / DEAD_LETTERS_FILE)
+    scrape_subjects(subjects, writer, watch, url_params, dead_letters,
+                    concurrency=args.concurrency)
+
+    # Failures are tried again once everything else is done.
+    delay = args.retry_delay
+    for retry_pass in range(1, args.retry_passes + 1):
+        failed = set(dead_letters.failed())
+        if not failed:
+            break
+        print(f"Retry pass {retry_pass} of {args.retry_passes} for "
+              f"{len(failed)} subjects in {delay:g} s...")
+        time.sleep(delay)
+        scrape_subjects([subject for subject in subjects
+                         if subject in failed],
+                        writer, watch, url_params, dead_letters,
+                        concurrency=args.concurrency)
+        delay *= 2
+    writer.close()
+    link_latest(destination)
+    print(f"Wrote {writer.rows} sections to {destination}; watching for "
+          f"changes, written to {UPDATES_FILE}.")
+    failed = dead_letters.failed()
+    if failed:
+        print(f"Could not recover {len(failed)} subjects, listed in "
+              f"{dead_letters.path}; they are watched once a run of the "
+              "subject searches finds them:")
+        print(dead_letters.report())
+
+    try:
+        run(watch, subjects, concurrency=args.concurrency,
+            relist_interval=args.relist_interval, duration=args.duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watch.close()
+        metrics.write(Path(destination) / metrics.JSON_FILE)
+    print(f"\nStopped after {watch.polls} polls and {watch.changes} "
+          "changes.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,430 @@
+# A queue of work shared by several scrape.py or get_cids.py processes,
+# on one machine or on several machines sharing a filesystem, so that a
+# system-wide or historical backfill is not limited to what one machine
+# can politely fetch.
+#
+# The sources of a run (subjects, course ID/year_term pairs or CIDs to
+# probe) are split into units of work when the queue is made. A worker
+# claims a unit by creating its lock file, which only one process can
+# do, and keeps the claim alive by touching the file while it works. A
+# lock file that has not been touched for stale_after seconds belongs to
+# a worker that died, and the unit is claimed again by someone else.
+# Each attempt at a unit writes to a directory of its own, and the unit
+# is finished once a record naming the attempt is in done/; a worker
+# whose claim was taken over in the meantime throws its work away. Once
+# every unit is finished, one of the workers merges the shards into the
+# usual output.
+#
+# The queue directory holds
+#
+#   queue.json                  the settings and the sources of each unit
+#   claims/<unit>.lock          the attempt working on a unit
+#   done/<unit>.json            the attempt whose output is used
+#   shards/<unit>.<attempt>/    the output of each attempt
+#
+# Only operations that are atomic on shared filesystems such as NFS are
+# relied on: creating a file that must not exist, hard links and
+# renames. The clocks of the machines need to agree to well within
+# stale_after.
+
+import os
+import json
+import time
+import uuid
+import socket
+import threading
+from pathlib import Path
+
+QUEUE_FILE = 'queue.json'
+CLAIMS_DIR = 'claims'
+DONE_DIR = 'done'
+SHARDS_DIR = 'shards'
+
+# Seconds after which a claim that has not been renewed is taken to
+# belong to a worker that died.
+DEFAULT_STALE_AFTER = 300
+
+# Claims are renewed this many times within stale_after, so that one
+# slow write to the shared filesystem does not lose a claim.
+HEARTBEATS_PER_STALE = 5
+
+# Longest wait, in seconds, before looking for work again when every
+# unfinished unit is claimed. This is kept well below stale_after so
+# that a worker with nothing left to do notices soon after the last
+# unit is finished.
+MAX_POLL_INTERVAL = 5
+
+# Name of the pseudo-unit claimed by the worker that merges the shards.
+MERGE_UNIT = 'merge'
+
+
+def worker_name():
+    """
+    Return a name for this process that is unique across machines.
+    """
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+def _write_new(path, content):
+    """
+    Write ``content`` to ``path`` in one go, unless ``path`` already
+    exists. Returns ``True`` if the file was written.
+
+    The content goes to a temporary file that is then hard linked to
+    ``path``, so nobody ever sees a half written file and only one of
+    several processes racing to write ``path`` succeeds.
+    """
+    path = Path(path)
+    temp_path = path.with_name(f'{path.name}.{uuid.uuid4().hex}.tmp')
+    temp_path.write_text(content)
+    try:
+        os.link(temp_path, path)
+    except FileExistsError:
+        return False
+    finally:
+        temp_path.unlink()
+    return True
+
+
+class WorkQueue:
+    """
+    A queue of units of work in a directory shared by the workers.
+
+    Use ``WorkQueue.open`` to make the queue or join one that already
+    exists.
+
+    Parameters
+    ----------
+    path : str or Path
+        The queue directory.
+    settings : dict
+        Settings of the run; every worker must use the same ones.
+    units : list of (str, list)
+        The name and sources of each unit of work, in order.
+    stale_after : float, optional
+        Seconds after which an unrenewed claim can be taken over.
+    """
+
+    def __init__(self, path, settings, units,
+                 stale_after=DEFAULT_STALE_AFTER):
+        self.path = Path(path)
+        self.settings = settings
+        self.units = units
+        self.stale_after = stale_after
+
+    @classmethod
+    def open(cls, path, settings, make_sources, unit_size,
+             stale_after=DEFAULT_STALE_AFTER):
+        """
+        Join the queue in ``path``, making it first if it does not exist.
+
+        Parameters
+        ----------
+        path : str or Path
+            The queue directory.
+        settings : dict
+            Settings of the run, which must match those the queue was
+            made with.
+        make_sources : callable
+            Called with no arguments to get the list of sources, only if
+            the queue has to be made.
+        unit_size : int
+            Number of sources in each unit of work.
+        stale_after : float, optional
+            Seconds after which an unrenewed claim can be taken over.
+        """
+        path = Path(path)
+        for directory in (CLAIMS_DIR, DONE_DIR, SHARDS_DIR):
+            (path / directory).mkdir(parents=True, exist_ok=True)
+
+        queue_path = path / QUEUE_FILE
+        if not queue_path.exists():
+            sources = make_sources()
+            units = [
+                dict(unit=f'unit-{i // unit_size:05d}',
+                     sources=[list(source) if isinstance(source, tuple)
+                              else source
+                              for source in sources[i:i + unit_size]])
+                for i in range(0, len(sources), unit_size)
+            ]
+            # If another worker made the queue first, theirs is used.
+            _write_new(queue_path, json.dumps(dict(settings=settings,
+                                                   units=units)))
+
+        header = json.loads(queue_path.read_text())
+        if header['settings'] != settings:
+            raise RuntimeError(f'The queue in {path} is for a different '
+                               f'run: {header["settings"]}')
+        # Course ID/year_term pairs are tuples everywhere else, but JSON
+        # turns them into lists.
+        units = [(unit['unit'],
+                  [tuple(source) if isinstance(source, list) else source
+                   for source in unit['sources']])
+                 for unit in header['units']]
+        return cls(path, settings, units, stale_after=stale_after)
+
+    @property
+    def source_list(self):
+        """
+        All of the sources, in order.
+        """
+        return [source for _, sources in self.units for source in sources]
+
+    def _lock_path(self, unit):
+        return self.path / CLAIMS_DIR / f'{unit}.lock'
+
+    def _done_path(self, unit):
+        return self.path / DONE_DIR / f'{unit}.json'
+
+    def shard_dir(self, unit, attempt):
+        """
+        The directory for the output of one attempt at a unit.
+        """
+        return self.path / SHARDS_DIR / f'{unit}.{attempt}'
+
+    def done_record(self, unit):
+        """
+        Return the record of a finished unit, or ``None`` if it is not
+        finished.
+        """
+        try:
+            return json.loads(self._done_path(unit).read_text())
+        except FileNotFoundError:
+            return None
+
+    def unfinished(self):
+        """
+        Names of the units that are not finished yet, in order.
+        """
+        return [unit for unit, _ in self.units
+                if not self._done_path(unit).exists()]
+
+    def claim(self, unit, sources=()):
+        """
+        Claim a unit, taking over the claim of a dead worker if need be.
+
+        Returns
+        -------
+        Claim or None
+            The claim, or ``None`` if the unit is finished or another
+            worker holds it.
+        """
+        if self._done_path(unit).exists():
+            return None
+        lock_path = self._lock_path(unit)
+        if lock_path.exists() and not self._take_over(lock_path):
+            return None
+        attempt = uuid.uuid4().hex[:12]
+        content = json.dumps(dict(attempt=attempt, worker=worker_name(),
+                                  claimed=time.time()))
+        if not _write_new(lock_path, content):
+            return None
+        # The unit may have been finished between the check above and
+        # making the claim.
+        if self._done_path(unit).exists():
+            lock_path.unlink()
+            return None
+        return Claim(self, unit, list(sources), attempt)
+
+    def _take_over(self, lock_path):
+        """
+        Remove a stale lock file. Returns ``True`` if there is no lock
+        file left.
+        """
+        try:
+            if time.time() - lock_path.stat().st_mtime < self.stale_after:
+                return False
+            # Renaming is atomic, so only one of the workers that saw
+            # the stale claim gets it.
+            moved = lock_path.with_name(
+                f'{lock_path.name}.{uuid.uuid4().hex}.stale')
+            lock_path.rename(moved)
+        except FileNotFoundError:
+            return True
+        if time.time() - moved.stat().st_mtime < self.stale_after:
+            # Another worker took it over, and renewed it, between the
+            # check and the rename; give it back.
+            try:
+                os.link(moved, lock_path)
+            except FileExistsError:
+                pass
+            moved.unlink()
+            return False
+        previous = json.loads(moved.read_text())
+        print(f'Taking over {lock_path.stem} from {previous["worker"]}, '
+              'which stopped renewing its claim.')
+        moved.unlink()
+        return True
+
+    def claim_next(self):
+        """
+        Claim the first unit that is neither finished nor held by a live
+        worker, or return ``None`` if there is none.
+        """
+        for unit, sources in self.units:
+            claim = self.claim(unit, sources)
+            if claim is not None:
+                return claim
+        return None
+
+
+class Claim:
+    """
+    A worker's claim on a unit of work, renewed in the background while
+    it is used as a context manager. Leaving the context without calling
+    ``complete`` gives the unit back.
+
+    Parameters
+    ----------
+    queue : WorkQueue
+        The queue the unit is in.
+    unit : str
+        The name of the unit.
+    sources : list
+        The sources of the unit.
+    attempt : str
+        Name of this attempt at the unit.
+    """
+
+    def __init__(self, queue, unit, sources, attempt):
+        self.queue = queue
+        self.unit = unit
+        self.sources = sources
+        self.attempt = attempt
+        self.shard_dir = queue.shard_dir(unit, attempt)
+        self._lock_path = queue._lock_path(unit)
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def __enter__(self):
+        interval = self.queue.stale_after / HEARTBEATS_PER_STALE
+        self._heartbeat = threading.Thread(target=self._renew,
+                                           args=(interval,), daemon=True)
+        self._heartbeat.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._heartbeat.join()
+        self.release()
+
+    def _renew(self, interval):
+        while not self._stop.wait(interval):
+            if not self.is_held():
+                return
+            try:
+                os.utime(self._lock_path)
+            except FileNotFoundError:
+                return
+
+    def is_held(self):
+        """
+        Whether the lock file is still this attempt's.
+        """
+        try:
+            content = json.loads(self._lock_path.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+        return content['attempt'] == self.attempt
+
+    def complete(self, record):
+        """
+        Mark the unit finished, with this attempt's output, unless the
+        claim was lost.
+
+        Parameters
+        ----------
+        record : dict
+            What to record about the unit, such as numbers of rows.
+
+        Returns
+        -------
+        bool
+            ``True`` if this attempt's output is the one used.
+        """
+        if not self.is_held():
+            return False
+        record = dict(record, unit=self.unit, attempt=self.attempt,
+                      worker=worker_name(), finished=time.time())
+        return _write_new(self.queue._done_path(self.unit),
+                          json.dumps(record))
+
+    def release(self):
+        """
+        Give up the claim, if it is still held.
+        """
+        if self.is_held():
+            self._lock_path.unlink(missing_ok=True)
+
+
+def work(queue, do_unit, poll_interval=None):
+    """
+    Claim and do units until every unit in the queue is finished,
+    waiting while other workers hold the rest so that their units can be
+    taken over if they die.
+
+    Parameters
+    ----------
+    queue : WorkQueue
+        The queue to work on.
+    do_unit : callable
+        Called with a ``Claim``; it writes the output of the unit to
+        ``claim.shard_dir`` and returns a dict to record about the unit.
+        If it raises, the unit is given back and the exception passed on.
+    poll_interval : float, optional
+        Seconds to wait before looking for work again when every
+        unfinished unit is claimed. By default a tenth of
+        ``queue.stale_after``, but no more than ``MAX_POLL_INTERVAL``.
+
+    Returns
+    -------
+    int
+        Number of units finished by this worker.
+    """
+    if poll_interval is None:
+        poll_interval = min(MAX_POLL_INTERVAL, queue.stale_after / 10)
+    finished = 0
+    while True:
+        claim = queue.claim_next()
+        if claim is None:
+            if not queue.unfinished():
+                return finished
+            time.sleep(poll_interval)
+            continue
+        with claim:
+            record = do_unit(claim)
+            if claim.complete(record):
+                finished += 1
+            else:
+                print(f'Another worker took over {claim.unit}; its output '
+                      'is used instead.')
+
+
+def merge_once(queue, merge):
+    """
+    Merge the shards, unless another worker has done it or is doing it.
+
+    Parameters
+    ----------
+    queue : WorkQueue
+        A queue whose units are all finished.
+    merge : callable
+        Called with the queue; it combines the output of the finished
+        attempts and returns a dict to record about the merge.
+
+    Returns
+    -------
+    dict or None
+        The record of the merge, or ``None`` if another worker is
+        merging. The ``worker`` of the record says who did the merge.
+    """
+    record = queue.done_record(MERGE_UNIT)
+    if record is not None:
+        return record
+    claim = queue.claim(MERGE_UNIT)
+    if claim is None:
+        return queue.done_record(MERGE_UNIT)
+    with claim:
+        record = dict(merge(queue), worker=worker_name())
+        claim.complete(record)
+    return record
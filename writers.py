@@ -0,0 +1,666 @@
+# Writers for the output of scrape.py.
+#
+# The table for each subject (or course ID) is appended to the output
+# file as soon as it is ready, so nothing larger than one subject is ever
+# held in memory. A small JSON manifest next to the output records how
+# many rows and bytes each batch added and their checksums, which is
+# enough to check the output without reading it back in.
+#
+# Besides the usual CSV file, the output can be a Parquet or Arrow IPC
+# dataset partitioned by campus and year/term, in which the columns
+# have compact types (categorical, integer, boolean and datetime)
+# instead of all being strings. Those are much faster to load for
+# analysis, and read_dataset turns them back into exactly the CSV
+# layout. The rows of each partition are put together into files of up
+# to ROWS_PER_FILE rows, rather than a file for every subject or course
+# ID, so those rows are held in memory until their file is written.
+
+import os
+import json
+import hashlib
+import argparse
+from pathlib import Path
+
+import polars as pl
+
+# Suffix added to the name of the output file to get the manifest name.
+MANIFEST_SUFFIX = '.manifest.json'
+
+# Number of bytes to read at a time when checking a checksum.
+HASH_CHUNK_SIZE = 1 << 20
+
+# Output formats and the file extension for each.
+OUTPUT_FORMATS = {
+    'csv': '.csv',
+    'parquet': '.parquet',
+    'ipc': '.arrow',
+}
+
+# Compact types used for the columns of a dataset. Any column not listed
+# here stays a string.
+CATEGORICAL_COLUMNS = ['Subj', 'Status', 'Delivery Method', 'Course level',
+                       'Tuition unit']
+INTEGER_COLUMNS = ['Size:', 'Enrolled:']
+BOOLEAN_COLUMNS = ['18online']
+TIMESTAMP_COLUMN = 'timestamp'
+
+# Number of rows of a partition of a dataset held before they are
+# written out as one file.
+ROWS_PER_FILE = 100_000
+
+# The columns a dataset is partitioned on. They are stored in the
+# directory names rather than in the files.
+CAMPUS_COLUMN = 'campus_id'
+YEAR_TERM_COLUMN = 'year_term'
+
+NANOSECONDS = 1_000_000_000
+
+
+def manifest_path_for(path):
+    """
+    Return the path of the manifest for the output file ``path``.
+    """
+    path = Path(path)
+    return path.with_name(path.name + MANIFEST_SUFFIX)
+
+
+def source_label(source):
+    """
+    Return a string naming a source, which is either a subject or a
+    ``(course_id, year_term)`` pair.
+    """
+    if isinstance(source, tuple):
+        return '-'.join(source)
+    return source
+
+
+def sources_name(source_list):
+    """
+    Return what the sources in ``source_list`` are called in messages:
+    ``'subjects'``, or ``'course IDs'`` for ``(course_id, year_term)``
+    pairs.
+    """
+    if source_list and isinstance(source_list[0], tuple):
+        return 'course IDs'
+    return 'subjects'
+
+
+class StreamingCSVWriter:
+    """
+    Append batches of rows to a single CSV file and keep a manifest of
+    what has been written.
+
+    Parameters
+    ----------
+    path : str or Path
+        The CSV file to write. It must not exist yet, unless resuming.
+    resume_sources : set of str, optional
+        Labels of the sources of an interrupted run whose batches are to
+        be kept. Each batch is checked against the size and checksum in
+        the manifest, and only the batches up to the first that is
+        missing or damaged are kept. The file is cut back to the end of
+        the last batch kept and writing carries on from there.
+    """
+
+    def __init__(self, path, resume_sources=None):
+        self.path = Path(path)
+        self.manifest_path = manifest_path_for(self.path)
+        self.rows = 0
+        self.bytes = 0
+        self.batches = []
+        self._columns = None
+        self._sha256 = hashlib.sha256()
+        if resume_sources is None:
+            self._file = open(self.path, 'xb')
+        else:
+            self._resume(resume_sources)
+
+    def _resume(self, resume_sources):
+        if self.manifest_path.exists():
+            manifest = read_manifest(self.path)
+            self._columns = manifest['columns']
+            size = self.path.stat().st_size if self.path.exists() else 0
+            # Batches are in the order they were written, so keep them up
+            # to the first that was not finished, or that is not in the
+            # file as it was written.
+            with open(self.path, 'ab+') as f:
+                f.seek(0)
+                for batch in manifest['batches']:
+                    if (batch['source'] not in resume_sources or
+                            batch['offset'] != self.bytes or
+                            self.bytes + batch['bytes'] > size):
+                        break
+                    content = f.read(batch['bytes'])
+                    if (hashlib.sha256(content).hexdigest() !=
+                            batch['sha256']):
+                        break
+                    self._sha256.update(content)
+                    self.batches.append(batch)
+                    self.rows += batch['rows']
+                    self.bytes += batch['bytes']
+
+        # Anything after the kept batches may be only partly written.
+        self._file = open(self.path, 'ab')
+        self._file.truncate(self.bytes)
+        if not self.batches:
+            self._columns = None
+        self._write_manifest()
+
+    def write_batch(self, data_df, source):
+        """
+        Append a table to the output and record it in the manifest.
+
+        Parameters
+        ----------
+        data_df : polars DataFrame
+            The rows to write. Every batch must have the same columns.
+        source : str or tuple
+            The subject or ``(course_id, year_term)`` the rows are for.
+        """
+        if self._columns is None:
+            self._columns = data_df.columns
+        elif data_df.columns != self._columns:
+            raise ValueError('Columns of batch for {} do not match the '
+                             'output'.format(source_label(source)))
+
+        # Only the first batch gets a header, so the file is the same as
+        # writing all of the batches as one table.
+        content = data_df.write_csv(include_header=not self.batches)
+        content = content.encode('utf-8')
+
+        self._file.write(content)
+        self._file.flush()
+        # The batch must be on disk before the manifest, and then the
+        # journal, say that it is.
+        os.fsync(self._file.fileno())
+        self._sha256.update(content)
+
+        self.batches.append(dict(
+            source=source_label(source),
+            rows=len(data_df),
+            offset=self.bytes,
+            bytes=len(content),
+            sha256=hashlib.sha256(content).hexdigest(),
+        ))
+        self.rows += len(data_df)
+        self.bytes += len(content)
+        self._write_manifest()
+
+    def sources(self):
+        """
+        Labels of the sources whose batches are in the output. When
+        resuming, these are the sources of ``resume_sources`` whose
+        batches were found intact.
+        """
+        return {batch['source'] for batch in self.batches}
+
+    def close(self):
+        """
+        Close the output file and write the final manifest.
+        """
+        self._file.close()
+        self._write_manifest(complete=True)
+
+    def _write_manifest(self, complete=False):
+        manifest = dict(
+            file=self.path.name,
+            complete=complete,
+            columns=self._columns,
+            rows=self.rows,
+            bytes=self.bytes,
+            sha256=self._sha256.hexdigest(),
+            batches=self.batches,
+        )
+        _write_manifest_file(self.manifest_path, manifest)
+
+    def verify(self, checksum=False):
+        """
+        Check the output file against the manifest. By default only the
+        size is checked; with ``checksum`` the file is hashed too.
+
+        Returns
+        -------
+        bool
+            ``True`` if the file matches the manifest.
+        """
+        return verify_output(self.path, checksum=checksum)
+
+
+def _write_manifest_file(manifest_path, manifest):
+    """
+    Replace the manifest at ``manifest_path`` with ``manifest``.
+    """
+    # Write to a temporary file first, and make sure it is on disk, so
+    # that the manifest is never left half written, even by a crash of
+    # the whole machine.
+    temp_path = manifest_path.with_suffix('.tmp')
+    with open(temp_path, 'w') as f:
+        f.write(json.dumps(manifest, indent=2))
+        f.flush()
+        os.fsync(f.fileno())
+    temp_path.replace(manifest_path)
+
+
+def read_manifest(path):
+    """
+    Return the manifest for the output file or dataset ``path`` as a
+    dict.
+    """
+    return json.loads(manifest_path_for(path).read_text())
+
+
+def verify_output(path, checksum=False):
+    """
+    Check an output file against its manifest without parsing it.
+
+    Parameters
+    ----------
+    path : str or Path
+        The output file.
+    checksum : bool, optional
+        Also check the SHA-256 checksum of the whole file, which means
+        reading it (but not parsing it).
+
+    Returns
+    -------
+    bool
+        ``True`` if the file matches the manifest.
+    """
+    path = Path(path)
+    manifest = read_manifest(path)
+    if path.stat().st_size != manifest['bytes']:
+        return False
+    if sum(batch['rows'] for batch in manifest['batches']) != manifest['rows']:
+        return False
+    if checksum:
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                sha256.update(chunk)
+        if sha256.hexdigest() != manifest['sha256']:
+            return False
+    return True
+
+
+def to_compact(data_df):
+    """
+    Convert a table in the CSV layout to the compact column types used
+    in datasets.
+    """
+    stamp = pl.col(TIMESTAMP_COLUMN)
+    whole_seconds = stamp.floor()
+    # Convert whole and fractional seconds separately so that no
+    # precision is lost and the conversion back gives the same floats.
+    nanoseconds = (whole_seconds.cast(pl.Int64) * NANOSECONDS +
+                   ((stamp - whole_seconds) * NANOSECONDS).round()
+                   .cast(pl.Int64))
+    return data_df.with_columns(
+        [pl.col(col).cast(pl.Categorical) for col in CATEGORICAL_COLUMNS] +
+        [pl.col(col).cast(pl.Int32) for col in INTEGER_COLUMNS] +
+        [(pl.col(col) == 'True').alias(col) for col in BOOLEAN_COLUMNS] +
+        [nanoseconds.cast(pl.Datetime('ns', 'UTC')).alias(TIMESTAMP_COLUMN)]
+    )
+
+
+def from_compact(data_df):
+    """
+    Convert a table with the compact column types used in datasets back
+    to the types of the CSV layout.
+    """
+    stamp = pl.col(TIMESTAMP_COLUMN).dt.epoch('ns')
+    seconds = ((stamp // NANOSECONDS).cast(pl.Float64) +
+               (stamp % NANOSECONDS).cast(pl.Float64) / NANOSECONDS)
+    return data_df.with_columns(
+        [pl.col(col).cast(pl.Utf8) for col in CATEGORICAL_COLUMNS] +
+        [pl.col(col).cast(pl.Int64) for col in INTEGER_COLUMNS] +
+        [pl.when(pl.col(col)).then(pl.lit('True'))
+         .when(~pl.col(col)).then(pl.lit('False'))
+         .alias(col) for col in BOOLEAN_COLUMNS] +
+        [seconds.alias(TIMESTAMP_COLUMN)]
+    )
+
+
+class DatasetWriter:
+    """
+    Write batches of rows to a Parquet or Arrow IPC dataset partitioned
+    by campus and year/term, and keep a manifest of what has been
+    written.
+
+    The rows of each partition are held until there are
+    ``rows_per_file`` of them, or the writer is closed, and are then
+    written as one file, so a term scraped one course ID at a time is
+    still a few large files rather than thousands of tiny ones. The
+    files are laid out as
+    ``<path>/campus_id=<campus>/year_term=<year_term>/part-<n>.<ext>``,
+    so the dataset can also be loaded directly, for example with
+    ``pl.scan_parquet('<path>/**/*.parquet', hive_partitioning=True)``.
+
+    Only the batches in files already written are in the manifest, so
+    when a run dies the batches still held are not, and a resumed run
+    fetches them again.
+
+    Parameters
+    ----------
+    path : str or Path
+        Directory for the dataset. It must not exist yet.
+    campus_id : int
+        The campus the data is for.
+    output_format : str, optional
+        Either 'parquet' or 'ipc'.
+    resume_sources : set of str, optional
+        Labels of the sources of an interrupted run whose files are to be
+        kept. A file is kept only if it is still there with the size in
+        the manifest and all of its sources are in ``resume_sources``;
+        the other files are removed.
+    rows_per_file : int, optional
+        Number of rows of a partition to hold before writing them out.
+    """
+
+    def __init__(self, path, campus_id, output_format='parquet',
+                 resume_sources=None, rows_per_file=ROWS_PER_FILE):
+        if output_format not in ('parquet', 'ipc'):
+            raise ValueError('Unknown dataset format '
+                             '{}'.format(output_format))
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=resume_sources is not None)
+        # The manifest goes beside the dataset directory, not in it, so
+        # that the directory can be scanned as a whole by polars.
+        self.manifest_path = manifest_path_for(self.path)
+        self.campus_id = campus_id
+        self.output_format = output_format
+        self.rows_per_file = rows_per_file
+        self.rows = 0
+        self.bytes = 0
+        # Every batch, in the order written; those still held have no
+        # file yet.
+        self.batches = []
+        self.files = []
+        self._columns = None
+        # Tables and batches held for each year/term, and how many rows
+        # they have.
+        self._pending = {}
+        self._pending_rows = {}
+        self._next_file = 0
+        if resume_sources is not None and self.manifest_path.exists():
+            self._resume(resume_sources)
+
+    def _resume(self, resume_sources):
+        manifest = read_manifest(self.path)
+        kept = set()
+        for entry in _manifest_files(manifest):
+            file_path = self.path / entry['file']
+            if (set(entry['sources']) <= resume_sources and
+                    file_path.exists() and
+                    file_path.stat().st_size == entry['bytes']):
+                self.files.append(entry)
+                self.bytes += entry['bytes']
+                kept.add(entry['file'])
+            else:
+                file_path.unlink(missing_ok=True)
+            self._next_file = max(self._next_file, entry['number'] + 1)
+        for batch in manifest['batches']:
+            if batch['file'] in kept:
+                self.batches.append(batch)
+                self.rows += batch['rows']
+        if self.batches:
+            self._columns = manifest['columns']
+        self._write_manifest()
+
+    def write_batch(self, data_df, source):
+        """
+        Add a table to the rows held for its partition, and write them
+        out if there are enough of them.
+
+        Parameters
+        ----------
+        data_df : polars DataFrame
+            The rows to write, in the CSV layout. All rows must have the
+            same year/term.
+        source : str or tuple
+            The subject or ``(course_id, year_term)`` the rows are for.
+        """
+        if self._columns is None:
+            self._columns = data_df.columns
+        elif data_df.columns != self._columns:
+            raise ValueError('Columns of batch for {} do not match the '
+                             'output'.format(source_label(source)))
+
+        year_terms = data_df[YEAR_TERM_COLUMN].unique().to_list()
+        if len(year_terms) != 1:
+            raise ValueError('Batch for {} has more than one '
+                             'year/term'.format(source_label(source)))
+        year_term = year_terms[0]
+
+        batch = dict(source=source_label(source), rows=len(data_df))
+        self.batches.append(batch)
+        self.rows += len(data_df)
+        tables, batches = self._pending.setdefault(year_term, ([], []))
+        tables.append(data_df)
+        batches.append(batch)
+        self._pending_rows[year_term] = (self._pending_rows.get(year_term, 0)
+                                         + len(data_df))
+        if self._pending_rows[year_term] >= self.rows_per_file:
+            self._flush(year_term)
+
+    def _flush(self, year_term):
+        """
+        Write the rows held for a year/term out as one file and record
+        it in the manifest.
+        """
+        tables, batches = self._pending.pop(year_term)
+        del self._pending_rows[year_term]
+        partition = (Path('{}={}'.format(CAMPUS_COLUMN, self.campus_id)) /
+                     '{}={}'.format(YEAR_TERM_COLUMN, year_term))
+        file_name = ('part-{:05}'.format(self._next_file) +
+                     OUTPUT_FORMATS[self.output_format])
+        (self.path / partition).mkdir(parents=True, exist_ok=True)
+        file_path = self.path / partition / file_name
+
+        compact_df = to_compact(pl.concat(tables)).drop(YEAR_TERM_COLUMN)
+        if self.output_format == 'parquet':
+            compact_df.write_parquet(file_path, compression='zstd')
+        else:
+            compact_df.write_ipc(file_path, compression='zstd')
+        with open(file_path, 'rb') as f:
+            os.fsync(f.fileno())
+
+        size = file_path.stat().st_size
+        # Where the rows of each batch are in the file, so that the
+        # batches can be read back in the order they were written.
+        offset = 0
+        for batch in batches:
+            batch.update(file=str(partition / file_name), offset=offset)
+            offset += batch['rows']
+        self.files.append(dict(
+            file=str(partition / file_name),
+            number=self._next_file,
+            rows=offset,
+            bytes=size,
+            sources=[batch['source'] for batch in batches],
+        ))
+        self._next_file += 1
+        self.bytes += size
+        self._write_manifest()
+
+    def sources(self):
+        """
+        Labels of the sources whose batches are in the dataset. When
+        resuming, these are the sources of ``resume_sources`` whose files
+        were found intact.
+        """
+        return {batch['source'] for batch in self.batches}
+
+    def close(self):
+        """
+        Write out the rows still held and the final manifest.
+        """
+        for year_term in list(self._pending):
+            self._flush(year_term)
+        self._write_manifest(complete=True)
+
+    def _write_manifest(self, complete=False):
+        batches = [batch for batch in self.batches if 'file' in batch]
+        manifest = dict(
+            format=self.output_format,
+            complete=complete,
+            columns=self._columns,
+            rows=sum(batch['rows'] for batch in batches),
+            bytes=self.bytes,
+            files=self.files,
+            batches=batches,
+        )
+        _write_manifest_file(self.manifest_path, manifest)
+
+    def verify(self, checksum=False):
+        """
+        Check that every file in the manifest is there with the size
+        recorded for it. ``checksum`` is accepted for compatibility with
+        ``StreamingCSVWriter`` and is ignored.
+
+        Returns
+        -------
+        bool
+            ``True`` if the dataset matches the manifest.
+        """
+        for entry in self.files:
+            file_path = self.path / entry['file']
+            if (not file_path.exists() or
+                    file_path.stat().st_size != entry['bytes']):
+                return False
+        return True
+
+
+def _manifest_files(manifest):
+    """
+    Return the files of a dataset manifest. Datasets written before
+    batches were put together have one file per batch and no list of
+    files.
+    """
+    if 'files' in manifest:
+        return manifest['files']
+    return [dict(file=batch['file'], number=number, rows=batch['rows'],
+                 bytes=batch['bytes'], sources=[batch['source']])
+            for number, batch in enumerate(manifest['batches'])]
+
+
+def open_writer(destination, campus_id, output_format='csv',
+                resume_sources=None):
+    """
+    Return the writer for the output of a run in ``destination``.
+
+    Parameters
+    ----------
+    destination : str or Path
+        The directory for the results of the run.
+    campus_id : int
+        The campus the data is for.
+    output_format : str, optional
+        One of the keys of ``OUTPUT_FORMATS``.
+    resume_sources : set of str, optional
+        When resuming an interrupted run, the labels of the sources whose
+        output is to be kept. The ``sources`` of the writer are those
+        that were found intact.
+    """
+    if output_format == 'csv':
+        return StreamingCSVWriter(Path(destination) / 'all_enrollments.csv',
+                                  resume_sources=resume_sources)
+    return DatasetWriter(Path(destination) / 'all_enrollments', campus_id,
+                         output_format=output_format,
+                         resume_sources=resume_sources)
+
+
+def read_dataset(path):
+    """
+    Read a dataset written by ``DatasetWriter`` back into the CSV
+    layout, with the rows in the order they were written.
+
+    Parameters
+    ----------
+    path : str or Path
+        The directory of the dataset.
+
+    Returns
+    -------
+    polars DataFrame
+        The same table that would have been written to
+        ``all_enrollments.csv``.
+    """
+    path = Path(path)
+    manifest = read_manifest(path)
+    if not manifest['batches']:
+        return pl.DataFrame()
+
+    files = {}
+    for entry in _manifest_files(manifest):
+        file_path = path / entry['file']
+        if manifest['format'] == 'parquet':
+            file_df = pl.read_parquet(file_path)
+        else:
+            file_df = pl.read_ipc(file_path)
+        # The year/term comes from the name of the partition.
+        year_term = file_path.parent.name.split('=', 1)[1]
+        file_df = file_df.with_columns(
+            pl.lit(year_term, dtype=pl.Utf8).alias(YEAR_TERM_COLUMN)
+        )
+        files[entry['file']] = from_compact(file_df).select(
+            manifest['columns'])
+    # A file holds the batches of one partition, so put the batches back
+    # in the order they were written.
+    return pl.concat([files[batch['file']].slice(batch.get('offset', 0),
+                                                 batch['rows'])
+                      for batch in manifest['batches']])
+
+
+def has_output(destination):
+    """
+    Whether the results directory ``destination`` has output to read, in
+    either format. A dataset counts only once its manifest is written.
+    """
+    destination = Path(destination)
+    return ((destination / ('all_enrollments' +
+                            OUTPUT_FORMATS['csv'])).exists() or
+            manifest_path_for(destination / 'all_enrollments').exists())
+
+
+def read_batches(destination):
+    """
+    Read the output of a run in ``destination``, in either format, one
+    batch at a time.
+
+    Yields
+    ------
+    tuple
+        ``(label, data_df)`` for each batch in the order it was written,
+        with ``data_df`` in the CSV layout, ready to be passed to the
+        ``write_batch`` of another writer.
+    """
+    csv_path = Path(destination) / ('all_enrollments' + OUTPUT_FORMATS['csv'])
+    if csv_path.exists():
+        batches = read_manifest(csv_path)['batches']
+        if not batches:
+            return
+        data_df = pl.read_csv(csv_path, infer_schema_length=0).with_columns(
+            pl.col(TIMESTAMP_COLUMN).cast(pl.Float64)
+        )
+    else:
+        path = Path(destination) / 'all_enrollments'
+        batches = read_manifest(path)['batches']
+        data_df = read_dataset(path)
+
+    offset = 0
+    for batch in batches:
+        yield batch['source'], data_df.slice(offset, batch['rows'])
+        offset += batch['rows']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a scrape.py '
+                                     'Parquet or Arrow dataset out as '
+                                     'all_enrollments.csv')
+    parser.add_argument('dataset',
+                        help='Directory of the dataset.')
+    parser.add_argument('csv',
+                        help='CSV file to write.')
+    args = parser.parse_args()
+
+    read_dataset(args.dataset).write_csv(args.csv)